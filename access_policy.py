@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+The rules for which S3 paths users can be granted.
+
+Local authority users (custom:is_la = 1) can only be granted
+paths under [main_prefix]/local_authority/ and other users can
+only be granted paths outside it. Upload paths mirror the
+granted download paths under the upload prefix.
+
+AccessPolicy compiles the s3paths.json catalogue and the bucket
+prefix settings once so every check is a dict lookup or a walk
+up the parent folders of a key, however big the catalogue is.
+"""
+import threading
+
+from path_catalogue import CATALOGUE
+import config
+
+LOCAL_AUTHORITY_TYPE = "local_authority"
+
+OTHER_TYPE = "other"
+
+
+class AccessPolicy:
+    def __init__(self, catalogue, download_root, upload_root):
+        self.download_root = download_root
+        self.upload_root = upload_root
+        self.local_authority_folder = f"{download_root}/{LOCAL_AUTHORITY_TYPE}/"
+
+        # Catalogue folders by path value, e.g.
+        # {"web-app-prod-data/local_authority/barnet": {"type", "disp", "val"}}
+        self.entries = {}
+        for entry in catalogue:
+            for sub in entry.get("subs", []):
+                self.entries[sub["val"].rstrip("/")] = dict(sub, type=entry["type"])
+
+    def path_type(self, path):
+        if path.startswith(self.local_authority_folder):
+            return LOCAL_AUTHORITY_TYPE
+        return OTHER_TYPE
+
+    def path_is_valid(self, is_la, path):
+        """ Can a user of this type be granted path """
+        if path == "":
+            return False
+        return (self.path_type(path) == LOCAL_AUTHORITY_TYPE) == is_la
+
+    def invalid_paths(self, is_la, paths):
+        return [path for path in paths if not self.path_is_valid(is_la, path)]
+
+    def is_download_path(self, path):
+        return path.startswith(self.download_root)
+
+    def download_paths(self, paths):
+        return [path for path in paths if self.is_download_path(path)]
+
+    def upload_path(self, download_path):
+        """ Map a granted download path to its upload path """
+        return download_path.replace(self.download_root, self.upload_root, 1)
+
+    def owner(self, key):
+        """
+        Return the catalogue folder holding key or None
+
+        Only the key's parent folders are looked up
+        so this doesn't depend on the catalogue size.
+        """
+        folder = key.rstrip("/")
+        while folder:
+            if folder in self.entries:
+                return self.entries[folder]
+            folder = folder.rpartition("/")[0]
+        return None
+
+
+POLICY_CACHE = {}
+
+POLICY_LOCK = threading.Lock()
+
+
+def clear_access_policy_cache():
+    with POLICY_LOCK:
+        POLICY_CACHE.clear()
+
+
+def get_access_policy():
+    """
+    Return the AccessPolicy for the current settings
+
+    The policy is compiled again if the bucket prefixes
+    or the catalogue change.
+    """
+    roots = (
+        config.get("bucket_main_prefix", "web-app-prod-data"),
+        config.get("bucket_upload_prefix", "web-app-upload"),
+    )
+    catalogue = CATALOGUE.get_entries()
+    key = roots + (CATALOGUE.version,)
+    with POLICY_LOCK:
+        if POLICY_CACHE.get("key") != key:
+            POLICY_CACHE["policy"] = AccessPolicy(catalogue, *roots)
+            POLICY_CACHE["key"] = key
+        return POLICY_CACHE["policy"]
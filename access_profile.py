@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+The access profile of a logged in user.
+
+The profile is built once at login from the user's attributes
+and group and kept in the session. It holds the attributes as
+a dict, the granted download prefixes, the upload prefixes
+derived from them and the flags request handlers check, so
+none of that is worked out again on each request.
+
+get_access_profile returns a read only AccessProfile which is
+made once per request however many times it is asked for.
+"""
+from types import MappingProxyType
+from typing import NamedTuple
+
+from flask import g, has_app_context
+
+from access_policy import get_access_policy
+
+ADMIN_GROUPS = ["admin-view", "admin-power", "admin-full"]
+
+UPLOAD_GROUPS = ["standard-upload"]
+
+
+class AccessProfile(NamedTuple):
+    attributes: MappingProxyType
+    download_prefixes: tuple
+    upload_prefixes: tuple
+    group_name: str
+    is_la: bool
+    can_upload: bool
+    is_admin: bool
+
+
+def granted_prefixes(paths_attribute):
+    """
+    Return the download prefixes in a custom:paths
+    attribute and the matching upload prefixes
+
+    Only paths under the app's download prefix are granted.
+    """
+    policy = get_access_policy()
+    download_prefixes = policy.download_paths(paths_attribute.split(";"))
+    upload_prefixes = [policy.upload_path(path) for path in download_prefixes]
+    return download_prefixes, upload_prefixes
+
+
+def build_access_profile(attributes, group):
+    """
+    Return the profile for a cognito attribute list and group
+    as plain values which can be stored in the session
+    """
+    attribute_map = {
+        attribute["Name"]: attribute["Value"]
+        for attribute in attributes
+        if "Name" in attribute
+    }
+    download_prefixes, upload_prefixes = granted_prefixes(
+        attribute_map.get("custom:paths", "")
+    )
+    group_name = (group or {}).get("value", "")
+    return {
+        "attributes": attribute_map,
+        "download_prefixes": download_prefixes,
+        "upload_prefixes": upload_prefixes,
+        "group_name": group_name,
+        "is_la": attribute_map.get("custom:is_la") == "1",
+        "can_upload": group_name in UPLOAD_GROUPS,
+        "is_admin": group_name in ADMIN_GROUPS,
+    }
+
+
+def get_access_profile(user_session):
+    """
+    Return the AccessProfile for a session
+
+    Sessions from before profiles were kept in the
+    session have one built from their attribute list.
+    """
+    stored = user_session.get("access_profile")
+    source = stored if stored is not None else user_session.get("attributes")
+    cache_key = (id(user_session), id(source))
+
+    cached = g.get("access_profile") if has_app_context() else None
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+
+    if stored is None:
+        stored = build_access_profile(
+            user_session.get("attributes", []), user_session.get("group")
+        )
+    profile = AccessProfile(
+        attributes=MappingProxyType(dict(stored["attributes"])),
+        download_prefixes=tuple(stored["download_prefixes"]),
+        upload_prefixes=tuple(stored["upload_prefixes"]),
+        group_name=stored["group_name"],
+        is_la=stored["is_la"],
+        can_upload=stored["can_upload"],
+        is_admin=stored["is_admin"],
+    )
+    if has_app_context():
+        g.access_profile = (cache_key, profile)
+    return profile
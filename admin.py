@@ -1,32 +1,61 @@
 #!/usr/bin/env python3
 # import os
-
-from flask import Flask, escape, redirect, request, session, url_for
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import (
+    Flask,
+    Response,
+    escape,
+    redirect,
+    request,
+    session,
+    stream_with_context,
+    url_for,
+)
 from requests.utils import quote, unquote
 
-from cognito_groups import get_group_by_name, return_users_group, user_groups
+from access_policy import get_access_policy
+import bulk_users
+import config
+import export_users
+from cognito import CLIENT_EXCEPTIONS
+from cognito_groups import (
+    get_group_by_name,
+    get_group_map,
+    return_users_group,
+    user_groups,
+)
 from flask_helpers import render_template_custom, user_has_a_valid_role
+from logger import LOG
+from path_catalogue import CATALOGUE
+import path_impact
 from user import User
-import config
+import user_directory
+
+ADMIN_LIST_PAGE_SIZES = [10, 20, 40, 60]
+
+ADMIN_LIST_DEFAULT_PAGE_SIZE = 20
+
+# With USER_LIST_PREFETCH set the page after the one being viewed
+# on /admin/user/list is fetched in the background so following
+# "Next" is instant. It is off on lambda, which freezes the
+# container once the response is sent.
+USER_LIST_PREFETCH = {}
 
+USER_LIST_PREFETCH_LOCK = threading.Lock()
 
-local_valid_paths_var = []
+USER_LIST_PREFETCH_TTL_SECONDS = 30
 
+USER_LIST_PREFETCH_MAX_PAGES = 32
 
-def _local_valid_paths():
-    global local_valid_paths_var
-    if local_valid_paths_var == []:
-        local_valid_paths_var = config.load_s3_paths()
-    return local_valid_paths_var
+USER_LIST_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="user-list")
 
 
 def value_paths_by_type(type):
-    res = []
-    for lvp in _local_valid_paths():
-        if lvp["type"] == type:
-            res = lvp
-            break
-    return res
+    return CATALOGUE.entry_for_type(type)
 
 
 def admin_user(app):
@@ -92,14 +121,155 @@ def clear_session(app):
         session.pop("admin_user_object")
 
 
+def user_list_prefetch_enabled():
+    return (
+        config.get("user_list_prefetch", "false") == "true"
+        and not config.running_on_lambda()
+    )
+
+
+def user_list_page(email_starts_filter, token, limit):
+    """
+    Return a page of User.list, taking it from the
+    prefetched pages if it was fetched ahead of time,
+    and start fetching the page that follows it
+    if prefetching is enabled.
+    """
+    if not user_list_prefetch_enabled():
+        return User.list(email_starts_filter, token, limit)
+
+    now = time.monotonic()
+    with USER_LIST_PREFETCH_LOCK:
+        for key, (expires, _) in list(USER_LIST_PREFETCH.items()):
+            if expires <= now:
+                del USER_LIST_PREFETCH[key]
+        prefetched = USER_LIST_PREFETCH.pop((email_starts_filter, token, limit), None)
+
+    page = None
+    if prefetched is not None:
+        try:
+            page = prefetched[1].result()
+        except CLIENT_EXCEPTIONS as error:
+            # Fetched again below
+            LOG.error(error)
+    if page is None:
+        page = User.list(email_starts_filter, token, limit)
+
+    next_token = page["token"]
+    key = (email_starts_filter, next_token, limit)
+    with USER_LIST_PREFETCH_LOCK:
+        if (
+            next_token
+            and key not in USER_LIST_PREFETCH
+            and len(USER_LIST_PREFETCH) < USER_LIST_PREFETCH_MAX_PAGES
+        ):
+            USER_LIST_PREFETCH[key] = (
+                now + USER_LIST_PREFETCH_TTL_SECONDS,
+                USER_LIST_EXECUTOR.submit(
+                    User.list, email_starts_filter, next_token, limit
+                ),
+            )
+    return page
+
+
 def admin_list_users(app):
-    return render_template_custom("admin/list-user.html")
+    args = request.args
+    email = args.get("email", "").strip().lower()
+    token = args.get("token", "")
+    try:
+        page_size = int(args.get("page_size", ADMIN_LIST_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        page_size = ADMIN_LIST_DEFAULT_PAGE_SIZE
+    if page_size not in ADMIN_LIST_PAGE_SIZES:
+        page_size = ADMIN_LIST_DEFAULT_PAGE_SIZE
+
+    page = user_list_page(email, token, page_size)
+
+    return render_template_custom(
+        "admin/list-user.html",
+        users=page["users"],
+        email=email,
+        page_size=page_size,
+        page_sizes=ADMIN_LIST_PAGE_SIZES,
+        is_first_page=token == "",
+        next_token=page["token"],
+    )
+
+
+def admin_search_users(app):
+    """
+    Render the /admin/user/search flask route
+
+    Searches run against the local user directory which is
+    synced first if it is out of date. Posting task=sync
+    syncs it straight away.
+    """
+    if request.method == "POST" and request.form.get("task") == "sync":
+        user_directory.sync_user_directory()
+        return redirect(url_for("admin_search_users", **request.args))
+
+    args = request.args
+    is_la = {"yes": True, "no": False}.get(args.get("is_la", ""))
+    filters = {
+        "email_prefix": args.get("email_prefix", "").strip(),
+        "domain": args.get("domain", "").strip(),
+        "group_name": args.get("group", ""),
+        "is_la": is_la,
+        "path_prefix": args.get("path_prefix", "").strip(),
+        "phone_unverified": args.get("phone_unverified") == "yes",
+    }
+
+    users = []
+    is_search = any(value not in ("", None, False) for value in filters.values())
+    if is_search:
+        user_directory.sync_if_stale()
+        users = user_directory.search_users(**filters)
+
+    last_synced = user_directory.last_synced()
+    return render_template_custom(
+        "admin/search-user.html",
+        users=users,
+        is_search=is_search,
+        search=args,
+        available_groups=user_groups(),
+        search_limit=user_directory.SEARCH_LIMIT,
+        last_synced=(
+            datetime.fromtimestamp(last_synced).strftime("%d/%m/%Y %H:%M")
+            if last_synced
+            else None
+        ),
+    )
+
+
+def admin_path_impact(app):
+    """
+    Render the /admin/user/path-impact flask route
+
+    Lists the users holding a folder given as ?path= and
+    the granted paths which aren't in the catalogue.
+    """
+    path = request.args.get("path", "").strip()
+    user_directory.sync_if_stale()
+    last_synced = user_directory.last_synced()
+    return render_template_custom(
+        "admin/path-impact.html",
+        path=path,
+        affected=path_impact.affected_users(path) if path else {},
+        orphaned=path_impact.orphaned_paths(),
+        last_synced=(
+            datetime.fromtimestamp(last_synced).strftime("%d/%m/%Y %H:%M")
+            if last_synced
+            else None
+        ),
+    )
 
 
 def admin_main(app):
     clear_session(app)
     return render_template_custom(
-        "admin/index.html", can_create_users=user_has_a_valid_role(["admin-full"])
+        "admin/index.html",
+        can_create_users=user_has_a_valid_role(["admin-full"]),
+        can_update_users=user_has_a_valid_role(["admin-power", "admin-full"]),
     )
 
 
@@ -205,26 +375,17 @@ def parse_edit_form_fields(post_fields: dict, admin_user_object: dict, app: Flas
 def requested_path_matches_user_type(
     is_local_authority: bool, requested_path: str
 ) -> bool:
-    is_path_valid = True
-    if requested_path == "":
-        is_path_valid = False
-    elif (not is_local_authority) and "local_authority" in requested_path:
-        is_path_valid = False
-    elif is_local_authority and ("local_authority" not in requested_path):
-        is_path_valid = False
-    return is_path_valid
+    return get_access_policy().path_is_valid(is_local_authority, requested_path)
 
 
 def remove_invalid_user_paths(user: dict) -> dict:
-    user_custom_paths = user["custom:paths"].split(";")
+    policy = get_access_policy()
     is_local_authority_user = user["custom:is_la"] == "1"
-    valid_user_paths = []
-    for custom_path in user_custom_paths:
-        is_path_valid = requested_path_matches_user_type(
-            is_local_authority_user, custom_path
-        )
-        if is_path_valid:
-            valid_user_paths.append(custom_path)
+    valid_user_paths = [
+        custom_path
+        for custom_path in user["custom:paths"].split(";")
+        if policy.path_is_valid(is_local_authority_user, custom_path)
+    ]
 
     user["custom:paths"] = ";".join(valid_user_paths)
 
@@ -258,7 +419,7 @@ def perform_cognito_task(task: str, admin_user_object: dict) -> bool:
 def admin_edit_user(app):
     args = request.values
     new_user = False
-    user_custom_paths = []
+    user_custom_paths = set()
 
     task = ""
     if "task" in args:
@@ -292,7 +453,8 @@ def admin_edit_user(app):
         is_local_authority_user = admin_user_object["custom:is_la"] == "1"
         is_other_user = not is_local_authority_user
         admin_user_object = remove_invalid_user_paths(admin_user_object)
-        user_custom_paths = admin_user_object["custom:paths"].split(";")
+        # A set so checking each catalogue folder against it is a lookup
+        user_custom_paths = set(admin_user_object["custom:paths"].split(";"))
 
     return render_template_custom(
         "admin/edit-user.html",
@@ -404,3 +566,178 @@ def admin_delete_user(app):
 
 def admin_user_not_found(app):
     return render_template_custom("error.html", error="User not found")
+
+
+def admin_bulk_create_users(app):
+    """
+    Render the /admin/user/bulk flask route
+
+    A posted CSV of users is validated in full and
+    nothing is created unless every row is valid.
+    The first batch is created straight away,
+    task=run creates the next batch of a job and
+    task=retry puts a job's failed users back in the queue.
+    The progress of a job is shown when its id is passed as ?job=
+    """
+    if not bulk_users.bulk_jobs_available():
+        return render_template_custom(
+            "admin/bulk-create.html", file_errors=[bulk_users.BULK_JOBS_UNAVAILABLE]
+        )
+
+    task = request.form.get("task", "")
+    if request.method == "POST" and task in ["run", "retry"]:
+        job = bulk_users.load_job(request.form.get("job", ""))
+        if job.get("action") != "create":
+            return redirect("/admin/user/not-found")
+        if task == "run":
+            bulk_users.run_batch(job)
+        else:
+            bulk_users.retry_failed_items(job)
+        return redirect("/admin/user/bulk?job={}".format(job["id"]))
+
+    if request.method == "POST":
+        upload = request.files.get("users_csv")
+        if upload is None or upload.filename == "":
+            return render_template_custom(
+                "admin/bulk-create.html", file_errors=["Choose a CSV file of users."]
+            )
+
+        rows, file_errors = bulk_users.read_users_csv(upload.read())
+        items, invalid_rows = bulk_users.validate_users(rows)
+        if file_errors or invalid_rows:
+            return render_template_custom(
+                "admin/bulk-create.html",
+                file_errors=file_errors,
+                invalid_rows=invalid_rows,
+            )
+
+        job = bulk_users.create_users(items, session["user"])
+        return redirect("/admin/user/bulk?job={}".format(job["id"]))
+
+    job = bulk_users.load_job(request.args.get("job", ""))
+    return render_template_custom(
+        "admin/bulk-create.html", job=job, counts=bulk_users.job_counts(job)
+    )
+
+
+def admin_bulk_update_users(app):
+    """
+    Render the /admin/user/bulk/update flask route
+
+    task=find records a job for the users matching the filters
+    without changing them, task=run applies the next batch of a
+    job and task=retry puts a job's failed users back in the queue.
+    """
+    if not bulk_users.bulk_jobs_available():
+        return render_template_custom(
+            "admin/bulk-update.html",
+            job={},
+            counts={},
+            errors=[bulk_users.BULK_JOBS_UNAVAILABLE],
+            available_groups=user_groups(),
+        )
+
+    args = request.values
+    task = args.get("task", "")
+    job = bulk_users.load_job(args.get("job", ""))
+    if job.get("action") not in bulk_users.BULK_UPDATE_ACTIONS:
+        job = {}
+    errors = []
+
+    if request.method == "POST" and task == "find":
+        filters = {
+            "domain": args.get("domain", "").strip().lower(),
+            "group_name": args.get("group", ""),
+            "path_prefix": args.get("path_prefix", "").strip(),
+        }
+        action = args.get("action", "")
+        group_name = args.get("new_group") if action == "regroup" else None
+
+        if not any(filters.values()):
+            errors.append("Fill in at least one filter.")
+        if action not in bulk_users.BULK_UPDATE_ACTIONS:
+            errors.append("Choose an action.")
+        elif action == "regroup" and group_name not in get_group_map():
+            errors.append("Choose the new account type.")
+
+        if not errors:
+            users = bulk_users.find_users(**filters)
+            job = bulk_users.new_update_job(
+                action, users, session["user"], filters, group_name
+            )
+            return redirect("/admin/user/bulk/update?job={}".format(job["id"]))
+
+    if request.method == "POST" and job != {}:
+        if task == "run":
+            bulk_users.run_batch(job)
+        elif task == "retry":
+            bulk_users.retry_failed_items(job)
+        return redirect("/admin/user/bulk/update?job={}".format(job["id"]))
+
+    return render_template_custom(
+        "admin/bulk-update.html",
+        job=job,
+        counts=bulk_users.job_counts(job),
+        errors=errors,
+        available_groups=user_groups(),
+    )
+
+
+def admin_bulk_report(app):
+    job = bulk_users.load_job(request.args.get("job", ""))
+    if job == {}:
+        return redirect("/admin/user/not-found")
+
+    return Response(
+        bulk_users.job_report_csv(job),
+        mimetype="text/csv",
+        headers={
+            "Content-Disposition": "attachment; filename=bulk-{}-{}.csv".format(
+                job["action"], job["id"]
+            )
+        },
+    )
+
+
+def admin_export_users(app):
+    """
+    Stream every user in the pool as a CSV or JSONL download
+
+    Rows are sent as each page of users arrives from Cognito.
+    On lambda, where responses are buffered, the export is
+    refused if it is over LAMBDA_EXPORT_MAX_BYTES.
+    """
+    export_format = request.args.get("format", "csv")
+    if export_format not in export_users.EXPORT_FORMATS:
+        export_format = "csv"
+
+    LOG.info(
+        {
+            "action": "admin.export_users",
+            "format": export_format,
+            "exported_by": session["user"],
+        }
+    )
+    if config.running_on_lambda():
+        body = export_users.bounded_export(
+            export_format, export_users.LAMBDA_EXPORT_MAX_BYTES
+        )
+        if body is None:
+            return (
+                render_template_custom(
+                    "error.html", error=export_users.EXPORT_TOO_LARGE
+                ),
+                500,
+            )
+    else:
+        body = stream_with_context(export_users.export_chunks(export_format))
+
+    return Response(
+        body,
+        mimetype=export_users.EXPORT_FORMATS[export_format],
+        headers={
+            "Content-Disposition": "attachment; filename={}".format(
+                export_users.export_filename(export_format)
+            )
+        },
+    )
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Bulk user administration.
+
+Every row of a file is validated before anything is sent to
+Cognito. The rows are then applied BULK_BATCH_SIZE at a time, one
+batch per request, by a small worker pool. The Cognito calls the
+workers make are kept within the admin API quotas by the rate
+limiter in cognito.call_api.
+
+Each bulk change is recorded as a job so its per-row results can be
+shown and downloaded as a CSV report. A batch's rows are marked
+running and the job saved before they are applied, so a run posted
+again meanwhile skips them, and the job record is saved as each row
+finishes so a job that stops part way through can be picked up
+again without repeating rows that are already done.
+
+Job records are kept in S3 under BULK_JOB_BUCKET when it is set
+so every instance of the app sees them. Otherwise they are kept
+on local disk, which only works on a single node, so bulk jobs
+are refused on lambda without a bucket.
+"""
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+
+import boto3
+from botocore.exceptions import ClientError
+
+from cognito_groups import get_group_map
+from logger import LOG
+from user import LIST_USERS_PAGE_SIZE, User
+import config
+
+BULK_CSV_COLUMNS = ["email", "name", "phone", "is_la", "group", "paths"]
+
+REPORT_COLUMNS = BULK_CSV_COLUMNS + ["status", "message"]
+
+UPDATE_REPORT_COLUMNS = ["email", "group", "status", "message"]
+
+BULK_MAX_ROWS = 500
+
+BULK_WORKERS = 4
+
+BULK_JOBS_UNAVAILABLE = (
+    "Bulk jobs can't be run here until BULK_JOB_BUCKET is set "
+    "as their records would only be kept by one instance."
+)
+
+# Rows applied per request to a bulk job
+BULK_BATCH_SIZE = 100
+
+BULK_UPDATE_ACTIONS = ["enable", "disable", "regroup"]
+
+# Rows still running after this long were left by a request
+# which stopped, as requests time out well before it
+BULK_RUNNING_TIMEOUT_SECONDS = 30 * 60
+
+IS_LA_VALUES = {
+    "1": "1",
+    "yes": "1",
+    "true": "1",
+    "0": "0",
+    "no": "0",
+    "false": "0",
+}
+
+
+def read_users_csv(content):
+    """
+    Parse an uploaded CSV of users
+
+    Returns a list of row dicts keyed by BULK_CSV_COLUMNS
+    and a list of errors with the file as a whole.
+    """
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return [], ["The file is not UTF-8 encoded text."]
+
+    reader = csv.DictReader(io.StringIO(text))
+    try:
+        header = [column.strip().lower() for column in reader.fieldnames or []]
+        missing = [column for column in BULK_CSV_COLUMNS if column not in header]
+        if missing:
+            return [], ["Missing columns: {}.".format(", ".join(missing))]
+        reader.fieldnames = header
+
+        rows = []
+        for row in reader:
+            if not any(row.values()):
+                continue
+            rows.append(
+                {column: (row[column] or "").strip() for column in BULK_CSV_COLUMNS}
+            )
+            if len(rows) > BULK_MAX_ROWS:
+                return [], [f"The file has more than {BULK_MAX_ROWS} users."]
+    except csv.Error as error:
+        return [], [f"The file is not a valid CSV: {error}"]
+
+    if not rows:
+        return [], ["The file does not contain any users."]
+    return rows, []
+
+
+def validate_user_row(row):
+    """
+    Apply the same checks as User.create to a CSV row
+
+    Returns the row with sanitised values
+    and a list of the problems found with it.
+    """
+    user = User(row["email"])
+    errors = []
+
+    if not user.email_address_is_valid():
+        errors.append("Email address is invalid.")
+
+    name = user.sanitise_name(row["name"])
+    if name == "":
+        errors.append("Name is empty.")
+
+    phone_number = user.sanitise_phone(row["phone"])
+    if phone_number == "":
+        errors.append("Phone number is empty.")
+
+    is_la = IS_LA_VALUES.get(row["is_la"].lower())
+    if is_la is None:
+        errors.append("Local authority user must be yes or no.")
+
+    group_name = row["group"].lower()
+    if group_name not in get_group_map():
+        errors.append("Account type is not recognised.")
+
+    paths = ";".join(path.strip() for path in row["paths"].split(";") if path.strip())
+    if is_la is not None and group_name in get_group_map():
+        if not user.user_paths_are_valid(is_la, paths, group_name):
+            errors.append("The granted access permissions are not valid.")
+
+    item = {
+        "email": user.email_address,
+        "name": name,
+        "phone": phone_number,
+        "is_la": is_la,
+        "group": group_name,
+        "paths": paths,
+    }
+    return item, errors
+
+
+def validate_users(rows):
+    """
+    Validate every row before anything is created
+
+    Returns the sanitised rows and a list of
+    {"line", "email", "errors"} for the invalid rows.
+    """
+    items = []
+    invalid_rows = []
+    seen_emails = set()
+
+    # Line 1 of the file is the header
+    for line, row in enumerate(rows, start=2):
+        item, errors = validate_user_row(row)
+        if item["email"] in seen_emails:
+            errors.append("Email address appears more than once.")
+        seen_emails.add(item["email"])
+
+        items.append(item)
+        if errors:
+            invalid_rows.append({"line": line, "email": row["email"], "errors": errors})
+
+    return items, invalid_rows
+
+
+def bulk_jobs_available():
+    """ Can job records be seen by every instance handling requests """
+    return bool(config.get("bulk_job_bucket")) or not config.running_on_lambda()
+
+
+def job_dir():
+    return config.get("bulk_job_dir") or os.path.join(
+        tempfile.gettempdir(), "bulk-user-jobs"
+    )
+
+
+def job_path(job_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+        return None
+    return os.path.join(job_dir(), f"{job_id}.json")
+
+
+def job_key(job_id):
+    prefix = config.get("bulk_job_prefix") or "bulk-user-jobs"
+    return f"{prefix}/{job_id}.json"
+
+
+def new_job(action, items, created_by, **fields):
+    job = {
+        "id": uuid.uuid4().hex,
+        "action": action,
+        "created_by": created_by,
+        "created_at": datetime.utcnow().isoformat(),
+        "items": [dict({"status": "pending", "message": ""}, **item) for item in items],
+    }
+    job.update(fields)
+    save_job(job)
+    return job
+
+
+def save_job(job):
+    bucket_name = config.get("bulk_job_bucket")
+    if bucket_name:
+        boto3.client("s3").put_object(
+            Bucket=bucket_name,
+            Key=job_key(job["id"]),
+            Body=json.dumps(job).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return
+
+    os.makedirs(job_dir(), exist_ok=True)
+    path = job_path(job["id"])
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as job_file:
+        json.dump(job, job_file)
+    # Readers never see a partly written job
+    os.replace(temp_path, path)
+
+
+def load_job(job_id):
+    path = job_path(job_id)
+    if path is None:
+        return {}
+    bucket_name = config.get("bulk_job_bucket")
+    if bucket_name:
+        try:
+            response = boto3.client("s3").get_object(
+                Bucket=bucket_name, Key=job_key(job_id)
+            )
+            return json.loads(response["Body"].read())
+        except (ClientError, ValueError) as error:
+            LOG.error(error)
+            return {}
+    try:
+        with open(path) as job_file:
+            return json.load(job_file)
+    except (FileNotFoundError, json.JSONDecodeError) as error:
+        LOG.error(error)
+        return {}
+
+
+def job_counts(job):
+    counts = {}
+    for item in job.get("items", []):
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    return counts
+
+
+def set_item_result(item, is_done, status="done", message="Failed to update user."):
+    item["status"] = status if is_done else "failed"
+    item["message"] = "" if is_done else message
+
+
+def create_user_item(item):
+    created = User(item["email"]).create(
+        item["name"], item["phone"], item["paths"], item["is_la"], item["group"]
+    )
+    set_item_result(item, created, "created", "Failed to create user.")
+
+
+def run_job(job, apply_item, workers=BULK_WORKERS, limit=None):
+    """
+    Apply apply_item to the pending items of job
+    on a pool of worker threads.
+
+    apply_item sets the status and message of the item
+    it is given. The items are saved as running before
+    any is applied and the job record is saved again as
+    each item finishes. Pass limit to only apply that many items.
+    """
+    save_lock = threading.Lock()
+
+    def run_item(item):
+        apply_item(item)
+        item.pop("started_at", None)
+        with save_lock:
+            save_job(job)
+
+    pending = [item for item in job["items"] if item["status"] == "pending"]
+    batch = pending[:limit]
+    started_at = datetime.utcnow().isoformat()
+    for item in batch:
+        item["status"] = "running"
+        item["started_at"] = started_at
+    if batch:
+        save_job(job)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk") as pool:
+        list(pool.map(run_item, batch))
+
+    LOG.info(
+        {
+            "action": f"bulk.{job['action']}",
+            "job": job["id"],
+            "created_by": job["created_by"],
+            "counts": job_counts(job),
+        }
+    )
+    return job
+
+
+def retry_failed_items(job):
+    """
+    Put the failed items of job back in the queue, along with
+    any left running by a request which stopped
+    """
+    stopped_before = datetime.utcnow() - timedelta(seconds=BULK_RUNNING_TIMEOUT_SECONDS)
+    for item in job["items"]:
+        stopped = (
+            item["status"] == "running"
+            and item["started_at"] < stopped_before.isoformat()
+        )
+        if item["status"] == "failed" or stopped:
+            item["status"] = "pending"
+            item["message"] = ""
+            item.pop("started_at", None)
+    save_job(job)
+    return job
+
+
+def create_users(items, created_by, limit=BULK_BATCH_SIZE):
+    """Record a bulk create job and apply its first batch"""
+    job = new_job("create", items, created_by)
+    return run_job(job, create_user_item, limit=limit)
+
+
+def user_matches(user, domain="", group_name="", path_prefix=""):
+    email = user.get("email", "")
+    if domain and not (email.endswith(f"@{domain}") or email.endswith(f".{domain}")):
+        return False
+    if group_name and user.get("group", {}).get("value") != group_name:
+        return False
+    if path_prefix:
+        paths = user.get("custom:paths", "").split(";")
+        if not any(path.startswith(path_prefix) for path in paths):
+            return False
+    return True
+
+
+def find_users(domain="", group_name="", path_prefix=""):
+    """
+    Return every user in the pool matching all the given filters
+
+    domain matches the email domain and its subdomains,
+    group_name the user's group and path_prefix
+    the start of any of the user's granted paths.
+    """
+    return [
+        user
+        for user in User.iter_users(limit=LIST_USERS_PAGE_SIZE)
+        if user_matches(user, domain, group_name, path_prefix)
+    ]
+
+
+def enable_user_item(item):
+    set_item_result(item, User(item["email"]).enable())
+
+
+def disable_user_item(item):
+    set_item_result(item, User(item["email"]).disable())
+
+
+def regroup_user_item(group_name, item):
+    user = User(item["email"])
+    if user.get_details() == {}:
+        set_item_result(item, False, message="User not found.")
+    else:
+        set_item_result(item, user.set_group(group_name))
+
+
+def new_update_job(action, users, created_by, filters, group_name=None):
+    """
+    Record a bulk update of users without applying it
+
+    The acting administrator is skipped so they can't
+    disable or regroup their own account.
+    """
+    items = []
+    for user in users:
+        item = {"email": user["email"], "group": user["group"]["value"]}
+        if user["email"] == created_by:
+            item["status"] = "skipped"
+            item["message"] = "You can't change your own account."
+        items.append(item)
+    return new_job(action, items, created_by, filters=filters, target_group=group_name)
+
+
+def run_batch(job, limit=BULK_BATCH_SIZE):
+    """Apply the next limit pending items of a bulk job"""
+    if job["action"] == "create":
+        apply_item = create_user_item
+    elif job["action"] == "enable":
+        apply_item = enable_user_item
+    elif job["action"] == "disable":
+        apply_item = disable_user_item
+    elif job["action"] == "regroup":
+        apply_item = partial(regroup_user_item, job["target_group"])
+    else:
+        raise ValueError(f"ERR: {job['action']}: is not a bulk job action")
+    return run_job(job, apply_item, limit=limit)
+
+
+def job_report_csv(job):
+    report = io.StringIO()
+    columns = REPORT_COLUMNS if job.get("action") == "create" else UPDATE_REPORT_COLUMNS
+    writer = csv.DictWriter(report, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(job.get("items", []))
+    return report.getvalue()
@@ -6,10 +6,26 @@ can do to any user account.
 
 API operations prefixed with admin_ are operations administrators
 perform on behalf of other users.
+
+Every call to the API goes through call_api which waits for a
+token from the rate limiter for the operation's quota category
+and retries throttled calls with jittered exponential backoff.
+
+Calls to the Cognito hosted domain, like the OAuth token
+endpoint, go through hosted_domain_request which reuses
+pooled keep-alive connections.
 """
 
+import random
+import threading
+import time
+
 import boto3
+import requests
+from botocore.config import Config
 from botocore.exceptions import ClientError, ParamValidationError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from cognito_groups import get_group_map
 from logger import LOG
@@ -17,15 +33,213 @@ import config
 
 CLIENT_EXCEPTIONS = (ClientError, ParamValidationError)
 
+# Requests per second allowed for each category of
+# operation by the Amazon Cognito user pool quotas
+API_CATEGORY_QUOTAS = {
+    "UserCreation": 50,
+    "UserRead": 120,
+    "UserResourceRead": 50,
+    "UserList": 30,
+    "UserUpdate": 25,
+}
+
+API_OPERATION_CATEGORIES = {
+    "admin_create_user": "UserCreation",
+    "admin_get_user": "UserRead",
+    "admin_list_groups_for_user": "UserResourceRead",
+    "list_users": "UserList",
+    "list_users_in_group": "UserList",
+    "admin_update_user_attributes": "UserUpdate",
+    "admin_delete_user": "UserUpdate",
+    "admin_disable_user": "UserUpdate",
+    "admin_enable_user": "UserUpdate",
+    "admin_set_user_settings": "UserUpdate",
+    "admin_set_user_mfa_preference": "UserUpdate",
+    "admin_add_user_to_group": "UserUpdate",
+    "admin_remove_user_from_group": "UserUpdate",
+}
+
+THROTTLING_ERROR_CODES = ["TooManyRequestsException", "ThrottlingException"]
+
+MAX_ATTEMPTS = 6
+
+BACKOFF_BASE_SECONDS = 0.1
+
+BACKOFF_MAX_SECONDS = 5
+
+# Creating clients from the default boto3 session isn't thread safe
+CLIENT_LOCK = threading.Lock()
+
+# Connections kept open to the hosted domain per process
+HOSTED_DOMAIN_POOL_SIZE = 10
+
+# Failed connections are retried for any method but read errors
+# and 5xx responses only for methods that are safe to repeat.
+# An authorization code can only be exchanged once so a token
+# request is never sent twice.
+HOSTED_DOMAIN_RETRIES = 2
+
+HOSTED_DOMAIN_RETRY_STATUSES = [500, 502, 503, 504]
+
+HOSTED_DOMAIN_SESSION = None
+
+HOSTED_DOMAIN_SESSION_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket refilled at rate tokens a second.
+
+    The rate is halved each time the API reports throttling
+    and climbs back towards max_rate as calls succeed so the
+    bucket settles close to the quota actually available.
+    """
+
+    def __init__(self, max_rate, min_rate=1):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self._tokens = max_rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.max_rate, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # A negative balance reserves a token for this caller
+            # so later callers queue behind it
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+RATE_LIMITERS = {
+    category: TokenBucket(quota) for category, quota in API_CATEGORY_QUOTAS.items()
+}
+
+
+def reset_rate_limiters():
+    for category, quota in API_CATEGORY_QUOTAS.items():
+        RATE_LIMITERS[category] = TokenBucket(quota)
+
+
+def is_throttling_error(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    )
+
+
+def backoff_seconds(attempt):
+    """Full jitter exponential backoff for a retry attempt"""
+    return random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    )
+
+
+def call_api(client, operation_name, **arguments):
+    """
+    Call a Cognito API operation within its category's
+    rate limit, retrying if the call is throttled.
+
+    Errors other than throttling, and throttling that
+    outlasts MAX_ATTEMPTS, are raised to the caller.
+    """
+    limiter = RATE_LIMITERS[API_OPERATION_CATEGORIES[operation_name]]
+    operation = getattr(client, operation_name)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = operation(**arguments)
+        except ClientError as error:
+            attempt += 1
+            if not is_throttling_error(error) or attempt == MAX_ATTEMPTS:
+                raise
+            limiter.throttled()
+            LOG.warning(
+                {
+                    "action": "cognito.call_api",
+                    "operation": operation_name,
+                    "attempt": attempt,
+                    "message": "Throttled",
+                }
+            )
+            time.sleep(backoff_seconds(attempt))
+        else:
+            limiter.succeeded()
+            return response
+
 
 def get_boto3_client():
-    return boto3.client("cognito-idp", region_name=config.get("region"))
+    # Retries are handled by call_api
+    with CLIENT_LOCK:
+        return boto3.client(
+            "cognito-idp",
+            region_name=config.get("region"),
+            config=Config(retries={"total_max_attempts": 1}),
+        )
+
+
+def get_hosted_domain_session():
+    """Return the process wide session for requests to Cognito endpoints"""
+    global HOSTED_DOMAIN_SESSION
+    with HOSTED_DOMAIN_SESSION_LOCK:
+        if HOSTED_DOMAIN_SESSION is None:
+            retries = Retry(
+                total=HOSTED_DOMAIN_RETRIES,
+                backoff_factor=BACKOFF_BASE_SECONDS,
+                status_forcelist=HOSTED_DOMAIN_RETRY_STATUSES,
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                raise_on_status=False,
+            )
+            # One pool for the hosted domain and one for the JWKS host
+            adapter = HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=HOSTED_DOMAIN_POOL_SIZE,
+                max_retries=retries,
+            )
+            hosted_domain_session = requests.Session()
+            hosted_domain_session.mount("https://", adapter)
+            HOSTED_DOMAIN_SESSION = hosted_domain_session
+        return HOSTED_DOMAIN_SESSION
+
+
+def hosted_domain_request(method, path, **kwargs):
+    """
+    Send a request to the Cognito hosted domain
+
+    Requests time out after the configured
+    cognito_connect_timeout and cognito_read_timeout.
+    """
+    url = "https://{}{}".format(config.get("cognito_domain"), path)
+    kwargs.setdefault(
+        "timeout",
+        (config.get("cognito_connect_timeout"), config.get("cognito_read_timeout")),
+    )
+    return get_hosted_domain_session().request(method, url, **kwargs)
 
 
 def create_user(name, email_address, phone_number, is_la, custom_paths):
     client = get_boto3_client()
     try:
-        response = client.admin_create_user(
+        response = call_api(
+            client,
+            "admin_create_user",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email_address,
             UserAttributes=[
@@ -49,7 +263,9 @@ def create_user(name, email_address, phone_number, is_la, custom_paths):
 def update_user(email, attributes):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_update_user_attributes(
+        response = call_api(
+            cognito_client,
+            "admin_update_user_attributes",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email,
             UserAttributes=attributes,
@@ -63,8 +279,11 @@ def update_user(email, attributes):
 def delete_user(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_delete_user(
-            UserPoolId=config.get("cognito_pool_id"), Username=email
+        response = call_api(
+            cognito_client,
+            "admin_delete_user",
+            UserPoolId=config.get("cognito_pool_id"),
+            Username=email,
         )
     except CLIENT_EXCEPTIONS as error:
         LOG.error(error)
@@ -75,8 +294,11 @@ def delete_user(email):
 def disable_user(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_disable_user(
-            UserPoolId=config.get("cognito_pool_id"), Username=email
+        response = call_api(
+            cognito_client,
+            "admin_disable_user",
+            UserPoolId=config.get("cognito_pool_id"),
+            Username=email,
         )
     except CLIENT_EXCEPTIONS as error:
         LOG.error(error)
@@ -87,8 +309,11 @@ def disable_user(email):
 def enable_user(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_enable_user(
-            UserPoolId=config.get("cognito_pool_id"), Username=email
+        response = call_api(
+            cognito_client,
+            "admin_enable_user",
+            UserPoolId=config.get("cognito_pool_id"),
+            Username=email,
         )
     except CLIENT_EXCEPTIONS as error:
         LOG.error(error)
@@ -99,7 +324,9 @@ def enable_user(email):
 def set_user_settings(email):
     client = get_boto3_client()
     try:
-        response = client.admin_set_user_settings(
+        response = call_api(
+            client,
+            "admin_set_user_settings",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email,
             MFAOptions=[{"DeliveryMedium": "SMS", "AttributeName": "phone_number"}],
@@ -113,7 +340,9 @@ def set_user_settings(email):
 def set_mfa_preferences(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_set_user_mfa_preference(
+        response = call_api(
+            cognito_client,
+            "admin_set_user_mfa_preference",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email,
             SMSMfaSettings={"Enabled": True, "PreferredMfa": True},
@@ -132,7 +361,9 @@ def add_to_group(email, group_name):
 
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_add_user_to_group(
+        response = call_api(
+            cognito_client,
+            "admin_add_user_to_group",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email,
             GroupName=group_name,
@@ -146,7 +377,9 @@ def add_to_group(email, group_name):
 def remove_from_group(email, group_name):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_remove_user_from_group(
+        response = call_api(
+            cognito_client,
+            "admin_remove_user_from_group",
             UserPoolId=config.get("cognito_pool_id"),
             Username=email,
             GroupName=group_name,
@@ -160,8 +393,11 @@ def remove_from_group(email, group_name):
 def get_user(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_get_user(
-            UserPoolId=config.get("cognito_pool_id"), Username=email
+        response = call_api(
+            cognito_client,
+            "admin_get_user",
+            UserPoolId=config.get("cognito_pool_id"),
+            Username=email,
         )
     except CLIENT_EXCEPTIONS as error:
         LOG.error(error)
@@ -172,8 +408,11 @@ def get_user(email):
 def list_groups_for_user(email):
     cognito_client = get_boto3_client()
     try:
-        response = cognito_client.admin_list_groups_for_user(
-            UserPoolId=config.get("cognito_pool_id"), Username=email
+        response = call_api(
+            cognito_client,
+            "admin_list_groups_for_user",
+            UserPoolId=config.get("cognito_pool_id"),
+            Username=email,
         )
     except CLIENT_EXCEPTIONS as error:
         LOG.error(error)
@@ -181,6 +420,19 @@ def list_groups_for_user(email):
     return response
 
 
+def list_users_in_group(group_name, token=""):
+    cognito_client = get_boto3_client()
+    arguments = {"UserPoolId": config.get("cognito_pool_id"), "GroupName": group_name}
+    if token != "":
+        arguments["NextToken"] = token
+    try:
+        response = call_api(cognito_client, "list_users_in_group", **arguments)
+    except CLIENT_EXCEPTIONS as error:
+        LOG.error(error)
+        response = {}
+    return response
+
+
 def check_response_status_code(response):
     is_200 = False
     if "ResponseMetadata" in response:
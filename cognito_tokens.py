@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Local verification of the id_token returned by the
+Cognito token endpoint.
+
+Cognito signs id tokens with RS256 using one of the keys
+published in the user pool's JWKS. The keys are fetched once
+and cached by their kid. The JWKS is only fetched again when
+a token names a kid that isn't in the cache, which is how a
+key rotation shows up, and no more than once every
+JWKS_MIN_REFRESH_SECONDS.
+
+Signatures are checked with the pure python rsa package
+so the lambda bundle doesn't need a compiled crypto dependency.
+"""
+import base64
+import json
+import threading
+import time
+
+import requests
+import rsa
+
+from cognito import get_hosted_domain_session
+from logger import LOG
+import config
+
+# Allowed clock skew between this server and Cognito
+CLOCK_SKEW_SECONDS = 60
+
+JWKS_MIN_REFRESH_SECONDS = 60
+
+JWKS_CACHE = {"keys": {}, "fetched_at": None}
+
+JWKS_LOCK = threading.Lock()
+
+
+def clear_jwks_cache():
+    with JWKS_LOCK:
+        JWKS_CACHE["keys"] = {}
+        JWKS_CACHE["fetched_at"] = None
+
+
+def b64url_decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def b64url_int(segment):
+    return int.from_bytes(b64url_decode(segment), "big")
+
+
+def issuer():
+    return "https://cognito-idp.{}.amazonaws.com/{}".format(
+        config.get("region"), config.get("cognito_pool_id")
+    )
+
+
+def fetch_jwks():
+    """ Return the pool's RSA signing keys as {kid: rsa.PublicKey} """
+    response = get_hosted_domain_session().get(
+        f"{issuer()}/.well-known/jwks.json",
+        timeout=(
+            config.get("cognito_connect_timeout"),
+            config.get("cognito_read_timeout"),
+        ),
+    )
+    response.raise_for_status()
+    return {
+        key["kid"]: rsa.PublicKey(b64url_int(key["n"]), b64url_int(key["e"]))
+        for key in response.json().get("keys", [])
+        if key.get("kty") == "RSA"
+    }
+
+
+def get_signing_key(kid):
+    with JWKS_LOCK:
+        if kid not in JWKS_CACHE["keys"]:
+            fetched_at = JWKS_CACHE["fetched_at"]
+            now = time.time()
+            if fetched_at is None or now - fetched_at > JWKS_MIN_REFRESH_SECONDS:
+                JWKS_CACHE["fetched_at"] = now
+                try:
+                    JWKS_CACHE["keys"] = fetch_jwks()
+                except (requests.RequestException, ValueError, KeyError) as error:
+                    LOG.error({"action": "cognito_tokens.jwks", "error": str(error)})
+        return JWKS_CACHE["keys"].get(kid)
+
+
+def rsa_sha256_signature_is_valid(message, signature, key):
+    """ Check an RSASSA-PKCS1-v1_5 SHA-256 signature """
+    try:
+        # rsa.verify accepts any hash it knows, RS256 is only SHA-256
+        return rsa.verify(message, signature, key) == "SHA-256"
+    except rsa.VerificationError:
+        return False
+
+
+def claims_are_valid(claims, now):
+    expires = claims.get("exp")
+    issued = claims.get("iat")
+    return (
+        claims.get("iss") == issuer()
+        and claims.get("aud") == config.get("client_id")
+        and claims.get("token_use") == "id"
+        and isinstance(expires, (int, float))
+        and isinstance(issued, (int, float))
+        and expires + CLOCK_SKEW_SECONDS > now
+        and issued - CLOCK_SKEW_SECONDS < now
+    )
+
+
+def verify_id_token(token, now=None):
+    """
+    Return the claims of a Cognito id token
+
+    An empty dict is returned if the signature, issuer,
+    audience, token use or expiry don't check out.
+    """
+    now = time.time() if now is None else now
+    try:
+        header_segment, claims_segment, signature_segment = token.split(".")
+        header = json.loads(b64url_decode(header_segment))
+        claims = json.loads(b64url_decode(claims_segment))
+        signature = b64url_decode(signature_segment)
+    except (AttributeError, ValueError) as error:
+        LOG.error({"action": "cognito_tokens.verify", "error": str(error)})
+        return {}
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        LOG.error({"action": "cognito_tokens.verify", "error": "Malformed token"})
+        return {}
+
+    if header.get("alg") != "RS256":
+        LOG.error({"action": "cognito_tokens.verify", "error": "Unexpected algorithm"})
+        return {}
+
+    key = get_signing_key(header.get("kid"))
+    message = f"{header_segment}.{claims_segment}".encode("ascii")
+    if key is None or not rsa_sha256_signature_is_valid(message, signature, key):
+        LOG.error({"action": "cognito_tokens.verify", "error": "Invalid signature"})
+        return {}
+
+    if not claims_are_valid(claims, now):
+        LOG.error({"action": "cognito_tokens.verify", "error": "Invalid claims"})
+        return {}
+    return claims
+
+
+def claim_attributes(claims):
+    """
+    Return the user attributes in an id token in the
+    [{"Name", "Value"}] shape cognito get_user returns
+    """
+    attributes = []
+    for name, value in claims.items():
+        if name in ("sub", "name", "email", "phone_number") or name.startswith(
+            "custom:"
+        ):
+            attributes.append({"Name": name, "Value": value})
+        elif name in ("email_verified", "phone_number_verified"):
+            is_verified = "true" if value in (True, "true") else "false"
+            attributes.append({"Name": name, "Value": is_verified})
+    return attributes
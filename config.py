@@ -1,5 +1,6 @@
-import json
 import os
+import sys
+import tempfile
 
 import boto3
 import sentry_sdk
@@ -9,6 +10,11 @@ from flask_talisman import Talisman
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from logger import LOG
+from server_session import (
+    FilesystemSessionStore,
+    ServerSideSessionInterface,
+    SQLiteSessionStore,
+)
 
 CONFIG = {}
 
@@ -47,12 +53,45 @@ def setup_sentry(app):
             app.logger.info(f'sentry integration failed with excption {e}')
 
 
-def load_environment(app):
+def setup_session_store(app):
+    """
+    Keep sessions server side when SESSION_STORE is
+    filesystem or sqlite rather than in the cookie
+    """
+    # Settings are loaded again on each lambda invocation
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        return app.session_interface
+
+    store_type = get("session_store", "cookie")
+    store_path = get("session_store_path")
+    if store_type == "filesystem":
+        store = FilesystemSessionStore(
+            store_path or os.path.join(tempfile.gettempdir(), "sessions")
+        )
+    elif store_type == "sqlite":
+        store = SQLiteSessionStore(
+            store_path or os.path.join(tempfile.gettempdir(), "sessions.sqlite3")
+        )
+    else:
+        return None
+
+    app.logger.info(f"loading {store_type} session store")
+    app.session_interface = ServerSideSessionInterface(
+        store, get("session_lifetime_seconds")
+    )
+    return app.session_interface
+
+
+def load_environment(app=None):
     """
     Load environment vars into flask app attributes
+
+    Without an app, for handlers which don't run one,
+    they are only loaded into CONFIG.
     """
     global CONFIG
-    CONFIG = app.config
+    if app is not None:
+        CONFIG = app.config
     read_env_variables(app)
 
 
@@ -61,11 +100,13 @@ def load_settings(app):
     load_cognito_settings()
     setup_talisman(app)
     setup_sentry(app)
+    setup_session_store(app)
     return ssm_loaded
 
 
-def read_env_variables(app):
-    app.secret_key = os.getenv("APPSECRET", "secret")
+def read_env_variables(app=None):
+    if app is not None:
+        app.secret_key = os.getenv("APPSECRET", "secret")
     set("page_title", os.getenv("PAGE_TITLE", "Data Transfer"))
     set("app_environment", os.getenv("APP_ENVIRONMENT", "testing"))
     set("admin", os.getenv("ADMIN", "false"))
@@ -78,6 +119,22 @@ def read_env_variables(app):
     set("bucket_upload_prefix", os.getenv("BUCKET_UPLOAD_PREFIX", "web-app-upload"))
     set("region", os.getenv("REGION", "eu-west-2"))
     set("sentry_dsn", os.getenv("SENTRY_DSN"))
+    set("bulk_job_dir", os.getenv("BULK_JOB_DIR"))
+    set("bulk_job_bucket", os.getenv("BULK_JOB_BUCKET"))
+    set("bulk_job_prefix", os.getenv("BULK_JOB_PREFIX", "bulk-user-jobs"))
+    set("zip_archive_prefix", os.getenv("ZIP_ARCHIVE_PREFIX", "web-app-archives"))
+    set(
+        "checksum_index_prefix",
+        os.getenv("CHECKSUM_INDEX_PREFIX", "web-app-upload-checksums"),
+    )
+    set("delta_key_columns", os.getenv("DELTA_KEY_COLUMNS", ""))
+    set("user_directory_path", os.getenv("USER_DIRECTORY_PATH"))
+    set("user_list_prefetch", os.getenv("USER_LIST_PREFETCH", "false"))
+    set("cognito_connect_timeout", float(os.getenv("COGNITO_CONNECT_TIMEOUT", "3.05")))
+    set("cognito_read_timeout", float(os.getenv("COGNITO_READ_TIMEOUT", "10")))
+    set("session_store", os.getenv("SESSION_STORE", "cookie"))
+    set("session_store_path", os.getenv("SESSION_STORE_PATH"))
+    set("session_lifetime_seconds", int(os.getenv("SESSION_LIFETIME_SECONDS", "43200")))
 
     # temporary references to existing env vars
     set("cf_space", get("app_environment"))
@@ -107,6 +164,22 @@ def setup_local_environment(
     os.environ["REGION"] = region
 
 
+def setup_command_line(environment):
+    """
+    Load the admin settings for environment into the app
+    for a command line tool, returning whether they loaded
+    """
+    # Imported here as main imports the command line modules through admin
+    from main import app
+
+    setup_local_environment(is_admin=True, environment=environment)
+    load_environment(app)
+    if not load_ssm_parameters(app):
+        print("Could not load the SSM parameters for the environment", file=sys.stderr)
+        return False
+    return True
+
+
 def load_ssm_parameters(app):
     ssm_parameters_retrieved = True
     ssm_prefix = "/transfer-coronavirus-data-service"
@@ -195,14 +268,12 @@ def list_pools():
     return pool_list
 
 
-def load_s3_paths():
-    try:
-        with open("s3paths.json", "r") as s3paths_file:
-            s3paths = json.load(s3paths_file)
-    except (FileNotFoundError, json.JSONDecodeError) as error:
-        LOG.error(error)
-        s3paths = []
-    return s3paths
+def running_on_lambda():
+    """
+    Lambda responses go through serverless_wsgi, which buffers
+    the whole body, and requests can reach any instance
+    """
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
 
 
 def get(setting_name, default=None):
@@ -2,13 +2,67 @@
 This isn't used yet but there has to be a conftest file for
 the test module includes to resolve successfully
 """
+from concurrent.futures import Future
 from datetime import datetime
+import time
 
 import pytest
 
+from cognito import reset_rate_limiters
+from cognito_tokens import clear_jwks_cache
 from config import load_environment
+import config
 from main import app
-from user import User
+from user import USER_DETAILS_CACHE, User, clear_group_map_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_user_caches():
+    # Stubbed cognito responses differ between tests
+    USER_DETAILS_CACHE.clear()
+    clear_group_map_cache()
+    reset_rate_limiters()
+    clear_jwks_cache()
+
+
+class SerialExecutor:
+    """Run submitted calls straight away in the calling thread"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+@pytest.fixture()
+def serial_executor():
+    return SerialExecutor()
+
+
+@pytest.fixture(autouse=True)
+def serial_post_create_steps(monkeypatch):
+    # botocore Stubber responses must be requested in order
+    monkeypatch.setattr("user.POST_CREATE_EXECUTOR", SerialExecutor())
+
+
+@pytest.fixture()
+def bulk_job_dir(tmp_path):
+    config.set("bulk_job_dir", str(tmp_path))
+    yield tmp_path
+    config.delete("bulk_job_dir")
+
+
+# Users changed in any test are written to a mirror here
+# rather than a shared one in the temp directory
+@pytest.fixture(autouse=True)
+def user_directory_path(tmp_path):
+    path = str(tmp_path / "user-directory.sqlite3")
+    config.set("user_directory_path", path)
+    yield path
+    config.delete("user_directory_path")
 
 
 def get_standard_download_group():
@@ -85,6 +139,29 @@ def get_test_jwt():
     return {"cognito:username": "test-user", "email": "test-user@test-domain.com"}
 
 
+@pytest.fixture()
+def id_token_claims():
+    now = int(time.time())
+    return {
+        "sub": "a_uuid",
+        "aud": "123456",
+        "iss": "https://cognito-idp.eu-west-1.amazonaws.com/eu-west-2_poolid",
+        "token_use": "id",
+        "auth_time": now,
+        "iat": now,
+        "exp": now + 3600,
+        "cognito:username": "test-secrets",
+        "cognito:groups": ["standard-upload"],
+        "email": "test-user@test-domain.com",
+        "email_verified": True,
+        "name": "Test User",
+        "phone_number": "+447123456789",
+        "phone_number_verified": True,
+        "custom:paths": "local_authority/barnet",
+        "custom:is_la": "1",
+    }
+
+
 @pytest.fixture()
 def fake_jwt_decoder():
     def decoder(
@@ -299,13 +376,19 @@ def list_users_arguments():
             "custom:is_la",
         ],
         "Limit": 20,
+        "UserPoolId": "eu-west-2_poolid",
     }
 
 
 @pytest.fixture()
 def list_users_response(admin_get_user):
+    # list_users returns Attributes where admin_get_user returns UserAttributes
+    list_user = dict(admin_get_user)
+    list_user["Attributes"] = list_user.pop("UserAttributes")
+    admin_list_user = dict(list_user)
+    admin_list_user["Username"] = "admin.user@communities.gov.uk"
     return {
-        "Users": [admin_get_user],
+        "Users": [list_user, admin_list_user],
     }
 
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Day-over-day deltas between consecutive daily CSV files.
+
+When a new daily file lands in a local authority folder it is
+compared with the previous day's file of the same category
+and the added, removed and changed rows are written next to it
+so consumers don't have to download the whole file every day.
+
+Rows are matched on their key columns, the first column unless
+DELTA_KEY_COLUMNS names others. A key can be on several rows, so
+rows found in both files are matched first and the rest of the
+rows with a key are paired up as changed, leaving any extra rows
+added or removed.
+
+Inputs are split by key hash into partition files on local disk.
+Each partition is indexed by digests of its rows and keys, and read
+again to write out the rows, so only one partition's digests are
+held in memory at a time.
+"""
+import codecs
+import csv
+import hashlib
+import math
+import os
+import tempfile
+import zlib
+from collections import Counter
+from contextlib import ExitStack
+
+import boto3
+
+from file_categories import categorise_file
+from logger import LOG
+import config
+
+DELTA_CHANGES = ["added", "removed", "changed"]
+
+DEFAULT_KEY_COLUMNS = (0,)
+
+# Size of the previous file indexed in memory in one go, the
+# digest index of a partition takes about its size again
+DELTA_PARTITION_BYTES = 8 * 1024 * 1024
+
+
+def delta_file_key(key, change):
+    return "{}-delta-{}.csv".format(key[: -len(".csv")], change)
+
+
+def is_delta_file(key):
+    return any(key.endswith(f"-delta-{change}.csv") for change in DELTA_CHANGES)
+
+
+def is_daily_file(key):
+    return key.endswith(".csv") and not is_delta_file(key)
+
+
+def file_category(key, folder):
+    return categorise_file({"Key": key}, folder)["Category"]
+
+
+def find_previous_file(s3_client, bucket_name, key):
+    """
+    Return the key of the most recent file of the same category
+    in the same folder uploaded on an earlier day than key
+    """
+    folder = key.rsplit("/", 1)[0] + "/"
+    category = file_category(key, folder)
+    new_modified = s3_client.head_object(Bucket=bucket_name, Key=key)["LastModified"]
+
+    previous = None
+    paginator = s3_client.get_paginator("list_objects")
+    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=folder, Delimiter="/")
+    for page in page_iterator:
+        for file_item in page.get("Contents", []):
+            candidate = file_item["Key"]
+            if candidate == key or not is_daily_file(candidate):
+                continue
+            if file_item["LastModified"].date() >= new_modified.date():
+                continue
+            if file_category(candidate, folder) != category:
+                continue
+            if previous is None or file_item["LastModified"] > previous["LastModified"]:
+                previous = file_item
+
+    return previous["Key"] if previous else None
+
+
+def key_columns_for(header):
+    """
+    Return the indexes of the DELTA_KEY_COLUMNS in header
+    or None if any of them isn't in it
+    """
+    names = [name.strip() for name in config.get("delta_key_columns", "").split(",")]
+    names = [name for name in names if name]
+    if not names:
+        return DEFAULT_KEY_COLUMNS
+    if not set(names) <= set(header):
+        return None
+    return tuple(header.index(name) for name in names)
+
+
+def row_key(row, key_columns=DEFAULT_KEY_COLUMNS):
+    return tuple(row[column] if column < len(row) else "" for column in key_columns)
+
+
+def row_partition(row, partitions, key_columns=DEFAULT_KEY_COLUMNS):
+    key = "\x1f".join(row_key(row, key_columns))
+    return zlib.crc32(key.encode("utf-8")) % partitions
+
+
+def digest(values):
+    joined = "\x1f".join(values).encode("utf-8")
+    return hashlib.blake2b(joined, digest_size=16).digest()
+
+
+class SpilledRows:
+    """ The rows of a partition file, read again on each iteration """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, newline="") as partition_file:
+            yield from csv.reader(partition_file)
+
+
+def spill_partitions(rows, partitions, workdir, name, key_columns):
+    """
+    Split rows by key hash into one CSV file per partition
+    """
+    paths = [os.path.join(workdir, f"{name}-{i}.csv") for i in range(partitions)]
+    with ExitStack() as stack:
+        writers = [
+            csv.writer(stack.enter_context(open(path, "w", newline="")))
+            for path in paths
+        ]
+        for row in rows:
+            if row:
+                writers[row_partition(row, partitions, key_columns)].writerow(row)
+    return paths
+
+
+def diff_partition(previous_rows, new_rows, key_columns=DEFAULT_KEY_COLUMNS):
+    """
+    Yield the changes between two re-iterable sequences of rows.
+
+    Only digests of the rows and keys are indexed: the new rows are
+    read twice, to match them and then to write them out, and the
+    previous rows are read again to write out the removed ones.
+    """
+    # How often each previous row occurs, and how many of each
+    # previous and new key are left once identical rows are matched
+    previous_counts = Counter()
+    previous_left = Counter()
+    for row in previous_rows:
+        if row:
+            previous_counts[digest(row)] += 1
+            previous_left[digest(row_key(row, key_columns))] += 1
+
+    matched = Counter()
+    new_left = Counter()
+    for row in new_rows:
+        if not row:
+            continue
+        row_digest = digest(row)
+        key_digest = digest(row_key(row, key_columns))
+        if matched[row_digest] < previous_counts[row_digest]:
+            matched[row_digest] += 1
+            previous_left[key_digest] -= 1
+        else:
+            new_left[key_digest] += 1
+
+    # The unmatched rows with a key are paired up as changed
+    paired = Counter(
+        {
+            key_digest: min(count, previous_left[key_digest])
+            for key_digest, count in new_left.items()
+        }
+    )
+
+    new_matched = Counter()
+    new_paired = Counter()
+    for row in new_rows:
+        if not row:
+            continue
+        row_digest = digest(row)
+        key_digest = digest(row_key(row, key_columns))
+        if new_matched[row_digest] < matched[row_digest]:
+            new_matched[row_digest] += 1
+        elif new_paired[key_digest] < paired[key_digest]:
+            new_paired[key_digest] += 1
+            yield "changed", row
+        else:
+            yield "added", row
+
+    for row in previous_rows:
+        if not row:
+            continue
+        row_digest = digest(row)
+        key_digest = digest(row_key(row, key_columns))
+        if matched[row_digest] > 0:
+            matched[row_digest] -= 1
+        elif paired[key_digest] > 0:
+            paired[key_digest] -= 1
+        else:
+            yield "removed", row
+
+
+def diff_rows(
+    previous_rows,
+    new_rows,
+    partitions=1,
+    workdir=None,
+    key_columns=DEFAULT_KEY_COLUMNS,
+):
+    """
+    Yield (change, row) for every row added, removed or
+    changed between previous_rows and new_rows.
+
+    Without a workdir the rows are held in memory.
+    """
+    if workdir is None:
+        yield from diff_partition(list(previous_rows), list(new_rows), key_columns)
+        return
+
+    previous_paths = spill_partitions(
+        previous_rows, partitions, workdir, "previous", key_columns
+    )
+    new_paths = spill_partitions(new_rows, partitions, workdir, "new", key_columns)
+    for previous_path, new_path in zip(previous_paths, new_paths):
+        yield from diff_partition(
+            SpilledRows(previous_path), SpilledRows(new_path), key_columns
+        )
+
+
+def csv_rows(body):
+    return csv.reader(codecs.getreader("utf-8-sig")(body))
+
+
+def write_daily_delta(bucket_name, key):
+    """
+    Write the delta files for a newly arrived daily file.
+
+    Returns a dict of row counts per change
+    or an empty dict if no delta was written.
+    """
+    s3_client = boto3.client("s3")
+
+    previous_key = find_previous_file(s3_client, bucket_name, key)
+    if previous_key is None:
+        LOG.info({"action": "delta", "key": key, "message": "No previous file"})
+        return {}
+
+    previous_object = s3_client.get_object(Bucket=bucket_name, Key=previous_key)
+    new_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+    previous_rows = csv_rows(previous_object["Body"])
+    new_rows = csv_rows(new_object["Body"])
+
+    header = next(new_rows, [])
+    if next(previous_rows, []) != header:
+        LOG.error({"action": "delta", "key": key, "message": "Headers do not match"})
+        return {}
+
+    key_columns = key_columns_for(header)
+    if key_columns is None:
+        LOG.error({"action": "delta", "key": key, "message": "Key columns not found"})
+        return {}
+
+    partitions = max(
+        1, math.ceil(previous_object["ContentLength"] / DELTA_PARTITION_BYTES)
+    )
+    counts = dict.fromkeys(DELTA_CHANGES, 0)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        delta_paths = {
+            change: os.path.join(workdir, f"delta-{change}.csv")
+            for change in DELTA_CHANGES
+        }
+        with ExitStack() as stack:
+            writers = {
+                change: csv.writer(stack.enter_context(open(path, "w", newline="")))
+                for change, path in delta_paths.items()
+            }
+            for writer in writers.values():
+                writer.writerow(header)
+            changes = diff_rows(
+                previous_rows, new_rows, partitions, workdir, key_columns
+            )
+            for change, row in changes:
+                writers[change].writerow(row)
+                counts[change] += 1
+
+        for change, path in delta_paths.items():
+            s3_client.upload_file(path, bucket_name, delta_file_key(key, change))
+
+    LOG.info(
+        {
+            "action": "delta",
+            "key": key,
+            "previous": previous_key,
+            "counts": counts,
+        }
+    )
+    return counts
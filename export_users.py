@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Streamed export of every user in the pool for audits.
+
+Rows are written out a page of list_users at a time so an
+export only ever holds one page of users in memory however
+big the pool is. Groups are resolved from User.group_map,
+one sweep of the group membership lists, rather than a
+lookup per user.
+
+Run as a script to write an export to a file or stdout:
+
+    python export_users.py --format jsonl --output users.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+
+from user import LIST_USERS_PAGE_SIZE, User
+import config
+
+EXPORT_COLUMNS = [
+    "username",
+    "email",
+    "name",
+    "group",
+    "paths",
+    "is_la",
+    "status",
+    "enabled",
+    "phone_number",
+    "phone_number_verified",
+    "mfa",
+    "created",
+    "last_modified",
+]
+
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+# Lambda responses are buffered and base64 encoded for the ALB,
+# which limits them to 1MB, so exports there are capped below that
+LAMBDA_EXPORT_MAX_BYTES = 700 * 1024
+
+EXPORT_TOO_LARGE = (
+    "The export is too large to download here. "
+    "Run python export_users.py to export every user."
+)
+
+
+def timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def mfa_state(user):
+    """
+    list_users only returns the SMS MFA options of a user,
+    not their preferred MFA setting
+    """
+    options = user.get("mfa_options", [])
+    if any(option.get("DeliveryMedium") == "SMS" for option in options):
+        return "sms"
+    return "none"
+
+
+def export_row(user):
+    """ Flatten a User.normalise dict into an export row """
+    return {
+        "username": user["username"],
+        "email": user.get("email", ""),
+        "name": user.get("name", ""),
+        "group": user["group"]["value"],
+        "paths": user.get("custom:paths", ""),
+        "is_la": user.get("custom:is_la", "0"),
+        "status": user["status"],
+        "enabled": bool(user["enabled"]),
+        "phone_number": user.get("phone_number", ""),
+        "phone_number_verified": user.get("phone_number_verified") == "true",
+        "mfa": mfa_state(user),
+        "created": timestamp(user["createdate"]),
+        "last_modified": timestamp(user["lastmodifieddate"]),
+    }
+
+
+def csv_chunk(rows, include_header=False):
+    chunk = io.StringIO()
+    writer = csv.DictWriter(chunk, fieldnames=EXPORT_COLUMNS)
+    if include_header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return chunk.getvalue()
+
+
+def jsonl_chunk(rows):
+    return "".join(json.dumps(row) + "\n" for row in rows)
+
+
+def export_chunks(export_format="csv", email_starts_filter=""):
+    """
+    Yield the export as text a page of users at a time
+
+    Each page is only requested from Cognito once the
+    previous chunk has been consumed.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"ERR: {export_format}: is not an export format")
+
+    if export_format == "csv":
+        yield csv_chunk([], include_header=True)
+
+    for page in User.iter_pages(email_starts_filter, limit=LIST_USERS_PAGE_SIZE):
+        rows = [export_row(user) for user in page["users"]]
+        if not rows:
+            continue
+        if export_format == "csv":
+            yield csv_chunk(rows)
+        else:
+            yield jsonl_chunk(rows)
+
+
+def bounded_export(export_format, max_bytes):
+    """ Return the whole export as text, or None if it is over max_bytes """
+    chunks = []
+    size = 0
+    for chunk in export_chunks(export_format):
+        size += len(chunk.encode("utf-8"))
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+def export_filename(export_format):
+    return "users-{}.{}".format(
+        datetime.utcnow().strftime("%Y%m%d-%H%M%S"), export_format
+    )
+
+
+def run(argv=None):
+    """
+    Write an export of the user pool from the command line
+    """
+    parser = argparse.ArgumentParser(description="Export every user in the pool")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--output", help="file to write to, defaults to stdout")
+    parser.add_argument("--environment", default="testing")
+    args = parser.parse_args(argv)
+
+    if not config.setup_command_line(args.environment):
+        return 1
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        for chunk in export_chunks(args.format):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
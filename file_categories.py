@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Categories for files from their folders and file names.
+
+Kept apart from main so the delta lambda can categorise
+files without loading the flask app.
+"""
+import logging
+import re
+
+from logger import LOG, log_lazy
+
+
+def categorise_file(file_item, prefix):
+    """
+    Take paths after the file prefix
+    and words of the file name and
+    join into a single category string
+    """
+    key = file_item["Key"]
+    file_path = key.replace(prefix, "")
+    # remove empty strings from starting or trailing slashes
+    path_steps = list(filter(lambda folder: folder != "", file_path.split("/")))
+    full_file_name = path_steps.pop()
+    file_category = get_file_name_category(full_file_name)
+    if file_category != "":
+        path_steps.append(file_category)
+
+    categories = [re_case_word(re.sub(r"[-_]", " ", word)) for word in path_steps]
+
+    joined_category = " > ".join(categories)
+    if joined_category == "":
+        joined_category = "Daily Incoming Data"
+
+    log_lazy(
+        LOG,
+        logging.DEBUG,
+        lambda: {"categories": categories, "joined": joined_category},
+    )
+    file_item["Category"] = joined_category
+    file_item["Categories"] = categories
+    return file_item
+
+
+def get_file_name_category(file_name):
+    """
+    Strip any numeric strings from the file name
+    and convert to space delimited string for
+    rendering
+    """
+    # remove file extension
+    file_name = " ".join(file_name.split(".")[:-1])
+
+    file_name_words = re.split("[-_]", file_name)
+    # remove numeric strings
+    file_category_words = filter(
+        lambda word: not re.match("^[0-9]+$", word), file_name_words
+    )
+
+    file_category = " ".join(file_category_words)
+    return file_category
+
+
+def re_case_word(word):
+    """
+    Title case word unless known initialism which should be upper
+    """
+    initialisms = ["DWP", "NHS", "MHCLG", "GDS"]
+
+    if word.upper() in initialisms:
+        re_cased = word.upper()
+    else:
+        re_cased = word.title()
+    return re_cased
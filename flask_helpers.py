@@ -1,8 +1,10 @@
 from functools import wraps
+import logging
 
 from flask import redirect, render_template, session
 
-from logger import LOG
+from access_profile import get_access_profile
+from logger import LOG, log_lazy
 import config
 
 
@@ -11,34 +13,29 @@ def is_admin_interface():
 
 
 def has_admin_role():
-    is_admin_role = False
-    group = session.get("group", None)
-    if group:
-        is_admin_role = group["value"] in ["admin-view", "admin-power", "admin-full"]
-    return is_admin_role
+    return get_access_profile(session).is_admin
 
 
 def user_has_a_valid_role(valid_roles):
     has_a_valid_role = False
-    group = session.get("group", None)
-    LOG.debug(group)
+    group_name = get_access_profile(session).group_name
+    LOG.debug(group_name)
     LOG.debug(session.get("user", None))
-    if group:
-        has_a_valid_role = group["value"] in valid_roles
+    if group_name:
+        has_a_valid_role = group_name in valid_roles
         if not has_a_valid_role:
-            LOG.debug({"group": group, "valid": valid_roles})
+            log_lazy(
+                LOG,
+                logging.DEBUG,
+                lambda: {"group": group_name, "valid": valid_roles},
+            )
     else:
         LOG.debug("No group in session")
     return has_a_valid_role
 
 
 def current_group_name():
-    default_group_name = "group-not-available"
-    group_name = default_group_name
-    group = session.get("group", None)
-    if group:
-        group_name = group.get("value", default_group_name)
-    return group_name
+    return get_access_profile(session).group_name or "group-not-available"
 
 
 def is_development():
@@ -167,7 +164,4 @@ def render_template_custom(template, hide_logout=False, **args):
 
 
 def has_upload_rights():
-    has_upload_role = False
-    if "group" in session:
-        has_upload_role = session["group"]["value"] == "standard-upload"
-    return has_upload_role
+    return get_access_profile(session).can_upload
@@ -0,0 +1,14 @@
+// Keeps a started bulk user job going one batch at a time.
+//
+// Each batch is applied by posting the continue form, which redirects
+// back to the job page. Once a job has started the form is posted
+// again automatically until no users are left pending.
+
+load_bulkjob_js();
+
+function load_bulkjob_js() {
+    var form = document.getElementById("continue_job");
+    if (form != null && form.hasAttribute("data-auto-continue")) {
+        form.submit();
+    }
+}
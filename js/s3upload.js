@@ -130,6 +130,12 @@ function upload_complete(result) {
     document.getElementById("uploading_spinner").classList.add("hidden");
 }
 
+function upload_duplicate(existing_key) {
+    document.getElementById("upload_duplicate_key").innerText = existing_key;
+    document.getElementById("upload_duplicate").classList.remove("hidden");
+    document.getElementById("uploading_spinner").classList.add("hidden");
+}
+
 function upload_failed(result) {
     document.getElementById("upload_failure").classList.remove("hidden");
     document.getElementById("uploading_spinner").classList.add("hidden");
@@ -140,7 +146,78 @@ function upload_failed(result) {
 //}
 
 function start_upload() {
-    ajax_file_upload();
+    if (typeof Worker === "undefined") {
+        // No worker support: upload without a client checksum
+        ajax_file_upload();
+        return;
+    }
+
+    var form_file_to_upload = document.getElementById("file").files[0];
+    var worker = new Worker("/js/sha256worker.js");
+    worker.onmessage = function(event) {
+        if ("checksum" in event.data) {
+            worker.terminate();
+            sign_upload_checksum(event.data.checksum);
+        } else if ("error" in event.data) {
+            s3_upload_console_log(event.data.error);
+            worker.terminate();
+            ajax_file_upload();
+        }
+    };
+    worker.postMessage({"file": form_file_to_upload});
+}
+
+// Ask the app to re-sign the upload with the file checksum
+// so S3 rejects any body that does not match it
+function sign_upload_checksum(checksum) {
+    var req = get_http_object();
+    var formData = new FormData();
+    formData.append("checksum", checksum);
+
+    req.open("POST", "/upload/checksum", true);
+    req.onreadystatechange = function() {
+        if(this.readyState == 4) {
+            if (this.status >= 200 && this.status < 300) {
+                var signed = JSON.parse(this.responseText);
+                if ("duplicate" in signed) {
+                    upload_duplicate(signed["duplicate"]);
+                } else {
+                    set_upload_form_params(signed["fields"]);
+                    ajax_file_upload();
+                }
+            } else {
+                upload_failed({
+                    status: this.status,
+                    statusText: this.statusText
+                });
+            }
+        }
+    }
+
+    req.send(formData);
+}
+
+function set_upload_form_params(fields) {
+    var upload_form = document.getElementById("upload_form");
+    var hidden_params = document.getElementsByClassName('upload_form_post_param');
+
+    for (var form_key in fields) {
+        var found = false;
+        for (var i = 0; i < hidden_params.length; i++) {
+            if (hidden_params[i].name == form_key) {
+                hidden_params[i].value = fields[form_key];
+                found = true;
+            }
+        }
+        if (!found) {
+            var param = document.createElement("input");
+            param.type = "hidden";
+            param.className = "upload_form_post_param";
+            param.name = form_key;
+            param.value = fields[form_key];
+            upload_form.appendChild(param);
+        }
+    }
 }
 
 function get_http_object() {
@@ -0,0 +1,148 @@
+// Incremental SHA-256 of a File run inside a Web Worker.
+//
+// The file is read in fixed size chunks so memory use is bounded
+// and the page stays responsive however large the upload is.
+// Posts {progress: 0..1} after each chunk and {checksum: hex}
+// when the whole file has been hashed.
+
+var CHUNK_SIZE = 4 * 1024 * 1024;
+
+var K = new Uint32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+function rotr(x, n) {
+    return (x >>> n) | (x << (32 - n));
+}
+
+function Sha256() {
+    this.h = new Uint32Array([
+        0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+        0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+    ]);
+    this.w = new Uint32Array(64);
+    this.block = new Uint8Array(64);
+    this.buffered = 0;
+    this.length = 0;
+}
+
+Sha256.prototype.compress = function(bytes, offset) {
+    var w = this.w;
+    var h = this.h;
+    var i;
+
+    for (i = 0; i < 16; i++) {
+        var j = offset + i * 4;
+        w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+    }
+    for (i = 16; i < 64; i++) {
+        var x = w[i - 15];
+        var y = w[i - 2];
+        var s0 = rotr(x, 7) ^ rotr(x, 18) ^ (x >>> 3);
+        var s1 = rotr(y, 17) ^ rotr(y, 19) ^ (y >>> 10);
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+    }
+
+    var a = h[0], b = h[1], c = h[2], d = h[3];
+    var e = h[4], f = h[5], g = h[6], k = h[7];
+
+    for (i = 0; i < 64; i++) {
+        var t1 = (k + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) +
+                  ((e & f) ^ (~e & g)) + K[i] + w[i]) | 0;
+        var t2 = ((rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) +
+                  ((a & b) ^ (a & c) ^ (b & c))) | 0;
+        k = g;
+        g = f;
+        f = e;
+        e = (d + t1) | 0;
+        d = c;
+        c = b;
+        b = a;
+        a = (t1 + t2) | 0;
+    }
+
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d;
+    h[4] += e; h[5] += f; h[6] += g; h[7] += k;
+};
+
+Sha256.prototype.update = function(bytes) {
+    var offset = 0;
+    this.length += bytes.length;
+
+    // top up a partially filled block left over from the last chunk
+    if (this.buffered > 0) {
+        var take = Math.min(64 - this.buffered, bytes.length);
+        this.block.set(bytes.subarray(0, take), this.buffered);
+        this.buffered += take;
+        offset = take;
+        if (this.buffered < 64) {
+            return;
+        }
+        this.compress(this.block, 0);
+        this.buffered = 0;
+    }
+
+    while (offset + 64 <= bytes.length) {
+        this.compress(bytes, offset);
+        offset += 64;
+    }
+
+    if (offset < bytes.length) {
+        this.block.set(bytes.subarray(offset), 0);
+        this.buffered = bytes.length - offset;
+    }
+};
+
+Sha256.prototype.hex_digest = function() {
+    var bit_length = this.length * 8;
+    var pad_length = this.buffered < 56 ? 56 - this.buffered : 120 - this.buffered;
+    var padding = new Uint8Array(pad_length + 8);
+    var high = Math.floor(bit_length / 0x100000000);
+    var low = bit_length >>> 0;
+    var i;
+
+    padding[0] = 0x80;
+    for (i = 0; i < 4; i++) {
+        padding[pad_length + i] = high >>> (24 - i * 8);
+        padding[pad_length + 4 + i] = low >>> (24 - i * 8);
+    }
+    this.update(padding);
+
+    var hex = "";
+    for (i = 0; i < 8; i++) {
+        hex += ("00000000" + this.h[i].toString(16)).slice(-8);
+    }
+    return hex;
+};
+
+function hash_file(file) {
+    var reader = new FileReaderSync();
+    var hash = new Sha256();
+
+    for (var offset = 0; offset < file.size; offset += CHUNK_SIZE) {
+        var chunk = file.slice(offset, offset + CHUNK_SIZE);
+        hash.update(new Uint8Array(reader.readAsArrayBuffer(chunk)));
+        self.postMessage({"progress": Math.min(offset + CHUNK_SIZE, file.size) / file.size});
+    }
+
+    return hash.hex_digest();
+}
+
+if (typeof module === "undefined") {
+    self.onmessage = function(event) {
+        try {
+            self.postMessage({"checksum": hash_file(event.data.file)});
+        } catch (err) {
+            self.postMessage({"error": String(err)});
+        }
+    };
+} else {
+    module.exports = {"Sha256": Sha256};
+}
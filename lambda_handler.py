@@ -1,9 +1,11 @@
 import os
+from urllib.parse import unquote_plus
 
 import serverless_wsgi
 
-from main import app
+from logger import flush_logs
 import config
+import delta
 
 
 def web_app(event, context):
@@ -31,7 +33,38 @@ def admin(event, context):
     return run(event, context)
 
 
+def daily_delta(event, context):
+    """Lambda handler entry point for S3 object created events.
+    Writes the day-over-day delta files for new daily files
+    in local authority folders.
+        :param event: An S3 event notification
+        :param context: An AWS context object
+        :returns: The changed row counts for each new file
+        :rtype: dict
+    """
+    config.load_environment()
+    la_prefix = "{}/local_authority/".format(config.get("bucket_main_prefix"))
+
+    results = {}
+    try:
+        for record in event.get("Records", []):
+            bucket_name = record["s3"]["bucket"]["name"]
+            key = unquote_plus(record["s3"]["object"]["key"])
+            if key.startswith(la_prefix) and delta.is_daily_file(key):
+                results[key] = delta.write_daily_delta(bucket_name, key)
+    finally:
+        flush_logs()
+    return results
+
+
 def run(event, context):
+    # Imported here so the daily_delta handler doesn't load the flask app
+    from main import app
+
     config.load_environment(app)
     config.load_settings(app)
-    return serverless_wsgi.handle_request(app, event, context)
+    try:
+        return serverless_wsgi.handle_request(app, event, context)
+    finally:
+        # Lambda may freeze the process before queued logs are written
+        flush_logs()
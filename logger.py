@@ -1,43 +1,325 @@
 """ Declare a logger to be used by any module """
-import datetime
+import atexit
+import copy
 import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Written for every log line in this order, as the JSON log
+# queries expect. These are the attributes of a LogRecord.
+RECORD_FIELDS = (
+    "name",
+    "msg",
+    "args",
+    "levelname",
+    "levelno",
+    "pathname",
+    "filename",
+    "module",
+    "exc_info",
+    "exc_text",
+    "stack_info",
+    "lineno",
+    "funcName",
+    "created",
+    "msecs",
+    "relativeCreated",
+    "thread",
+    "threadName",
+    "processName",
+    "process",
+)
+
+# Only messages starting like this can be a JSON object or list
+JSON_MESSAGE_STARTS = ("{", "[", " ", "\n")
+
+JSON_ENCODER = json.JSONEncoder(default=str)
+
+if orjson is not None:
+    # Leave datetimes to str like json.dumps(default=str) does
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
 
 
 class JsonFormatter(logging.Formatter):
     """ Handle log invokes with string, dict or json.dumps """
 
-    def format(self):
-        """ Detect formatting of self message and encode as valid JSON """
-        data = {}
-        data.update(vars(self))
+    def __init__(self, use_orjson=True):
+        super().__init__()
+        self.use_orjson = use_orjson and orjson is not None
+        self.formatted_second = (None, "")
+
+    def format(self, record):
+        """ Encode the record as a JSON object of RECORD_FIELDS """
+        attributes = vars(record)
+        data = {field: attributes.get(field) for field in RECORD_FIELDS}
+        data["msg"] = self.message(record)
+        data["timestamp"] = self.timestamp(record.created)
+        return self.encode(data)
+
+    def message(self, record):
+        """
+        Return the message with any args applied
+
+        A message which is a json.dumps string of a dict or
+        list is returned parsed so it is logged as JSON.
+        """
+        msg = record.msg
+        if isinstance(msg, str) and msg.startswith(JSON_MESSAGE_STARTS):
+            try:
+                parsed = json.loads(msg)
+                if isinstance(parsed, (dict, list)):
+                    msg = parsed
+            except ValueError:
+                pass
+
+        if record.args:
+            try:
+                msg = msg % record.args
+            except (TypeError, ValueError, KeyError):
+                pass
+        return msg
+
+    def timestamp(self, created):
+        """ Format a record time as UTC, formatting each second once """
+        second, microsecond = divmod(int(created * 1000000), 1000000)
+        cached_second, formatted = self.formatted_second
+        if second != cached_second:
+            formatted = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self.formatted_second = (second, formatted)
+        return f"{formatted}.{microsecond:06d}Z"
+
+    def encode(self, data):
+        if self.use_orjson:
+            try:
+                return orjson.dumps(data, default=str, option=ORJSON_OPTIONS).decode()
+            except TypeError:
+                # Such as integers too big for orjson
+                pass
         try:
-            json.loads(self.msg)
-            parsed = json.loads(self.msg)
-            if type(parsed) in [dict, list]:
-                data["msg"] = parsed
-        except (ValueError, TypeError, json.JSONDecodeError):
-            pass
+            return JSON_ENCODER.encode(data)
+        except (TypeError, ValueError) as err:
+            return str(err)
+
+
+# Report the caller of log_lazy as where a record was logged.
+# stacklevel is only in python 3.8 onwards.
+LAZY_LOG_ARGUMENTS = {"stacklevel": 2} if sys.version_info >= (3, 8) else {}
+
+
+def log_lazy(logger, level, message, *args):
+    """
+    Log the message a callable returns at level
+    only if logger is enabled for it
+
+    The callable is only called when the message will be logged,
+    so building a message the level filters out costs nothing.
+    Values already to hand should be logged directly instead.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, message(), *args, **LAZY_LOG_ARGUMENTS)
+
+
+# What a queued handler does with a record when its queue is full
+# drop-debug-first: records below WARNING are dropped once the
+#   queue is LOW_PRIORITY_FILL full, the rest only once it is full
+# drop-new: any record is dropped once the queue is full
+# block: the logging call waits for room
+OVERFLOW_POLICIES = ("drop-debug-first", "drop-new", "block")
+
+LOW_PRIORITY_FILL = 0.8
+
+FLUSH_TIMEOUT_SECONDS = 2
+
+
+# Log message args of these types can be queued without a copy
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+def is_immutable(value):
+    if isinstance(value, tuple):
+        return all(is_immutable(item) for item in value)
+    return isinstance(value, IMMUTABLE_TYPES)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Put records on a bounded queue for a QueueListener to write
+
+    Records which don't fit are counted by level and dropped
+    according to the overflow policy.
+    """
 
+    def __init__(self, maxsize, overflow="drop-debug-first"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown log queue overflow policy {overflow}")
+        super().__init__(queue.Queue(maxsize))
+        self.overflow = overflow
+        self.low_priority_limit = int(maxsize * LOW_PRIORITY_FILL)
+        self.dropped = Counter()
+        self.dropped_lock = threading.Lock()
+        self.message_formatter = JsonFormatter(use_orjson=False)
+
+    def prepare(self, record):
+        """
+        Snapshot the message of a record
+
+        The listener's handler formats records off the logging
+        thread, so a message the caller changes after logging it
+        would otherwise be written as changed, or change while
+        it is being encoded. Plain strings with immutable args,
+        nearly every record, can't change and are queued as they are.
+        """
+        if isinstance(record.msg, str) and is_immutable(record.args):
+            return record
+
+        record = copy.copy(record)
+        if isinstance(record.msg, (dict, list)) and is_immutable(record.args):
+            try:
+                record.msg = copy.deepcopy(record.msg)
+                return record
+            except Exception:
+                # Such as a message holding a lock
+                pass
+        # Encode anything else as it is now
+        message = self.message_formatter.message(record)
+        record.msg, record.args = json.loads(JSON_ENCODER.encode(message)), None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        if (
+            self.overflow == "drop-debug-first"
+            and record.levelno < logging.WARNING
+            and self.queue.qsize() >= self.low_priority_limit
+        ):
+            self.drop(record)
+            return
         try:
-            if ("args" in data) and len(data["args"]) > 0:
-                args = data["args"]
-                data["msg"] = data["msg"] % args
-        except TypeError:
-            pass
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.drop(record)
+
+    def drop(self, record):
+        with self.dropped_lock:
+            self.dropped[record.levelname] += 1
+
+    def take_dropped(self):
+        """ Return and reset the counts of dropped records by level """
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, Counter()
+        return dropped
+
+
+class QueuedLogWriter:
+    """
+    Write the records a BoundedQueueHandler queues from a thread
+
+    Counts of dropped records are logged after the next record
+    written following a drop, and when the queue is flushed.
+    """
+
+    def __init__(self, log_name, queue_handler, handler):
+        self.log_name = log_name
+        self.queue_handler = queue_handler
+        self.handler = handler
+        # The listener passes each record to handle below
+        self.listener = QueueListener(queue_handler.queue, self)
+        self.listener.start()
+
+    def handle(self, record):
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+        if self.queue_handler.dropped:
+            self.report_dropped()
+
+    def report_dropped(self):
+        dropped = self.queue_handler.take_dropped()
+        if dropped:
+            self.handler.handle(
+                logging.LogRecord(
+                    self.log_name,
+                    logging.WARNING,
+                    __file__,
+                    0,
+                    {"action": "logger.dropped", "dropped": dict(dropped)},
+                    None,
+                    None,
+                )
+            )
+
+    def flush(self, timeout=FLUSH_TIMEOUT_SECONDS):
+        """
+        Wait up to timeout seconds for the queued records to be
+        written and return whether they all were
+        """
+        log_queue = self.queue_handler.queue
+        deadline = time.monotonic() + timeout
+        with log_queue.all_tasks_done:
+            while log_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                log_queue.all_tasks_done.wait(remaining)
+            flushed = not log_queue.unfinished_tasks
+
+        self.report_dropped()
+        self.handler.flush()
+        return flushed
 
-        data["timestamp"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    def stop(self):
+        self.flush()
         try:
-            log_message = json.dumps(data, default=str)
-        except (TypeError, ValueError) as err:
-            log_message = str(err)
-        return log_message
+            self.listener.stop()
+        except queue.Full:
+            # Records are still being queued, the thread ends with the process
+            pass
+
+
+# The QueuedLogWriter of each queued logger by name
+LOG_WRITERS = {}
+
+
+def flush_logs(timeout=FLUSH_TIMEOUT_SECONDS):
+    """ Write out the records queued by every queued logger """
+    for writer in list(LOG_WRITERS.values()):
+        writer.flush(timeout)
+
 
+def exit_on_sigterm(signum, frame):
+    """
+    Signal handler which writes out queued logs then exits
 
-def build_logger(log_name, log_level="ERROR"):
-    """ Create shared logger and custom JSON handler """
+    Exiting this way runs the atexit handlers, which SIGTERM's
+    default handling skips.
+    """
+    flush_logs()
+    sys.exit(0)
+
+
+def build_logger(
+    log_name, log_level="ERROR", queue_size=0, overflow="drop-debug-first"
+):
+    """
+    Create shared logger and custom JSON handler
+
+    With a queue_size records are queued for a thread to write
+    rather than written by the logging call.
+    """
 
     # Default log_level value is only set for None
     # If log level env var is set but empty string
@@ -47,7 +329,19 @@ def build_logger(log_name, log_level="ERROR"):
 
     logger = logging.getLogger(log_name)
     handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(JsonFormatter)
+    handler.setFormatter(JsonFormatter())
+
+    if log_name in LOG_WRITERS:
+        writer = LOG_WRITERS.pop(log_name)
+        atexit.unregister(writer.stop)
+        writer.stop()
+    if queue_size > 0:
+        queue_handler = BoundedQueueHandler(queue_size, overflow)
+        writer = QueuedLogWriter(log_name, queue_handler, handler)
+        LOG_WRITERS[log_name] = writer
+        atexit.register(writer.stop)
+        handler = queue_handler
+
     logger.handlers = []
     logger.addHandler(handler)
     logger.setLevel(getattr(logging, log_level))
@@ -56,4 +350,14 @@ def build_logger(log_name, log_level="ERROR"):
 
 LOG_LEVEL = str(os.getenv("LOG_LEVEL", "ERROR"))
 
-LOG = build_logger("vulnerable_people_data_service", log_level=LOG_LEVEL)
+# Off unless LOG_QUEUE_SIZE is set
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or "0")
+
+LOG_QUEUE_OVERFLOW = os.getenv("LOG_QUEUE_OVERFLOW") or "drop-debug-first"
+
+LOG = build_logger(
+    "vulnerable_people_data_service",
+    log_level=LOG_LEVEL,
+    queue_size=LOG_QUEUE_SIZE,
+    overflow=LOG_QUEUE_OVERFLOW,
+)
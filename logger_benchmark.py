@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the cost of formatting one log record.
+
+Compares logger.JsonFormatter, with and without orjson, against
+the formatter it replaced for the kinds of message the app logs:
+
+    python logger_benchmark.py --number 20000
+"""
+import argparse
+import datetime
+import json
+import logging
+import sys
+import timeit
+
+from logger import JsonFormatter, orjson
+
+RECORDS = {
+    "string": ("User operation failed", None),
+    "string with args": ("ERR: %s: the email %s is not valid", ("admin", "a@b.c")),
+    "dict": (
+        {
+            "action": "user.update",
+            "status": {"user_found": True, "inputs_valid": True, "updated": True},
+            "user": "test-user@test-domain.com",
+        },
+        None,
+    ),
+    "json string": (json.dumps({"action": "login", "groups": ["admin-full"]}), None),
+}
+
+
+def legacy_format(record):
+    """ The formatter before fields were fixed, kept as the baseline """
+    data = {}
+    data.update(vars(record))
+    try:
+        json.loads(record.msg)
+        parsed = json.loads(record.msg)
+        if type(parsed) in [dict, list]:
+            data["msg"] = parsed
+    except (ValueError, TypeError, json.JSONDecodeError):
+        pass
+
+    try:
+        if ("args" in data) and len(data["args"]) > 0:
+            args = data["args"]
+            data["msg"] = data["msg"] % args
+    except TypeError:
+        pass
+
+    data["timestamp"] = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    try:
+        log_message = json.dumps(data, default=str)
+    except (TypeError, ValueError) as err:
+        log_message = str(err)
+    return log_message
+
+
+def make_record(msg, args, level=logging.ERROR):
+    return logging.LogRecord(
+        "vulnerable_people_data_service",
+        level,
+        __file__,
+        1,
+        msg,
+        args,
+        None,
+    )
+
+
+def formatters():
+    yield "legacy", legacy_format
+    yield "json", JsonFormatter(use_orjson=False).format
+    if orjson is not None:
+        yield "orjson", JsonFormatter().format
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Time formatting a log record")
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    for message_kind, (msg, msg_args) in RECORDS.items():
+        record = make_record(msg, msg_args)
+        for formatter_name, format_record in formatters():
+            best = min(
+                timeit.repeat(
+                    lambda: format_record(record),
+                    number=args.number,
+                    repeat=args.repeat,
+                )
+            )
+            microseconds = best / args.number * 1000000
+            print(
+                f"{message_kind:<18} {formatter_name:<8} {microseconds:6.2f} us/record"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
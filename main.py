@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
 
+import base64
+import csv
+import io
 import json
+import logging
 import re
+import uuid
+import zipfile
 from collections import defaultdict
 from datetime import datetime
+from itertools import islice
 
 import boto3
 import requests
 from botocore.exceptions import ClientError
-from flask import Flask, redirect, request, send_file, send_from_directory, session
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    redirect,
+    request,
+    send_file,
+    send_from_directory,
+    session,
+    stream_with_context,
+)
 from jinja2 import TemplateError
 from requests.auth import HTTPBasicAuth
 from werkzeug.utils import secure_filename
 
+from access_profile import build_access_profile, get_access_profile
 import admin
+import cognito
+from cognito_groups import get_group_by_name
+import cognito_tokens
 import config
 from flask_helpers import (
     admin_interface,
@@ -24,12 +45,26 @@ from flask_helpers import (
     render_template_custom,
     requires_group_in_list,
 )
-from logger import LOG
-from user import User
+from file_categories import categorise_file
+from logger import LOG, log_lazy
+from server_session import regenerate_session
 
 app = Flask(__name__)
 app.logger = LOG
 
+# Only this much of an object is fetched to render a preview
+PREVIEW_MAX_BYTES = 64 * 1024
+PREVIEW_MAX_ROWS = 20
+
+# S3 objects are copied into bulk download archives in chunks this size
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Archives written to S3 are uploaded in parts of at least this size
+ZIP_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
+# Added to an archive listing the files which couldn't be read
+ZIP_ERRORS_FILE_NAME = "download-errors.txt"
+
 
 def exchange_code_for_session_user(code, code_verifier=None) -> dict:
     """Exchange the authorization code for user tokens.
@@ -45,31 +80,42 @@ def exchange_code_for_session_user(code, code_verifier=None) -> dict:
         "redirect_uri": "{}".format(app.config["redirect_host"]),
         "code": code,
     }
-    token_endpoint_url = "https://{}/oauth2/token".format(app.config["cognito_domain"])
 
-    oauth_response = requests.post(
-        token_endpoint_url,
+    oauth_response = cognito.hosted_domain_request(
+        "POST",
+        "/oauth2/token",
         data=payload,
         headers=headers,
         auth=HTTPBasicAuth(app.config["client_id"], app.config["client_secret"]),
     )
+    if oauth_response.status_code != 200:
+        return oauth_response
 
     oauth_response_body = oauth_response.json()
     # Get the id_token field
     id_token = oauth_response_body["id_token"]
-
-    client = boto3.client("cognito-idp")
-    cognito_user = client.get_user(AccessToken=oauth_response_body["access_token"])
+    claims = cognito_tokens.verify_id_token(id_token)
+    if claims == {}:
+        oauth_response.status_code = 403
+        return oauth_response
 
     is_not_production = config.get("app_environment") != "production"
     # only get these attributes if the MFA is present
-    if is_not_production or is_mfa_configured(cognito_user):
-        session["attributes"] = cognito_user["UserAttributes"]
-        session["user"] = cognito_user["Username"]
-        session["email"] = return_attribute(session, "email")
-        session["name"] = return_attribute(session, "name")
+    if is_not_production or is_mfa_configured_for_token(
+        claims, oauth_response_body["access_token"]
+    ):
+        # Groups are listed in precedence order and
+        # we're currently only interested in the first
+        group_names = claims.get("cognito:groups", [])
+        group = get_group_by_name(group_names[0] if group_names else None)
+        profile = build_access_profile(cognito_tokens.claim_attributes(claims), group)
+        # The user, group and access profile all change so the id does too
+        regenerate_session()
+        session["access_profile"] = profile
+        session["user"] = claims["cognito:username"]
+        session["email"] = profile["attributes"].get("email", "")
+        session["name"] = profile["attributes"].get("name", "")
         session["details"] = id_token
-        session["group"] = User.group(cognito_user["Username"])
         app.logger.info(
             "Successful login - user: %s email: %s", session["user"], session["email"]
         )
@@ -84,6 +130,19 @@ def exchange_code_for_session_user(code, code_verifier=None) -> dict:
     return oauth_response
 
 
+def is_mfa_configured_for_token(claims, access_token):
+    """
+    The id token doesn't say whether MFA is set up so
+    the user's settings are fetched with their access token.
+    SMS MFA can't be set up without a phone number so that
+    call is skipped when the token doesn't have one.
+    """
+    if not claims.get("phone_number"):
+        return False
+    client = boto3.client("cognito-idp")
+    return is_mfa_configured(client.get_user(AccessToken=access_token))
+
+
 def is_mfa_configured(cognito_user):
     # does the MFAOptions list contain an entry where both
     # the DeliveryMedium is SMS
@@ -205,7 +264,11 @@ def index():
 
     if "code" in args:
         oauth_code = args["code"]
-        response = exchange_code_for_session_user(oauth_code)
+        try:
+            response = exchange_code_for_session_user(oauth_code)
+        except requests.RequestException as error:
+            app.logger.error({"error": "OAuth failed", "exception": str(error)})
+            return redirect("/403")
         if response.status_code != 200:
             app.logger.error({"error": "OAuth failed", "response": response})
             return redirect("/403")
@@ -249,7 +312,10 @@ def logout():
         session.pop("email", None)
         session.pop("user", None)
         session.pop("attributes", None)
+        session.pop("access_profile", None)
         session.pop("group", None)
+        session.pop("upload_file_path", None)
+        regenerate_session()
     except Exception as err:
         app.logger.error(err)
 
@@ -286,7 +352,7 @@ def download(path):
                 "User {}: generated url for: {}".format(session["user"], path)
             )
 
-            if "details" in session and "attributes" in session:
+            if "details" in session:
                 if redirect_url.startswith(
                         "https://{}.s3.amazonaws.com/".format(app.config["bucket_name"])
                 ):
@@ -300,12 +366,237 @@ def download(path):
         return redirect("/403")
 
 
+@app.route("/files/zip", methods=["POST"])
+@login_required
+@end_user_interface
+@requires_group_in_list(["standard-download", "standard-upload"])
+def download_zip():
+    """
+    Check the user has access to every requested file
+    Stream a ZIP archive of them straight from S3
+
+    On lambda the response is buffered in full and the ALB
+    limits it to 1MB, so the archive is written to S3 instead
+    and the user is redirected to a presigned URL for it.
+    """
+    prefixes = load_user_lookup(session)
+    keys = list(dict.fromkeys(request.form.getlist("keys")))
+
+    if len(keys) == 0:
+        return redirect("/files")
+
+    if not all(key_has_granted_prefix(key, prefixes) for key in keys):
+        return redirect("/403")
+
+    store_only = request.form.get("store_only", "") == "yes"
+    compression = zipfile.ZIP_STORED if store_only else zipfile.ZIP_DEFLATED
+
+    app.logger.info("User {}: downloading archive of: {}".format(session["user"], keys))
+    archive_name = "data-{}.zip".format(datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+    bucket_name = app.config["bucket_name"]
+    if config.running_on_lambda():
+        archive_key = "{}/{}/{}".format(
+            config.get("zip_archive_prefix"), uuid.uuid4().hex, archive_name
+        )
+        chunks = stream_zip_archive(bucket_name, keys, compression)
+        if not upload_chunks(bucket_name, archive_key, chunks, "application/zip"):
+            return (
+                render_template_custom(
+                    "error.html", error="The archive could not be created."
+                ),
+                500,
+            )
+        return redirect(create_presigned_url(bucket_name, archive_key, 60), 302)
+
+    return Response(
+        stream_with_context(stream_zip_archive(bucket_name, keys, compression)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={archive_name}"},
+    )
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    Unseekable sink for zipfile which hands back whatever
+    has been written since the last drain
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip_archive(bucket_name, keys, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yield a ZIP archive of the S3 objects at keys.
+
+    Each object is read and written in ZIP_CHUNK_SIZE chunks
+    so no file is ever held in memory in full. Objects which
+    can't be read are listed in ZIP_ERRORS_FILE_NAME.
+    """
+    s3_client = boto3.client("s3")
+    buffer = ZipStreamBuffer()
+    failed_keys = []
+
+    with zipfile.ZipFile(buffer, mode="w", compression=compression) as archive:
+        for key in keys:
+            try:
+                s3_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+            except ClientError as err:
+                app.logger.error(vars(err))
+                failed_keys.append(s3_remove_root_path(key))
+                continue
+
+            entry_info = zipfile.ZipInfo(
+                s3_remove_root_path(key),
+                date_time=s3_object["LastModified"].timetuple()[:6],
+            )
+            entry_info.compress_type = compression
+            with archive.open(entry_info, mode="w", force_zip64=True) as entry:
+                for chunk in s3_object["Body"].iter_chunks(ZIP_CHUNK_SIZE):
+                    entry.write(chunk)
+                    yield buffer.drain()
+
+        if failed_keys:
+            archive.writestr(
+                ZIP_ERRORS_FILE_NAME,
+                "These files could not be added to the archive:\n"
+                + "".join(f"{key}\n" for key in failed_keys),
+            )
+
+    yield buffer.drain()
+
+
+def upload_chunks(bucket_name, key, chunks, content_type):
+    """
+    Write an iterable of bytes to S3 with a multipart upload
+
+    Only one part is held in memory at a time.
+    Returns whether the object was written.
+    """
+    s3_client = boto3.client("s3")
+    upload_id = None
+    try:
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket_name, Key=key, ContentType=content_type
+        )["UploadId"]
+
+        parts = []
+        part = bytearray()
+
+        def upload_part():
+            response = s3_client.upload_part(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=len(parts) + 1,
+                Body=bytes(part),
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+
+        for chunk in chunks:
+            part += chunk
+            if len(part) >= ZIP_UPLOAD_PART_SIZE:
+                upload_part()
+                part = bytearray()
+        if part or not parts:
+            upload_part()
+
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except ClientError as err:
+        app.logger.error(vars(err))
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id
+            )
+        return False
+    return True
+
+
+@app.route("/preview/<path:path>")
+@login_required
+@end_user_interface
+@requires_group_in_list(["standard-download", "standard-upload"])
+def preview(path):
+    """
+    Check the user has access to the requested file
+    Fetch only the start of the object from S3
+    Render the header and first rows
+    """
+    prefixes = load_user_lookup(session)
+
+    if not key_has_granted_prefix(path, prefixes):
+        return redirect("/403")
+
+    rows = get_csv_preview(app.config["bucket_name"], path)
+    if rows is None:
+        return redirect("/404")
+
+    app.logger.info("User {}: previewed: {}".format(session["user"], path))
+    return render_template_custom(
+        "preview.html",
+        user=session["user"],
+        email=session["email"],
+        key=path,
+        header=rows[0] if rows else [],
+        rows=rows[1:],
+        download_url=f"/download/{path}",
+    )
+
+
+def get_csv_preview(
+    bucket_name, key, max_bytes=PREVIEW_MAX_BYTES, max_rows=PREVIEW_MAX_ROWS
+):
+    """
+    Parse up to max_rows CSV rows from the first max_bytes
+    of an object using a ranged GET so the cost does not
+    depend on the size of the file.
+
+    Returns a list of rows including the header
+    or None if the object can't be read.
+    """
+    s3_client = boto3.client("s3")
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=key, Range="bytes=0-{}".format(max_bytes - 1)
+        )
+        data = response["Body"].read(max_bytes)
+    except ClientError as err:
+        app.logger.error(vars(err))
+        return None
+
+    if len(data) >= max_bytes:
+        # drop the last line as it is probably cut short
+        data = data[: data.rfind(b"\n") + 1]
+
+    text = data.decode("utf-8-sig", errors="replace")
+    return list(islice(csv.reader(io.StringIO(text)), max_rows + 1))
+
+
 @app.route("/upload", methods=["POST", "GET"])
 @login_required
 @end_user_interface
 @requires_group_in_list(["standard-upload"])
 def upload():
-    user_upload_paths = user_custom_paths(is_upload=True, session=session)
+    profile = get_access_profile(session)
+    user_upload_paths = list(profile.upload_prefixes)
     preupload = True
     file_path_to_upload = ""
     presigned_object = ""
@@ -334,6 +625,8 @@ def upload():
                 presigned_object = create_presigned_post(file_path_to_upload)
                 if presigned_object is None:
                     return redirect("/upload?error=True")
+                # keep the key so the client can re-sign it with a checksum
+                session["upload_file_path"] = file_path_to_upload
             else:
                 return redirect("/upload?error=True")
 
@@ -345,7 +638,7 @@ def upload():
         "upload.html",
         user=session["user"],
         email=session["email"],
-        is_la=return_attribute(session, "custom:is_la"),
+        is_la=profile.is_la,
         presigned_object=presigned_object,
         preupload=preupload,
         filepathtoupload=file_path_to_upload,
@@ -355,6 +648,121 @@ def upload():
     )
 
 
+@app.route("/upload/checksum", methods=["POST"])
+@login_required
+@end_user_interface
+@requires_group_in_list(["standard-upload"])
+def upload_checksum():
+    """
+    Re-sign the pending upload with the SHA-256 checksum
+    computed in the browser so S3 rejects a corrupted body
+    """
+    file_path_to_upload = session.get("upload_file_path")
+    checksum = request.form.get("checksum", "").lower()
+
+    if not file_path_to_upload or not is_sha256_hex(checksum):
+        return jsonify({"error": "Invalid upload checksum request"}), 400
+
+    bucket_name = app.config["bucket_name"]
+    duplicate_key = find_duplicate_upload(bucket_name, file_path_to_upload, checksum)
+    if duplicate_key is not None:
+        app.logger.info(
+            "User {}: skipped duplicate of: {}".format(session["user"], duplicate_key)
+        )
+        # The file won't be uploaded so nor should its metadata be
+        delete_upload_metadata(bucket_name, file_path_to_upload)
+        session.pop("upload_file_path", None)
+        return jsonify({"duplicate": duplicate_key})
+
+    presigned_object = create_presigned_post(file_path_to_upload, checksum=checksum)
+    if presigned_object is None:
+        return jsonify({"error": "Failed to sign upload"}), 500
+
+    return jsonify(presigned_object)
+
+
+def is_sha256_hex(checksum):
+    return re.match("^[0-9a-f]{64}$", checksum) is not None
+
+
+def checksum_post_fields(checksum=None):
+    """
+    Return the presigned POST fields and policy conditions
+    which make S3 verify the uploaded body against checksum.
+
+    S3 expects the base64 encoded digest where we use hex.
+    The checksum is also stored as object metadata so an
+    object can be told apart from one uploaded unchecked.
+    """
+    if checksum is None:
+        return {}, []
+
+    encoded = base64.b64encode(bytes.fromhex(checksum)).decode("ascii")
+    fields = {
+        "x-amz-checksum-algorithm": "SHA256",
+        "x-amz-checksum-sha256": encoded,
+        "x-amz-meta-sha256": checksum,
+    }
+    conditions = [{name: value} for name, value in fields.items()]
+    return fields, conditions
+
+
+def checksum_index_key(object_name, checksum):
+    """
+    Key of the content-addressed index entry for checksum
+    in the upload folder that object_name is being written to
+
+    The index is kept under its own top level prefix so
+    consumers of the upload folders never see it.
+    """
+    upload_folder = object_name.rsplit("/", 1)[0]
+    return "{}/{}/{}.json".format(
+        config.get("checksum_index_prefix", "web-app-upload-checksums"),
+        upload_folder,
+        checksum,
+    )
+
+
+def upload_metadata_key(object_name):
+    return "{}-metadata.json".format(object_name)
+
+
+def delete_upload_metadata(bucket_name, object_name):
+    """ Remove the CSVW metadata written when an upload was signed """
+    s3_client = boto3.client("s3")
+    try:
+        s3_client.delete_object(
+            Bucket=bucket_name, Key=upload_metadata_key(object_name)
+        )
+    except ClientError as err:
+        app.logger.error(vars(err))
+        return False
+    return True
+
+
+def find_duplicate_upload(bucket_name, object_name, checksum):
+    """
+    Return the key of an existing upload in the same folder
+    with identical content or None if there isn't one.
+
+    Index entries are written when an upload is signed so
+    the referenced object is checked in case that upload
+    never completed, or was made with the unchecked post.
+    """
+    s3_client = boto3.client("s3")
+    try:
+        index_entry = s3_client.get_object(
+            Bucket=bucket_name, Key=checksum_index_key(object_name, checksum)
+        )
+        stored_key = json.loads(index_entry["Body"].read())["url"]
+        stored_object = s3_client.head_object(Bucket=bucket_name, Key=stored_key)
+    except (ClientError, ValueError, KeyError):
+        return None
+    if stored_object.get("Metadata", {}).get("sha256") != checksum:
+        return None
+    return stored_key
+
+
 def generate_upload_file_path(form_fields):
     """
     Use validated form fields to create the key for S3
@@ -413,12 +821,17 @@ def key_has_granted_prefix(key, prefixes):
     return granted
 
 
-def create_presigned_post(object_name, expiration=3600):
+def create_presigned_post(object_name, expiration=3600, checksum=None):
     # Generate a presigned S3 POST URL
     s3_client = boto3.client("s3")
+    fields, conditions = checksum_post_fields(checksum)
     try:
         response = s3_client.generate_presigned_post(
-            app.config["bucket_name"], object_name, ExpiresIn=expiration
+            app.config["bucket_name"],
+            object_name,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expiration,
         )
 
         csvw = {
@@ -428,12 +841,25 @@ def create_presigned_post(object_name, expiration=3600):
             "dc:date": datetime.utcnow().isoformat(),
             "dc:publisher": "Government Digital Service",
         }
+        if checksum is not None:
+            # Let consumers verify the file without hashing it again
+            csvw["spdx:checksum"] = {
+                "spdx:algorithm": "SHA256",
+                "spdx:checksumValue": checksum,
+            }
 
         s3_client.put_object(
             Body=json.dumps(csvw),
             Bucket=app.config["bucket_name"],
-            Key="{}-metadata.json".format(object_name),
+            Key=upload_metadata_key(object_name),
         )
+
+        if checksum is not None:
+            s3_client.put_object(
+                Body=json.dumps({"url": object_name}),
+                Bucket=app.config["bucket_name"],
+                Key=checksum_index_key(object_name, checksum),
+            )
     except ClientError as e:
         app.logger.error(e)
         return None
@@ -457,7 +883,7 @@ def files():
         user=session["user"],
         email=session["email"],
         files=collect_files_by_date(files),
-        is_la=return_attribute(session, "custom:is_la"),
+        is_la=get_access_profile(session).is_la,
     )
 
 
@@ -479,6 +905,27 @@ def admin_list_users():
     return admin.admin_list_users(app)
 
 
+@app.route("/admin/user/search", methods=["POST", "GET"])
+@admin_interface
+@requires_group_in_list(["admin-view", "admin-power", "admin-full"])
+def admin_search_users():
+    return admin.admin_search_users(app)
+
+
+@app.route("/admin/user/path-impact")
+@admin_interface
+@requires_group_in_list(["admin-view", "admin-power", "admin-full"])
+def admin_path_impact():
+    return admin.admin_path_impact(app)
+
+
+@app.route("/admin/user/export")
+@admin_interface
+@requires_group_in_list(["admin-view", "admin-power", "admin-full"])
+def admin_export_users():
+    return admin.admin_export_users(app)
+
+
 @app.route("/admin/user", methods=["POST", "GET"])
 @admin_interface
 @requires_group_in_list(["admin-view", "admin-power", "admin-full"])
@@ -486,6 +933,27 @@ def admin_user():
     return admin.admin_user(app)
 
 
+@app.route("/admin/user/bulk", methods=["POST", "GET"])
+@admin_interface
+@requires_group_in_list(["admin-full"])
+def admin_bulk_create_users():
+    return admin.admin_bulk_create_users(app)
+
+
+@app.route("/admin/user/bulk/update", methods=["POST", "GET"])
+@admin_interface
+@requires_group_in_list(["admin-power", "admin-full"])
+def admin_bulk_update_users():
+    return admin.admin_bulk_update_users(app)
+
+
+@app.route("/admin/user/bulk/report")
+@admin_interface
+@requires_group_in_list(["admin-power", "admin-full"])
+def admin_bulk_report():
+    return admin.admin_bulk_report(app)
+
+
 @app.route("/admin/user/edit", methods=["POST", "GET"])
 @admin_interface
 @requires_group_in_list(["admin-power", "admin-full"])
@@ -583,16 +1051,14 @@ def create_presigned_url(bucket_name: str, object_name: str, expiration=3600) ->
 
 def get_files(bucket_name: str, user_session: dict):
     prefixes = load_user_lookup(user_session)
-    app.logger.debug({"prefixes": prefixes})
+    log_lazy(app.logger, logging.DEBUG, lambda: {"prefixes": prefixes})
 
     file_keys = list_s3_bucket_matching_prefixes(bucket_name, prefixes)
 
     resp = []
 
     for file_key in file_keys:
-        app.logger.info(
-            "User {}: file_key: {}".format(user_session["user"], file_key["key"])
-        )
+        app.logger.info("User %s: file_key: %s", user_session["user"], file_key["key"])
 
         url_string = f"/download/{file_key['key']}"
         file_key["url"] = url_string
@@ -605,7 +1071,7 @@ def get_files(bucket_name: str, user_session: dict):
 
 def get_upload_history(bucket_name: str, user_session: dict) -> list:
     prefixes = user_custom_paths(user_session, True)
-    app.logger.debug({"prefixes": prefixes})
+    log_lazy(app.logger, logging.DEBUG, lambda: {"prefixes": prefixes})
 
     file_keys = list_s3_bucket_matching_prefixes(bucket_name, prefixes)
     file_keys = list(
@@ -645,65 +1111,6 @@ def list_s3_bucket_matching_prefixes(bucket_name, prefixes):
     return file_keys[:max_files_to_display]
 
 
-def categorise_file(file_item, prefix):
-    """
-    Take paths after the file prefix
-    and words of the file name and
-    join into a single category string
-    """
-    key = file_item["Key"]
-    file_path = key.replace(prefix, "")
-    # remove empty strings from starting or trailing slashes
-    path_steps = list(filter(lambda folder: folder != "", file_path.split("/")))
-    full_file_name = path_steps.pop()
-    file_category = get_file_name_category(full_file_name)
-    if file_category != "":
-        path_steps.append(file_category)
-
-    categories = [re_case_word(re.sub(r"[-_]", " ", word)) for word in path_steps]
-
-    joined_category = " > ".join(categories)
-    if joined_category == "":
-        joined_category = "Daily Incoming Data"
-
-    app.logger.debug({"categories": categories, "joined": joined_category})
-    file_item["Category"] = joined_category
-    file_item["Categories"] = categories
-    return file_item
-
-
-def get_file_name_category(file_name):
-    """
-    Strip any numeric strings from the file name
-    and convert to space delimited string for
-    rendering
-    """
-    # remove file extension
-    file_name = " ".join(file_name.split(".")[:-1])
-
-    file_name_words = re.split("[-_]", file_name)
-    # remove numeric strings
-    file_category_words = filter(
-        lambda word: not re.match("^[0-9]+$", word), file_name_words
-    )
-
-    file_category = " ".join(file_category_words)
-    return file_category
-
-
-def re_case_word(word):
-    """
-    Title case word unless known initialism which should be upper
-    """
-    initialisms = ["DWP", "NHS", "MHCLG", "GDS"]
-
-    if word.upper() in initialisms:
-        re_cased = word.upper()
-    else:
-        re_cased = word.title()
-    return re_cased
-
-
 def date_file(file_item):
     """
     Add Show_Date and Sort_Date as strings
@@ -713,7 +1120,11 @@ def date_file(file_item):
     file_item["ShowTime"] = file_item["LastModified"].strftime("%H:%M")
     file_item["SortDate"] = file_item["LastModified"].strftime("%Y%m%d")
     file_item["SortTime"] = file_item["LastModified"].strftime("%Y%m%d%H%M")
-    app.logger.debug({"date": file_item["SortDate"], "time": file_item["SortTime"]})
+    log_lazy(
+        app.logger,
+        logging.DEBUG,
+        lambda: {"date": file_item["SortDate"], "time": file_item["SortTime"]},
+    )
     return file_item
 
 
@@ -727,31 +1138,12 @@ def collect_files_by_date(file_items):
 
 
 def return_attribute(session: dict, get_attribute: str) -> str:
-    if "attributes" in session:
-        for attribute in session["attributes"]:
-            app.logger.debug(attribute["Name"])
-            if "Name" in attribute:
-                if attribute["Name"] == get_attribute:
-                    return attribute["Value"]
-    return ""
+    return get_access_profile(session).attributes.get(get_attribute, "")
 
 
 def user_custom_paths(session, is_upload=False):
-    # paths = []
-
-    app_download_path = config.get("bucket_main_prefix", "web-app-prod-data")
-    app_upload_path = config.get("bucket_upload_prefix", "web-app-upload")
-
-    user_paths_attribute = return_attribute(session, "custom:paths")
-    user_paths = user_paths_attribute.split(";")
-
-    user_paths = [
-        path.replace(app_download_path, app_upload_path) if is_upload else path
-        for path in user_paths
-        if path.startswith(app_download_path)
-    ]
-
-    return user_paths
+    profile = get_access_profile(session)
+    return list(profile.upload_prefixes if is_upload else profile.download_prefixes)
 
 
 def load_user_lookup(session):
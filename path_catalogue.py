@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+The catalogue of S3 folders users can be granted, from s3paths.json.
+
+The file is a list of access types each with the folders of
+that type:
+
+    [{"type": "local_authority", "main": "...",
+      "subs": [{"disp": "Barnet", "val": "web-app-prod-data/..."}]}]
+
+PathCatalogue indexes the folders by type and by path value.
+It checks the file's mtime and size at most every
+CHECK_SECONDS and only reads it again when they change. The
+content is hashed so rewriting the same catalogue doesn't
+reload it. A new version is validated before it replaces the
+current one, so a bad edit keeps the last good catalogue in
+use rather than emptying the admin forms.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from logger import LOG
+
+S3PATHS_FILE = "s3paths.json"
+
+CHECK_SECONDS = 5
+
+
+def validate_catalogue(catalogue):
+    """ Return a list of the problems with a parsed s3paths.json """
+    if not isinstance(catalogue, list):
+        return ["The catalogue is not a list of access types."]
+
+    errors = []
+    seen_values = set()
+    for index, entry in enumerate(catalogue):
+        if not isinstance(entry, dict):
+            errors.append(f"Entry {index} is not an object.")
+            continue
+        for field in ["type", "main"]:
+            if not isinstance(entry.get(field), str):
+                errors.append(f"Entry {index} has no {field}.")
+        if not isinstance(entry.get("subs"), list):
+            errors.append(f"Entry {index} has no subs list.")
+            continue
+        for sub in entry["subs"]:
+            if not (
+                isinstance(sub, dict)
+                and isinstance(sub.get("disp"), str)
+                and isinstance(sub.get("val"), str)
+            ):
+                errors.append(f"Entry {index} has a sub without disp and val.")
+            elif sub["val"] in seen_values:
+                errors.append(f"{sub['val']} appears more than once.")
+            else:
+                seen_values.add(sub["val"])
+    return errors
+
+
+class PathCatalogue:
+    def __init__(self, path=S3PATHS_FILE, check_seconds=CHECK_SECONDS):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.checked_at = None
+        self.file_stat = None
+        self.digest = None
+        self.version = 0
+        self.entries = []
+        self.by_type = {}
+        self.by_value = {}
+
+    def load(self, catalogue):
+        by_type = {}
+        by_value = {}
+        for entry in catalogue:
+            # The first entry of a type is the one the admin forms show
+            by_type.setdefault(entry["type"], entry)
+            for sub in entry["subs"]:
+                by_value[sub["val"]] = dict(sub, type=entry["type"])
+        # Readers outside the lock see the old or new indexes
+        self.entries, self.by_type, self.by_value = catalogue, by_type, by_value
+        self.version += 1
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self):
+        """ Reload the catalogue if the file has changed """
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.checked_at is not None
+                and now - self.checked_at < self.check_seconds
+            ):
+                return
+            self.checked_at = now
+
+            file_stat = self.stat()
+            if file_stat == self.file_stat:
+                return
+            self.file_stat = file_stat
+            if file_stat is None:
+                LOG.error({"action": "path_catalogue.refresh", "error": "No catalogue"})
+                return
+
+            with open(self.path, "rb") as catalogue_file:
+                content = catalogue_file.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if digest == self.digest:
+                return
+
+            try:
+                catalogue = json.loads(content)
+                errors = validate_catalogue(catalogue)
+            except ValueError as error:
+                errors = [str(error)]
+            if errors:
+                LOG.error({"action": "path_catalogue.refresh", "errors": errors})
+                return
+
+            self.digest = digest
+            self.load(catalogue)
+            LOG.info(
+                {
+                    "action": "path_catalogue.refresh",
+                    "version": self.version,
+                    "folders": len(self.by_value),
+                }
+            )
+
+    def get_entries(self):
+        self.refresh()
+        return self.entries
+
+    def entry_for_type(self, path_type):
+        """ Return the access type with its subs or [] if there isn't one """
+        self.refresh()
+        return self.by_type.get(path_type, [])
+
+    def folder(self, path_value):
+        self.refresh()
+        return self.by_value.get(path_value)
+
+
+CATALOGUE = PathCatalogue()
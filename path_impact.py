@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Which users a change to s3paths.json affects.
+
+Reports come from the user directory's index of granted paths
+so they don't walk the user pool:
+
+- the users holding a folder that is being renamed or retired
+- the orphaned paths, granted paths which are no longer in
+  any catalogue folder, and the users holding them
+
+From the command line:
+
+    python path_impact.py --environment staging --path web-app-prod-data/other/nhs
+    python path_impact.py --environment staging --orphaned
+"""
+import argparse
+import sys
+
+from access_policy import get_access_policy
+import config
+import user_directory
+
+
+def affected_users(path):
+    """ Return the users holding path or a folder in it, by granted path """
+    return user_directory.path_holders(path)
+
+
+def orphaned_paths():
+    """ Return the granted paths outside the catalogue and who holds them """
+    policy = get_access_policy()
+    return {
+        path: emails
+        for path, emails in user_directory.granted_paths().items()
+        if policy.owner(path) is None
+    }
+
+
+def report_lines(holders):
+    for path, emails in holders.items():
+        for email in emails:
+            yield f"{path}\t{email}\n"
+
+
+def run(argv=None):
+    """
+    Print each affected path and user a line at a time
+    """
+    parser = argparse.ArgumentParser(description="Report users affected by paths")
+    report = parser.add_mutually_exclusive_group(required=True)
+    report.add_argument("--path", help="report the users holding this folder")
+    report.add_argument(
+        "--orphaned", action="store_true", help="report paths outside s3paths.json"
+    )
+    parser.add_argument("--environment", default="testing")
+    args = parser.parse_args(argv)
+
+    if not config.setup_command_line(args.environment):
+        return 1
+
+    user_directory.sync_if_stale()
+    holders = orphaned_paths() if args.orphaned else affected_users(args.path)
+    sys.stdout.writelines(report_lines(holders))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
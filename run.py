@@ -1,5 +1,7 @@
 import os
+import signal
 
+from logger import exit_on_sigterm
 import config
 from main import app
 
@@ -11,6 +13,8 @@ def run():
     config.load_environment(app)
     settings_loaded = config.load_settings(app)
     if settings_loaded:
+        # Cloud Foundry stops the app with SIGTERM
+        signal.signal(signal.SIGTERM, exit_on_sigterm)
         app.run(host="0.0.0.0", port=os.getenv("PORT", "8000"))
     else:
         green_char = "\033[92m"
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Server side sessions.
+
+Flask's default session is kept in a signed cookie which holds
+everything put in the session and is sent, and verified, on
+every request. With a server side session the cookie only
+holds a random session id and the session data is kept in a
+SessionStore.
+
+FilesystemSessionStore and SQLiteSessionStore keep sessions on
+local disk so only suit a single node. A store shared between
+nodes only has to implement the four SessionStore methods.
+
+The session id is replaced with regenerate_session when a user
+logs in or out so an id known before login, for example one
+planted in the user's browser, can't be used after it.
+
+Sessions expire lifetime seconds after they were last saved.
+Sessions more than half way to expiring are saved again when
+used, and expired sessions are swept from the store at most
+once every sweep_seconds by each process.
+"""
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from flask import current_app, session
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{43}")
+
+SESSION_LIFETIME_SECONDS = 12 * 60 * 60
+
+SESSION_SWEEP_SECONDS = 5 * 60
+
+# Static files are served without reading the session
+SESSIONLESS_PATH_PREFIXES = (
+    "/js/",
+    "/css/",
+    "/dist/",
+    "/assets/",
+    "/resources/",
+    "/favicon.ico",
+    "/apple-touch-icon",
+    "/robots.txt",
+    "/browserconfig.xml",
+)
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class SessionStore(ABC):
+    """
+    Interface for somewhere to keep session data
+
+    data is the serialised session and expires
+    a unix time after which it is discarded.
+    """
+
+    @abstractmethod
+    def load(self, session_id):
+        """ Return (data, expires) or None if there is no live session """
+
+    @abstractmethod
+    def save(self, session_id, data, expires):
+        pass
+
+    @abstractmethod
+    def delete(self, session_id):
+        pass
+
+    @abstractmethod
+    def sweep(self, now):
+        """ Remove sessions expired by now and return how many there were """
+
+
+class FilesystemSessionStore(SessionStore):
+    """ A file per session holding its expiry time then its data """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_id):
+        return os.path.join(self.directory, session_id)
+
+    def read(self, path):
+        with open(path) as session_file:
+            expires = float(session_file.readline())
+            return session_file.read(), expires
+
+    def load(self, session_id):
+        try:
+            data, expires = self.read(self.path(session_id))
+        except (FileNotFoundError, ValueError):
+            return None
+        return (data, expires) if expires > time.time() else None
+
+    def save(self, session_id, data, expires):
+        path = self.path(session_id)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as session_file:
+            session_file.write(f"{expires}\n{data}")
+        os.replace(temp_path, path)
+
+    def delete(self, session_id):
+        try:
+            os.remove(self.path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, now):
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if not SESSION_ID_PATTERN.fullmatch(entry.name):
+                continue
+            try:
+                _, expires = self.read(entry.path)
+                if expires <= now:
+                    os.remove(entry.path)
+                    removed += 1
+            except (FileNotFoundError, ValueError):
+                continue
+        return removed
+
+
+class SQLiteSessionStore(SessionStore):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+        finally:
+            connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def execute(self, query, parameters):
+        connection = self.connect()
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchone()
+        finally:
+            connection.close()
+
+    def load(self, session_id):
+        row = self.execute(
+            "SELECT data, expires FROM sessions WHERE id = ? AND expires > ?",
+            [session_id, time.time()],
+        )
+        return tuple(row) if row else None
+
+    def save(self, session_id, data, expires):
+        self.execute(
+            "INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+            [session_id, data, expires],
+        )
+
+    def delete(self, session_id):
+        self.execute("DELETE FROM sessions WHERE id = ?", [session_id])
+
+    def sweep(self, now):
+        connection = self.connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    "DELETE FROM sessions WHERE expires <= ?", [now]
+                )
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.session_id = session_id or new_session_id()
+        self.new = new
+        self.modified = False
+        self.needs_refresh = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def __init__(
+        self,
+        store,
+        lifetime_seconds=SESSION_LIFETIME_SECONDS,
+        sweep_seconds=SESSION_SWEEP_SECONDS,
+    ):
+        self.store = store
+        self.lifetime_seconds = lifetime_seconds
+        self.sweep_seconds = sweep_seconds
+        self.last_swept = 0
+        self.sweep_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        if request.path.startswith(SESSIONLESS_PATH_PREFIXES):
+            return None
+
+        session_id = request.cookies.get(app.session_cookie_name, "")
+        # Ids the store never issued are replaced rather than adopted
+        if SESSION_ID_PATTERN.fullmatch(session_id):
+            stored = self.store.load(session_id)
+            if stored is not None:
+                data, expires = stored
+                session = ServerSideSession(self.serializer.loads(data), session_id)
+                remaining = expires - time.time()
+                session.needs_refresh = remaining < self.lifetime_seconds / 2
+                return session
+        return ServerSideSession(new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.store.delete(session.session_id)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path
+                )
+            return
+
+        if not (session.modified or session.needs_refresh):
+            return
+
+        self.store.save(
+            session.session_id,
+            self.serializer.dumps(dict(session)),
+            time.time() + self.lifetime_seconds,
+        )
+        self.sweep_if_due()
+        if session.new:
+            response.set_cookie(
+                app.session_cookie_name,
+                session.session_id,
+                domain=domain,
+                path=path,
+                httponly=self.get_cookie_httponly(app),
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def regenerate(self, session):
+        """ Move session to a new id, removing its old one from the store """
+        if not session.new:
+            self.store.delete(session.session_id)
+        session.session_id = new_session_id()
+        session.new = True
+        session.modified = True
+
+    def sweep_if_due(self):
+        now = time.time()
+        if now - self.last_swept < self.sweep_seconds:
+            return 0
+        if not self.sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            self.last_swept = now
+            return self.store.sweep(now)
+        finally:
+            self.sweep_lock.release()
+
+
+def regenerate_session():
+    """
+    Give the current session a new id if it is kept server side
+
+    A cookie session has no id to fix as its content is the cookie.
+    """
+    if isinstance(current_app.session_interface, ServerSideSessionInterface):
+        current_app.session_interface.regenerate(session)
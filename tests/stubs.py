@@ -1,7 +1,10 @@
 # """ Create mock boto3 clients for testing """
+import io
+import json
 from datetime import datetime
 
 import boto3
+from botocore.response import StreamingBody
 from botocore.stub import Stubber
 
 from logger import LOG
@@ -49,11 +52,10 @@ def mock_cognito_auth_flow(token, test_user):
 
     # Add responses
     stub_response_cognito_get_user(stubber, token, test_user)
-    stub_response_cognito_admin_list_groups_for_user(stubber, test_user["Username"])
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -76,7 +78,7 @@ def mock_cognito_create_user(admin_user, create_user_arguments):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -108,7 +110,7 @@ def mock_cognito_create_user_set_mfa_fails(admin_user, create_user_arguments):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -140,7 +142,7 @@ def mock_cognito_create_user_set_user_settings_fails(admin_user, create_user_arg
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -172,7 +174,7 @@ def mock_cognito_create_user_add_user_to_group_fails(admin_user, create_user_arg
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -187,7 +189,7 @@ def mock_cognito_list_pools(env="testing"):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -207,7 +209,7 @@ def mock_cognito_admin_create_user(user, arguments):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -224,7 +226,7 @@ def mock_cognito_admin_update_user_attributes(user, attributes):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -239,7 +241,7 @@ def mock_cognito_admin_delete_user(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -254,7 +256,29 @@ def mock_cognito_admin_disable_user(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_cognito_admin_disable_user_throttled(email, throttled_calls, succeeds=True):
+    _keep_it_real()
+    client = boto3.real_client("cognito-idp")
+
+    stubber = Stubber(client)
+
+    # Add responses
+    for _ in range(throttled_calls):
+        stubber.add_client_error(
+            "admin_disable_user",
+            service_error_code="TooManyRequestsException",
+            http_status_code=400,
+        )
+    if succeeds:
+        stub_response_cognito_admin_disable_user(stubber, email)
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -269,7 +293,7 @@ def mock_cognito_admin_enable_user(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -284,7 +308,7 @@ def mock_cognito_admin_set_user_settings(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -298,7 +322,7 @@ def mock_cognito_admin_set_user_mfa_preference(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -313,7 +337,7 @@ def mock_cognito_admin_add_user_to_group(email, group_name):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -328,7 +352,25 @@ def mock_cognito_admin_remove_user_from_group(email, group_name):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_user_set_group(email, current_group_name, new_group_name):
+    _keep_it_real()
+    client = boto3.real_client("cognito-idp")
+
+    stubber = Stubber(client)
+
+    # Add responses
+    stub_response_cognito_admin_remove_user_from_group(
+        stubber, email, current_group_name
+    )
+    stub_response_cognito_admin_add_user_to_group(stubber, email, new_group_name)
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -343,7 +385,7 @@ def mock_cognito_admin_get_user(email, admin_get_user):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -358,7 +400,7 @@ def mock_cognito_admin_list_groups_for_user(admin_user):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -375,7 +417,68 @@ def mock_user_get_details(email, admin_get_user):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_user_list(arguments, response, group_members):
+    _keep_it_real()
+    client = boto3.real_client("cognito-idp")
+
+    stubber = Stubber(client)
+
+    # Add responses
+    stubber.add_response("list_users", response, arguments)
+    for group_name, usernames in group_members.items():
+        stub_response_cognito_list_users_in_group(stubber, group_name, usernames)
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_user_list_pages(arguments, responses, group_members):
+    _keep_it_real()
+    client = boto3.real_client("cognito-idp")
+
+    stubber = Stubber(client)
+
+    # Add responses
+    # The group map is swept once, for the first page with users
+    token = None
+    swept = False
+    for response in responses:
+        page_arguments = dict(arguments)
+        if token:
+            page_arguments["PaginationToken"] = token
+        stubber.add_response("list_users", response, page_arguments)
+        if response["Users"] and not swept:
+            for group_name, usernames in group_members.items():
+                stub_response_cognito_list_users_in_group(
+                    stubber, group_name, usernames
+                )
+            swept = True
+        token = response.get("PaginationToken")
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_cognito_list_users_in_group(group_name, usernames):
+    _keep_it_real()
+    client = boto3.real_client("cognito-idp")
+
+    stubber = Stubber(client)
+
+    # Add responses
+    stub_response_cognito_list_users_in_group(stubber, group_name, usernames)
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -393,7 +496,7 @@ def mock_user_not_found(email):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -410,7 +513,7 @@ def mock_user_update(email, admin_get_user, attributes):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -440,7 +543,7 @@ def mock_user_reinvite(admin_user, admin_get_user, create_user_arguments):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -466,7 +569,7 @@ def mock_delete_user_failure(admin_user, admin_get_user):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -491,7 +594,7 @@ def mock_create_user_failure(admin_user, admin_get_user, create_user_arguments):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -508,7 +611,7 @@ def mock_config_set_app_settings(parameters):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -523,7 +626,7 @@ def mock_config_load_ssm_parameters(path, parameters):
 
     stubber.activate()
     # override boto.client to return the mock client
-    boto3.client = lambda service, region_name=None: client
+    boto3.client = lambda service, region_name=None, config=None: client
     return stubber
 
 
@@ -729,6 +832,17 @@ def stub_response_cognito_admin_list_groups_for_user(stubber, email):
     )
 
 
+def stub_response_cognito_list_users_in_group(stubber, group_name, usernames):
+    mock_list_users_in_group = {
+        "Users": [{"Username": username} for username in usernames]
+    }
+    stubber.add_response(
+        "list_users_in_group",
+        mock_list_users_in_group,
+        {"UserPoolId": MOCK_COGNITO_USER_POOL_ID, "GroupName": group_name},
+    )
+
+
 def stub_response_cognito_admin_create_user(stubber, admin_user, create_user_arguments):
     mock_admin_create_user = {
         "User": {
@@ -902,6 +1016,111 @@ def mock_s3_get_object(bucket_name, granted_prefixes, key, success_response):
     return stubber
 
 
+def mock_s3_find_duplicate_upload(
+    bucket_name, index_key, stored_key=None, stored_checksum=None
+):
+    _keep_it_real()
+    client = boto3.real_client("s3")
+
+    stubber = Stubber(client)
+
+    if stored_key is None:
+        stubber.add_client_error(
+            "get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": bucket_name, "Key": index_key},
+        )
+    else:
+        stub_response_s3_get_object_body(
+            stubber, bucket_name, index_key, json.dumps({"url": stored_key})
+        )
+        metadata = {"sha256": stored_checksum} if stored_checksum else {}
+        stubber.add_response(
+            "head_object",
+            {"ContentLength": 100, "Metadata": metadata},
+            {"Bucket": bucket_name, "Key": stored_key},
+        )
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_s3_get_object_range(bucket_name, key, body, max_bytes=64 * 1024):
+    _keep_it_real()
+    client = boto3.real_client("s3")
+
+    stubber = Stubber(client)
+
+    # S3 returns at most the requested range
+    stub_response_s3_get_object_body(
+        stubber,
+        bucket_name,
+        key,
+        body[:max_bytes],
+        {"Range": "bytes=0-{}".format(max_bytes - 1)},
+    )
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_s3_get_objects(bucket_name, bodies):
+    _keep_it_real()
+    client = boto3.real_client("s3")
+
+    stubber = Stubber(client)
+
+    for key, body in bodies.items():
+        stub_response_s3_get_object_body(stubber, bucket_name, key, body)
+
+    stubber.activate()
+    # override boto.client to return the mock client
+    boto3.client = lambda service, region_name=None, config=None: client
+    return stubber
+
+
+def mock_s3_find_previous_file(bucket_name, key, contents):
+    _keep_it_real()
+    client = boto3.real_client("s3")
+
+    stubber = Stubber(client)
+
+    new_file = next(item for item in contents if item["Key"] == key)
+    stubber.add_response(
+        "head_object",
+        {"LastModified": new_file["LastModified"]},
+        {"Bucket": bucket_name, "Key": key},
+    )
+    stubber.add_response(
+        "list_objects",
+        {"Contents": contents},
+        {
+            "Bucket": bucket_name,
+            "Prefix": key.rsplit("/", 1)[0] + "/",
+            "Delimiter": "/",
+        },
+    )
+
+    stubber.activate()
+    return stubber, client
+
+
+def stub_response_s3_get_object_body(stubber, bucket_name, key, body, params=None):
+    encoded = body.encode("utf-8")
+    mock_get_object = {
+        "Body": StreamingBody(io.BytesIO(encoded), len(encoded)),
+        "LastModified": datetime.utcnow(),
+    }
+    expected_params = {"Bucket": bucket_name, "Key": key}
+    expected_params.update(params or {})
+    stubber.add_response("get_object", mock_get_object, expected_params)
+
+
 def fake_url(bucket, key):
     url = (
         f"https://{bucket}.s3.amazonaws.com/{key}"
@@ -0,0 +1,61 @@
+import pytest
+
+from access_policy import AccessPolicy
+
+CATALOGUE = [
+    {
+        "type": "local_authority",
+        "main": "web-app-prod-data/local_authority",
+        "subs": [
+            {"disp": "Barnet", "val": "web-app-prod-data/local_authority/barnet"},
+            {"disp": "Haringey", "val": "web-app-prod-data/local_authority/haringey"},
+        ],
+    },
+    {
+        "type": "other",
+        "main": "web-app-prod-data/other",
+        "subs": [{"disp": "NHS", "val": "web-app-prod-data/other/nhs"}],
+    },
+]
+
+
+@pytest.fixture()
+def policy():
+    return AccessPolicy(CATALOGUE, "web-app-prod-data", "web-app-upload")
+
+
+def test_path_is_valid(policy):
+    assert policy.path_is_valid(True, "web-app-prod-data/local_authority/barnet")
+    assert not policy.path_is_valid(False, "web-app-prod-data/local_authority/barnet")
+    assert policy.path_is_valid(False, "web-app-prod-data/other/nhs")
+    assert not policy.path_is_valid(True, "web-app-prod-data/other/nhs")
+    # A local_authority folder outside the main prefix isn't an LA path
+    assert not policy.path_is_valid(True, "web-app-upload/local_authority/barnet")
+    assert not policy.path_is_valid(True, "")
+    assert not policy.path_is_valid(False, "")
+
+    paths = ["web-app-prod-data/local_authority/barnet", "web-app-prod-data/other/nhs"]
+    assert policy.invalid_paths(True, paths) == ["web-app-prod-data/other/nhs"]
+
+
+def test_upload_paths(policy):
+    paths = [
+        "web-app-prod-data/local_authority/barnet",
+        "web-app-nonprod-data/local_authority/barnet",
+        "",
+    ]
+    assert policy.download_paths(paths) == ["web-app-prod-data/local_authority/barnet"]
+    assert (
+        policy.upload_path("web-app-prod-data/local_authority/barnet")
+        == "web-app-upload/local_authority/barnet"
+    )
+
+
+def test_owner(policy):
+    owner = policy.owner("web-app-prod-data/local_authority/barnet/2020/people.csv")
+    assert owner["disp"] == "Barnet"
+    assert owner["type"] == "local_authority"
+    assert policy.owner("web-app-prod-data/other/nhs")["disp"] == "NHS"
+    # Folders only match whole path segments
+    assert policy.owner("web-app-prod-data/local_authority/barnetx/people.csv") is None
+    assert policy.owner("web-app-prod-data/other/gds/people.csv") is None
@@ -0,0 +1,44 @@
+import pytest
+
+from access_profile import build_access_profile, get_access_profile
+from main import app
+
+
+@pytest.mark.usefixtures("test_upload_session")
+def test_build_access_profile(test_upload_session):
+    profile = build_access_profile(
+        test_upload_session["attributes"], test_upload_session["group"]
+    )
+    assert profile["attributes"]["custom:is_la"] == "1"
+    assert profile["download_prefixes"] == [
+        "web-app-prod-data/local_authority/haringey",
+        "web-app-prod-data/local_authority/barnet",
+    ]
+    assert profile["upload_prefixes"] == [
+        "web-app-upload/local_authority/haringey",
+        "web-app-upload/local_authority/barnet",
+    ]
+    assert profile["is_la"]
+    assert profile["can_upload"]
+    assert not profile["is_admin"]
+
+
+@pytest.mark.usefixtures("test_session")
+def test_get_access_profile(test_session):
+    test_session["access_profile"] = build_access_profile(
+        test_session["attributes"], test_session["group"]
+    )
+    # The attribute list isn't read once there is a profile
+    test_session["attributes"] = []
+
+    with app.test_request_context("/files"):
+        profile = get_access_profile(test_session)
+        assert get_access_profile(test_session) is profile
+        assert profile.attributes["custom:is_la"] == "1"
+        assert not profile.can_upload
+        with pytest.raises(TypeError):
+            profile.attributes["custom:is_la"] = "0"
+
+        # A replaced profile is picked up
+        test_session["access_profile"] = build_access_profile([], None)
+        assert get_access_profile(test_session).download_prefixes == ()
@@ -1,8 +1,11 @@
+import io
 from unittest.mock import patch
 
 import pytest
 from werkzeug.datastructures import ImmutableMultiDict
 
+import admin
+import bulk_users
 import stubs
 from admin import (
     parse_edit_form_fields,
@@ -193,3 +196,332 @@ def test_route_admin_user_edit(
         assert body_has_element_with_attributes(
             body, {"name": "telephone-number", "value": admin_user["phone_number"]}
         )
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_bulk_jobs_refused_on_lambda(
+    test_client, test_admin_session, monkeypatch
+):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "admin")
+
+    with patch("bulk_users.create_users") as mocked_create_users:
+        response = test_client.post("/admin/user/bulk", data={})
+        mocked_create_users.assert_not_called()
+    assert "BULK_JOB_BUCKET" in response.data.decode()
+
+    with patch("bulk_users.find_users") as mocked_find_users:
+        response = test_client.post(
+            "/admin/user/bulk/update",
+            data={"task": "find", "domain": "nhs.net", "action": "disable"},
+        )
+        mocked_find_users.assert_not_called()
+    assert "BULK_JOB_BUCKET" in response.data.decode()
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session", "bulk_job_dir")
+def test_route_admin_bulk_create_users(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    csv_content = (
+        "email,name,phone,is_la,group,paths\n"
+        "new.user@communities.gov.uk,New User,07700900123,no,standard-download,"
+        "web-app-prod-data/other/gds\n"
+    )
+    with patch("bulk_users.User.create") as mocked_user_create:
+        mocked_user_create.return_value = True
+        response = test_client.post(
+            "/admin/user/bulk",
+            data={"users_csv": (io.BytesIO(csv_content.encode()), "users.csv")},
+            content_type="multipart/form-data",
+        )
+        mocked_user_create.assert_called_once_with(
+            "New User",
+            "+447700900123",
+            "web-app-prod-data/other/gds",
+            "0",
+            "standard-download",
+        )
+    assert response.status_code == 302
+    job_url = response.headers["Location"]
+    job_id = job_url.split("job=")[1]
+
+    response = test_client.get(f"/admin/user/bulk?job={job_id}")
+    assert response.status_code == 200
+    assert "1 created, 0 failed" in flatten_html(response.data.decode())
+
+    response = test_client.get(f"/admin/user/bulk/report?job={job_id}")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert response.data.decode().splitlines()[1].endswith(",created,")
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session", "bulk_job_dir")
+def test_route_admin_bulk_create_users_continues(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    items = [
+        {"email": f"user{i}@communities.gov.uk", "group": "standard-download"}
+        for i in range(2)
+    ]
+    job = bulk_users.new_job("create", items, "admin-user")
+    job["items"][0]["status"] = "created"
+    bulk_users.save_job(job)
+
+    response = test_client.get(f"/admin/user/bulk?job={job['id']}")
+    flat = flatten_html(response.data.decode())
+    assert "1 still to create" in flat
+    assert "data-auto-continue" in response.data.decode()
+
+    with patch("bulk_users.create_user_item") as mocked_create_user_item:
+        mocked_create_user_item.side_effect = lambda item: bulk_users.set_item_result(
+            item, False, "created", "Failed to create user."
+        )
+        response = test_client.post(
+            "/admin/user/bulk", data={"task": "run", "job": job["id"]}
+        )
+        assert mocked_create_user_item.call_count == 1
+    assert response.status_code == 302
+
+    response = test_client.get(f"/admin/user/bulk?job={job['id']}")
+    flat = flatten_html(response.data.decode())
+    assert "1 created, 1 failed" in flat
+    assert "Retry failed users" in flat
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_bulk_create_users_invalid(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    csv_content = (
+        "email,name,phone,is_la,group,paths\n"
+        "someone@example.com,Someone,07700900123,no,standard-download,"
+        "web-app-prod-data/other/gds\n"
+    )
+    with patch("bulk_users.User.create") as mocked_user_create:
+        response = test_client.post(
+            "/admin/user/bulk",
+            data={"users_csv": (io.BytesIO(csv_content.encode()), "users.csv")},
+            content_type="multipart/form-data",
+        )
+        mocked_user_create.assert_not_called()
+    body = response.data.decode()
+    assert response.status_code == 200
+    assert "No users were created" in body
+    assert "Line 2 (someone@example.com): Email address is invalid." in body
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session", "bulk_job_dir")
+def test_route_admin_bulk_update_users(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    users = [
+        {"email": "a@supplier.co.uk", "group": {"value": "standard-download"}},
+        {"email": "b@supplier.co.uk", "group": {"value": "standard-download"}},
+    ]
+    with patch("bulk_users.find_users", return_value=users) as mocked_find_users:
+        response = test_client.post(
+            "/admin/user/bulk/update",
+            data={"task": "find", "domain": "Supplier.co.uk", "action": "disable"},
+        )
+        mocked_find_users.assert_called_once_with(
+            domain="supplier.co.uk", group_name="", path_prefix=""
+        )
+    assert response.status_code == 302
+    job_id = response.headers["Location"].split("job=")[1]
+
+    response = test_client.get(f"/admin/user/bulk/update?job={job_id}")
+    flat = flatten_html(response.data.decode())
+    assert "0 of 2 users processed" in flat
+    assert "Apply to 2 users" in flat
+
+    with patch("bulk_users.User.disable", return_value=True) as mocked_disable:
+        response = test_client.post(
+            "/admin/user/bulk/update", data={"task": "run", "job": job_id}
+        )
+        assert mocked_disable.call_count == 2
+    assert response.status_code == 302
+
+    response = test_client.get(f"/admin/user/bulk/update?job={job_id}")
+    flat = flatten_html(response.data.decode())
+    assert "2 of 2 users processed" in flat
+    assert "Continue" not in flat
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_bulk_update_users_needs_a_filter(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    with patch("bulk_users.find_users") as mocked_find_users:
+        response = test_client.post(
+            "/admin/user/bulk/update", data={"task": "find", "action": "disable"}
+        )
+        mocked_find_users.assert_not_called()
+    assert response.status_code == 200
+    assert "Fill in at least one filter." in response.data.decode()
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session", "user_directory_path")
+def test_route_admin_search_users(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    user = {
+        "email": "la.user@haringey.gov.uk",
+        "enabled": True,
+        "phone_number_verified": "false",
+        "group": {"value": "standard-download", "display": "Standard download user"},
+    }
+    with patch("user_directory.sync_if_stale") as mocked_sync_if_stale, patch(
+        "user_directory.search_users", return_value=[user]
+    ) as mocked_search_users:
+        response = test_client.get(
+            "/admin/user/search?domain=haringey.gov.uk&is_la=yes&phone_unverified=yes"
+        )
+        mocked_sync_if_stale.assert_called_once_with()
+        mocked_search_users.assert_called_once_with(
+            email_prefix="",
+            domain="haringey.gov.uk",
+            group_name="",
+            is_la=True,
+            path_prefix="",
+            phone_unverified=True,
+        )
+    body = response.data.decode()
+    assert response.status_code == 200
+    assert 'href="/admin/user?email=la.user%40haringey.gov.uk"' in body
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_path_impact(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    nhs_path = "web-app-prod-data/other/nhs"
+    with patch("user_directory.sync_if_stale") as mocked_sync_if_stale, patch(
+        "path_impact.affected_users", return_value={nhs_path: ["a.user@nhs.net"]}
+    ) as mocked_affected_users, patch(
+        "path_impact.orphaned_paths",
+        return_value={"web-app-prod-data/other/retired": ["c.user@dwp.gov.uk"]},
+    ):
+        response = test_client.get(f"/admin/user/path-impact?path={nhs_path}")
+        mocked_sync_if_stale.assert_called_once_with()
+        mocked_affected_users.assert_called_once_with(nhs_path)
+
+    body = response.data.decode()
+    assert response.status_code == 200
+    assert 'href="/admin/user?email=a.user%40nhs.net"' in body
+    assert "web-app-prod-data/other/retired" in body
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_export_users(test_client, test_admin_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    chunks = ['{"email": "a@nhs.net"}\n', '{"email": "b@nhs.net"}\n']
+    with patch(
+        "export_users.export_chunks", return_value=iter(chunks)
+    ) as mocked_export_chunks:
+        response = test_client.get("/admin/user/export?format=jsonl")
+        assert response.is_streamed
+        assert response.data.decode() == "".join(chunks)
+        mocked_export_chunks.assert_called_once_with("jsonl")
+    assert response.mimetype == "application/x-ndjson"
+    assert "attachment; filename=users-" in response.headers["Content-Disposition"]
+
+    # Unknown formats fall back to CSV
+    with patch("export_users.export_chunks", return_value=iter([])) as mocked:
+        response = test_client.get("/admin/user/export?format=xlsx")
+        mocked.assert_called_once_with("csv")
+    assert response.mimetype == "text/csv"
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session")
+def test_route_admin_export_users_on_lambda(
+    test_client, test_admin_session, monkeypatch
+):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "transfer-data-admin")
+
+    chunks = ['{"email": "a@nhs.net"}\n', '{"email": "b@nhs.net"}\n']
+    with patch("export_users.export_chunks", return_value=iter(chunks)):
+        response = test_client.get("/admin/user/export?format=jsonl")
+    assert response.data.decode() == "".join(chunks)
+
+    monkeypatch.setattr("export_users.LAMBDA_EXPORT_MAX_BYTES", len(chunks[0]))
+    with patch("export_users.export_chunks", return_value=iter(chunks)):
+        response = test_client.get("/admin/user/export?format=jsonl")
+    assert response.status_code == 500
+    assert "python export_users.py" in response.data.decode()
+
+
+@pytest.mark.usefixtures("serial_executor")
+def test_user_list_page_prefetches_next_page(serial_executor, monkeypatch):
+    monkeypatch.setattr(admin, "USER_LIST_EXECUTOR", serial_executor)
+    monkeypatch.setattr(admin, "USER_LIST_PREFETCH", {})
+    monkeypatch.setitem(config.CONFIG, "user_list_prefetch", "true")
+    pages = {
+        "": {"users": [{"email": "a@nhs.net"}], "token": "page-2"},
+        "page-2": {"users": [{"email": "b@nhs.net"}], "token": ""},
+    }
+
+    def user_list(email_starts_filter, token, limit):
+        return pages[token]
+
+    with patch("admin.User.list", side_effect=user_list) as mocked:
+        assert admin.user_list_page("", "", 20) == pages[""]
+        # The second page was fetched straight after the first
+        assert mocked.call_count == 2
+        assert admin.user_list_page("", "page-2", 20) == pages["page-2"]
+        assert mocked.call_count == 2
+        assert admin.USER_LIST_PREFETCH == {}
+
+        # A page fetched for a different filter or size isn't reused
+        admin.user_list_page("", "", 20)
+        admin.user_list_page("", "page-2", 40)
+        assert mocked.call_count == 5
+
+
+@pytest.mark.usefixtures("serial_executor")
+def test_user_list_page_prefetch_is_opt_in(serial_executor, monkeypatch):
+    monkeypatch.setattr(admin, "USER_LIST_EXECUTOR", serial_executor)
+    monkeypatch.setattr(admin, "USER_LIST_PREFETCH", {})
+    page = {"users": [{"email": "a@nhs.net"}], "token": "page-2"}
+
+    with patch("admin.User.list", return_value=page) as mocked:
+        assert admin.user_list_page("", "", 20) == page
+        assert mocked.call_count == 1
+
+        # Never on lambda, which freezes the container after the response
+        monkeypatch.setitem(config.CONFIG, "user_list_prefetch", "true")
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "transfer-data-admin")
+        assert admin.user_list_page("", "", 20) == page
+        assert mocked.call_count == 2
+    assert admin.USER_LIST_PREFETCH == {}
+
+
+@pytest.mark.usefixtures("test_client", "test_admin_session", "admin_user")
+def test_route_admin_list_users(test_client, test_admin_session, admin_user):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_admin_session)
+
+    page = {"users": [admin_user], "token": "next/token+1"}
+    with patch("admin.user_list_page", return_value=page) as mocked_user_list_page:
+        response = test_client.get("/admin/user/list?email=Admin&page_size=40")
+        mocked_user_list_page.assert_called_once_with("admin", "", 40)
+        body = response.data.decode()
+        assert response.status_code == 200
+        assert admin_user["email"] in body
+        assert "token=next/token%2B1" in body
+
+        # Unsupported page sizes fall back to the default
+        test_client.get("/admin/user/list?page_size=1000")
+        mocked_user_list_page.assert_called_with("", "", 20)
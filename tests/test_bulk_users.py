@@ -0,0 +1,345 @@
+import io
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+import bulk_users
+import config
+
+CSV_HEADER = "email,name,phone,is_la,group,paths\n"
+
+LA_PATH = "web-app-prod-data/local_authority/haringey"
+OTHER_PATH = "web-app-prod-data/other/gds"
+
+
+def valid_row(email="new.user@communities.gov.uk", **fields):
+    row = {
+        "email": email,
+        "name": "New User",
+        "phone": "07700 900123",
+        "is_la": "yes",
+        "group": "standard-download",
+        "paths": LA_PATH,
+    }
+    row.update(fields)
+    return row
+
+
+def test_read_users_csv():
+    content = (
+        "\ufeffEmail,Name,Phone,IS_LA,Group,Paths\n"
+        f"new.user@communities.gov.uk,New User,07700900123,yes,standard-download,"
+        f"{LA_PATH}\n"
+        ",,,,,\n"
+    ).encode("utf-8")
+    rows, errors = bulk_users.read_users_csv(content)
+    assert errors == []
+    assert rows == [
+        {
+            "email": "new.user@communities.gov.uk",
+            "name": "New User",
+            "phone": "07700900123",
+            "is_la": "yes",
+            "group": "standard-download",
+            "paths": LA_PATH,
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "content, error",
+    [
+        (b"\xff\xfe", "The file is not UTF-8 encoded text."),
+        (b"email,name\na@b.gov.uk,A\n", "Missing columns: phone, is_la, group, paths."),
+        (CSV_HEADER.encode(), "The file does not contain any users."),
+    ],
+)
+def test_read_users_csv_file_errors(content, error):
+    assert bulk_users.read_users_csv(content) == ([], [error])
+
+
+def test_read_users_csv_row_limit(monkeypatch):
+    monkeypatch.setattr(bulk_users, "BULK_MAX_ROWS", 2)
+    content = CSV_HEADER + "a@b.gov.uk,A,07700900123,no,admin-view,\n" * 3
+    rows, errors = bulk_users.read_users_csv(content.encode())
+    assert rows == []
+    assert errors == ["The file has more than 2 users."]
+
+
+def test_validate_users():
+    rows = [
+        valid_row(),
+        valid_row(email="other.user@communities.gov.uk", is_la="no", paths=LA_PATH),
+        valid_row(email="someone@example.com", phone="", group="superuser"),
+        valid_row(email=" New.User@communities.gov.uk "),
+    ]
+    items, invalid_rows = bulk_users.validate_users(rows)
+
+    assert items[0] == {
+        "email": "new.user@communities.gov.uk",
+        "name": "New User",
+        "phone": "+447700900123",
+        "is_la": "1",
+        "group": "standard-download",
+        "paths": LA_PATH,
+    }
+    assert invalid_rows == [
+        {
+            "line": 3,
+            "email": "other.user@communities.gov.uk",
+            "errors": ["The granted access permissions are not valid."],
+        },
+        {
+            "line": 4,
+            "email": "someone@example.com",
+            "errors": [
+                "Email address is invalid.",
+                "Phone number is empty.",
+                "Account type is not recognised.",
+            ],
+        },
+        {
+            "line": 5,
+            "email": " New.User@communities.gov.uk ",
+            "errors": ["Email address appears more than once."],
+        },
+    ]
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_create_users():
+    items, _ = bulk_users.validate_users(
+        [valid_row(), valid_row(email="other.user@communities.gov.uk")]
+    )
+
+    def create(user, name, phone_number, custom_paths, is_la, group_name):
+        return user.email_address == "new.user@communities.gov.uk"
+
+    with patch("bulk_users.User.create", autospec=True, side_effect=create):
+        job = bulk_users.create_users(items, "admin-user")
+
+    assert job["action"] == "create"
+    assert job["created_by"] == "admin-user"
+    assert [(item["email"], item["status"]) for item in job["items"]] == [
+        ("new.user@communities.gov.uk", "created"),
+        ("other.user@communities.gov.uk", "failed"),
+    ]
+    assert bulk_users.job_counts(job) == {"created": 1, "failed": 1}
+    assert bulk_users.load_job(job["id"]) == job
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_create_users_in_batches():
+    items, _ = bulk_users.validate_users(
+        [valid_row(), valid_row(email="other.user@communities.gov.uk")]
+    )
+
+    with patch("bulk_users.User.create", return_value=True) as mocked_create:
+        job = bulk_users.create_users(items, "admin-user", limit=1)
+        assert mocked_create.call_count == 1
+        assert bulk_users.job_counts(job) == {"created": 1, "pending": 1}
+
+        bulk_users.run_batch(bulk_users.load_job(job["id"]))
+        assert mocked_create.call_count == 2
+    assert bulk_users.job_counts(bulk_users.load_job(job["id"])) == {"created": 2}
+
+
+class FakeS3Client:
+    """ Keeps put objects in a dict """
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+def test_jobs_kept_in_s3(monkeypatch):
+    s3_client = FakeS3Client()
+    monkeypatch.setattr("bulk_users.boto3.client", lambda service: s3_client)
+    monkeypatch.setitem(config.CONFIG, "bulk_job_bucket", "job-bucket")
+
+    job = bulk_users.new_job("create", [valid_row()], "admin-user")
+    assert list(s3_client.objects) == [
+        ("job-bucket", f"bulk-user-jobs/{job['id']}.json")
+    ]
+    assert bulk_users.load_job(job["id"]) == job
+    assert bulk_users.load_job("0" * 32) == {}
+
+
+def test_bulk_jobs_available(monkeypatch):
+    assert bulk_users.bulk_jobs_available()
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "admin")
+    assert not bulk_users.bulk_jobs_available()
+    monkeypatch.setitem(config.CONFIG, "bulk_job_bucket", "job-bucket")
+    assert bulk_users.bulk_jobs_available()
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_load_job_rejects_invalid_ids():
+    assert bulk_users.load_job("../../etc/passwd") == {}
+    assert bulk_users.load_job("0" * 32) == {}
+
+
+def test_job_report_csv():
+    job = {
+        "action": "create",
+        "items": [
+            dict(
+                valid_row(),
+                status="failed",
+                message="Failed to create user.",
+            )
+        ],
+    }
+    assert bulk_users.job_report_csv(job).splitlines() == [
+        "email,name,phone,is_la,group,paths,status,message",
+        "new.user@communities.gov.uk,New User,07700 900123,yes,standard-download,"
+        f"{LA_PATH},failed,Failed to create user.",
+    ]
+
+
+def list_user(email, group_name="standard-download"):
+    return {
+        "email": email,
+        "group": {"value": group_name},
+        "custom:paths": LA_PATH,
+    }
+
+
+@pytest.mark.parametrize(
+    "filters, matches",
+    [
+        ({"domain": "communities.gov.uk"}, True),
+        ({"domain": "gov.uk"}, True),
+        ({"domain": "ities.gov.uk"}, False),
+        ({"group_name": "standard-download"}, True),
+        ({"group_name": "standard-upload"}, False),
+        ({"path_prefix": "web-app-prod-data/local_authority/"}, True),
+        ({"path_prefix": "web-app-prod-data/other/"}, False),
+        ({"domain": "gov.uk", "group_name": "admin-full"}, False),
+    ],
+)
+def test_user_matches(filters, matches):
+    user = list_user("new.user@communities.gov.uk")
+    assert bulk_users.user_matches(user, **filters) == matches
+
+
+def test_find_users():
+    users = [
+        list_user("a@communities.gov.uk"),
+        list_user("b@nhs.net"),
+        list_user("c@communities.gov.uk"),
+    ]
+    with patch("bulk_users.User.iter_users", return_value=iter(users)) as mocked:
+        users = bulk_users.find_users(domain="communities.gov.uk")
+        mocked.assert_called_once_with(limit=bulk_users.LIST_USERS_PAGE_SIZE)
+    assert [user["email"] for user in users] == [
+        "a@communities.gov.uk",
+        "c@communities.gov.uk",
+    ]
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_update_users_resumes_and_retries(monkeypatch):
+    users = [list_user(f"user{i}@communities.gov.uk") for i in range(4)]
+    filters = {"domain": "communities.gov.uk"}
+    job = bulk_users.new_update_job(
+        "disable", users, "user0@communities.gov.uk", filters
+    )
+    assert job["filters"] == filters
+    assert job["items"][0]["status"] == "skipped"
+
+    def disable(user):
+        return user.email_address != "user2@communities.gov.uk"
+
+    with patch("bulk_users.User.disable", autospec=True, side_effect=disable):
+        bulk_users.run_batch(job, limit=1)
+        saved_job = bulk_users.load_job(job["id"])
+        assert bulk_users.job_counts(saved_job) == {
+            "skipped": 1,
+            "done": 1,
+            "pending": 2,
+        }
+
+        # A reloaded job only applies the items still pending
+        bulk_users.run_batch(saved_job)
+        assert bulk_users.job_counts(saved_job) == {
+            "skipped": 1,
+            "done": 2,
+            "failed": 1,
+        }
+
+    bulk_users.retry_failed_items(saved_job)
+    with patch("bulk_users.User.disable", return_value=True) as mocked_disable:
+        bulk_users.run_batch(bulk_users.load_job(job["id"]))
+        mocked_disable.assert_called_once_with()
+    assert bulk_users.job_counts(bulk_users.load_job(job["id"])) == {
+        "skipped": 1,
+        "done": 3,
+    }
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_run_batch_skips_items_already_running():
+    users = [list_user(f"user{i}@communities.gov.uk") for i in range(2)]
+    job = bulk_users.new_update_job("disable", users, "admin-user", {})
+
+    def disable(user):
+        # The run is posted again while the first batch is applied
+        saved_job = bulk_users.load_job(job["id"])
+        assert "pending" not in bulk_users.job_counts(saved_job)
+        bulk_users.run_batch(saved_job)
+        return True
+
+    with patch("bulk_users.User.disable", autospec=True, side_effect=disable):
+        bulk_users.run_batch(job, limit=2)
+        # Once for each item with nothing applied by the second run
+        assert bulk_users.User.disable.call_count == 2
+    assert bulk_users.job_counts(bulk_users.load_job(job["id"])) == {"done": 2}
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_retry_requeues_items_left_running(monkeypatch):
+    users = [list_user(f"user{i}@communities.gov.uk") for i in range(2)]
+    job = bulk_users.new_update_job("disable", users, "admin-user", {})
+    job["items"][0].update(status="running", started_at="2020-01-01T12:00:00")
+    job["items"][1].update(status="running", started_at=datetime.utcnow().isoformat())
+
+    bulk_users.retry_failed_items(job)
+    assert [item["status"] for item in job["items"]] == ["pending", "running"]
+
+
+@pytest.mark.usefixtures("bulk_job_dir")
+def test_update_users_regroup():
+    job = bulk_users.new_update_job(
+        "regroup",
+        [list_user("a@communities.gov.uk"), list_user("b@communities.gov.uk")],
+        "admin-user",
+        {"group_name": "standard-download"},
+        "standard-upload",
+    )
+
+    def get_details(user):
+        if user.email_address == "a@communities.gov.uk":
+            return {"group": {"value": "standard-download"}}
+        return {}
+
+    with patch(
+        "bulk_users.User.get_details", autospec=True, side_effect=get_details
+    ), patch("bulk_users.User.set_group", return_value=True) as mocked_set_group:
+        bulk_users.run_batch(job)
+        mocked_set_group.assert_called_once_with("standard-upload")
+
+    assert [(item["status"], item["message"]) for item in job["items"]] == [
+        ("done", ""),
+        ("failed", "User not found."),
+    ]
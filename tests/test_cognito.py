@@ -1,6 +1,10 @@
+import time
+
 import pytest
+import requests_mock
 
 import cognito
+import config
 import stubs
 
 
@@ -128,3 +132,91 @@ def test_list_groups_for_user(admin_user):
         first_group = groups["Groups"][0]
         assert first_group["GroupName"] == admin_user["group"]["value"]
         stubber.deactivate()
+
+
+def test_list_users_in_group():
+    usernames = ["justin.casey@communities.gov.uk"]
+    stubber = stubs.mock_cognito_list_users_in_group("standard-upload", usernames)
+
+    with stubber:
+        response = cognito.list_users_in_group("standard-upload")
+        assert [user["Username"] for user in response["Users"]] == usernames
+        stubber.deactivate()
+
+
+def test_token_bucket_spaces_out_calls():
+    bucket = cognito.TokenBucket(max_rate=20)
+    start = time.monotonic()
+    # The first 20 come from the full bucket then each waits 1/20s
+    for _ in range(25):
+        bucket.acquire()
+    assert time.monotonic() - start >= 4 / 20
+
+
+def test_token_bucket_adapts_to_throttling():
+    bucket = cognito.TokenBucket(max_rate=20, min_rate=4)
+    bucket.throttled()
+    assert bucket.rate == 10
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 4
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 20
+
+
+@pytest.mark.usefixtures("admin_user")
+def test_disable_user_retries_when_throttled(admin_user, monkeypatch):
+    monkeypatch.setattr(cognito, "backoff_seconds", lambda attempt: 0)
+    stubber = stubs.mock_cognito_admin_disable_user_throttled(admin_user["email"], 2)
+
+    with stubber:
+        assert cognito.disable_user(admin_user["email"])
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+    assert cognito.RATE_LIMITERS["UserUpdate"].rate < 25
+
+
+@pytest.mark.usefixtures("admin_user")
+def test_disable_user_gives_up_when_throttled(admin_user, monkeypatch):
+    monkeypatch.setattr(cognito, "backoff_seconds", lambda attempt: 0)
+    stubber = stubs.mock_cognito_admin_disable_user_throttled(
+        admin_user["email"], cognito.MAX_ATTEMPTS, succeeds=False
+    )
+
+    with stubber:
+        assert not cognito.disable_user(admin_user["email"])
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_backoff_seconds():
+    for attempt in range(1, 10):
+        ceiling = cognito.BACKOFF_BASE_SECONDS * 2**attempt
+        assert 0 <= cognito.backoff_seconds(attempt) <= cognito.BACKOFF_MAX_SECONDS
+        assert cognito.backoff_seconds(attempt) <= ceiling
+
+
+def test_hosted_domain_session_is_shared():
+    session = cognito.get_hosted_domain_session()
+    assert cognito.get_hosted_domain_session() is session
+
+    retries = session.get_adapter("https://test.cognito.domain.com").max_retries
+    assert retries.total == cognito.HOSTED_DOMAIN_RETRIES
+    # A token request is never repeated once it has been sent
+    assert retries.is_retry("GET", 503)
+    assert not retries.is_retry("POST", 503)
+
+
+@pytest.mark.usefixtures("test_client")
+@requests_mock.Mocker(kw="mocker")
+def test_hosted_domain_request(test_client, **args):
+    config.set("cognito_domain", "test.cognito.domain.com")
+    config.set("cognito_connect_timeout", 1.5)
+    config.set("cognito_read_timeout", 4)
+    mocker = args["mocker"]
+    mocker.get("https://test.cognito.domain.com/oauth2/userInfo", json={})
+
+    response = cognito.hosted_domain_request("GET", "/oauth2/userInfo")
+    assert response.status_code == 200
+    assert mocker.last_request.timeout == (1.5, 4)
@@ -0,0 +1,126 @@
+import json
+import os
+
+import pytest
+import requests_mock
+import rsa
+
+import cognito_tokens
+import config
+import stubs
+from helpers import TEST_PRIVATE_KEY, b64url_encode, jwks_document, sign_id_token
+
+JWKS_URL = (
+    "https://cognito-idp.eu-west-1.amazonaws.com/"
+    f"{stubs.MOCK_COGNITO_USER_POOL_ID}/.well-known/jwks.json"
+)
+
+
+@pytest.fixture()
+def jwks(test_client):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    with requests_mock.Mocker() as mocker:
+        mocker.get(JWKS_URL, json=jwks_document())
+        yield mocker
+
+
+@pytest.mark.usefixtures("jwks", "id_token_claims")
+def test_verify_id_token(jwks, id_token_claims):
+    token = sign_id_token(id_token_claims)
+    assert cognito_tokens.verify_id_token(token) == id_token_claims
+
+    # The signing keys are cached
+    assert cognito_tokens.verify_id_token(token) == id_token_claims
+    assert jwks.call_count == 1
+
+
+@pytest.mark.usefixtures("jwks", "id_token_claims")
+def test_verify_id_token_rejects_tampering(jwks, id_token_claims):
+    header, claims, signature = sign_id_token(id_token_claims).split(".")
+    id_token_claims["cognito:groups"] = ["admin-full"]
+    forged_claims = b64url_encode(json.dumps(id_token_claims).encode())
+    assert cognito_tokens.verify_id_token(f"{header}.{forged_claims}.{signature}") == {}
+
+    unsigned_header = b64url_encode(json.dumps({"alg": "none"}).encode())
+    assert cognito_tokens.verify_id_token(f"{unsigned_header}.{claims}.") == {}
+
+    assert cognito_tokens.verify_id_token("not-a-token") == {}
+    assert cognito_tokens.verify_id_token(None) == {}
+
+
+@pytest.mark.parametrize(
+    "claim, value",
+    [
+        ("iss", "https://cognito-idp.eu-west-1.amazonaws.com/another-pool"),
+        ("aud", "another-client"),
+        ("token_use", "access"),
+        ("exp", 1),
+        ("exp", "never"),
+    ],
+)
+@pytest.mark.usefixtures("jwks", "id_token_claims")
+def test_verify_id_token_checks_claims(jwks, id_token_claims, claim, value):
+    id_token_claims[claim] = value
+    assert cognito_tokens.verify_id_token(sign_id_token(id_token_claims)) == {}
+
+
+@pytest.mark.usefixtures("jwks", "id_token_claims")
+def test_verify_id_token_refreshes_keys_for_new_kid(jwks, id_token_claims):
+    assert cognito_tokens.verify_id_token(sign_id_token(id_token_claims)) != {}
+
+    # A rotated key is picked up by fetching the JWKS again
+    rotated_jwks = jwks_document()
+    rotated_jwks["keys"][0]["kid"] = "rotated-key"
+    jwks.get(JWKS_URL, json=rotated_jwks)
+    cognito_tokens.JWKS_CACHE["fetched_at"] -= cognito_tokens.JWKS_MIN_REFRESH_SECONDS
+    token = sign_id_token(id_token_claims, kid="rotated-key")
+    assert cognito_tokens.verify_id_token(token) == id_token_claims
+    assert jwks.call_count == 2
+
+    # Unknown kids don't refetch the JWKS more than once a minute
+    token = sign_id_token(id_token_claims, kid="unknown-key")
+    assert cognito_tokens.verify_id_token(token) == {}
+    assert cognito_tokens.verify_id_token(token) == {}
+    assert jwks.call_count == 2
+
+
+@pytest.mark.usefixtures("id_token_claims")
+def test_claim_attributes(id_token_claims):
+    attributes = cognito_tokens.claim_attributes(id_token_claims)
+    assert {"Name": "email_verified", "Value": "true"} in attributes
+    assert {"Name": "custom:is_la", "Value": "1"} in attributes
+    assert "cognito:groups" not in [attribute["Name"] for attribute in attributes]
+
+
+def test_rsa_sha256_signature_is_valid():
+    key = rsa.PublicKey(TEST_PRIVATE_KEY.n, TEST_PRIVATE_KEY.e)
+    signature = rsa.sign(b"message", TEST_PRIVATE_KEY, "SHA-256")
+    assert cognito_tokens.rsa_sha256_signature_is_valid(b"message", signature, key)
+    assert not cognito_tokens.rsa_sha256_signature_is_valid(b"other", signature, key)
+    assert not cognito_tokens.rsa_sha256_signature_is_valid(b"message", b"", key)
+
+    # Only SHA-256 signatures are accepted for RS256
+    signature = rsa.sign(b"message", TEST_PRIVATE_KEY, "SHA-1")
+    assert not cognito_tokens.rsa_sha256_signature_is_valid(b"message", signature, key)
+
+
+def test_verify_id_token_signed_by_openssl(test_client):
+    """
+    A Cognito shaped id token and JWKS made with a 2048 bit key
+    by openssl rather than the signing code these tests use
+    """
+    path = os.path.join(os.path.dirname(__file__), "cognito_id_token.json")
+    with open(path) as token_file:
+        fixture = json.load(token_file)
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+
+    claims = fixture["claims"]
+    with requests_mock.Mocker() as mocker:
+        mocker.get(JWKS_URL, json=fixture["jwks"])
+        now = claims["iat"] + 60
+        assert cognito_tokens.verify_id_token(fixture["id_token"], now) == claims
+
+        header, payload, signature = fixture["id_token"].split(".")
+        forged = signature[:-2] + ("AA" if signature[-2:] != "AA" else "BA")
+        token = f"{header}.{payload}.{forged}"
+        assert cognito_tokens.verify_id_token(token, now) == {}
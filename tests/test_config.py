@@ -5,6 +5,7 @@ from flask import Flask
 
 import stubs
 import config
+from server_session import SQLiteSessionStore
 
 
 def test_setup_talisman():
@@ -24,6 +25,22 @@ def test_setup_talisman():
     assert talisman.force_https
 
 
+def test_setup_session_store(tmp_path):
+    app = Flask(__name__)
+    config.set("session_store", "cookie")
+    assert config.setup_session_store(app) is None
+
+    config.set("session_store", "sqlite")
+    config.set("session_store_path", str(tmp_path / "sessions.sqlite3"))
+    config.set("session_lifetime_seconds", 60)
+    session_interface = config.setup_session_store(app)
+    assert isinstance(session_interface.store, SQLiteSessionStore)
+    assert session_interface.lifetime_seconds == 60
+    # Loading the settings again keeps the same store
+    assert config.setup_session_store(app) is session_interface
+    config.set("session_store", "cookie")
+
+
 def test_read_env_variables():
     app = Flask(__name__)
     config.read_env_variables(app)
@@ -0,0 +1,214 @@
+import io
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytest
+
+import config
+import stubs
+from delta import (
+    delta_file_key,
+    diff_rows,
+    find_previous_file,
+    is_daily_file,
+    write_daily_delta,
+)
+
+
+@pytest.fixture()
+def previous_rows():
+    return [
+        ["1", "alice", "AB1 2CD"],
+        ["2", "bob", "EF3 4GH"],
+        ["3", "carol", "IJ5 6KL"],
+    ]
+
+
+@pytest.fixture()
+def new_rows():
+    return [
+        ["1", "alice", "AB1 2CD"],
+        ["3", "carol", "MN7 8OP"],
+        ["4", "dave", "QR9 0ST"],
+    ]
+
+
+def test_delta_file_key():
+    key = "web-app-prod-data/local_authority/haringey/20200526-120000_people.csv"
+    assert delta_file_key(key, "added") == (
+        "web-app-prod-data/local_authority/haringey/"
+        "20200526-120000_people-delta-added.csv"
+    )
+    assert is_daily_file(key)
+    assert not is_daily_file(delta_file_key(key, "added"))
+    assert not is_daily_file(f"{key}-metadata.json")
+
+
+@pytest.mark.usefixtures("previous_rows", "new_rows")
+def test_diff_rows(previous_rows, new_rows):
+    changes = sorted(diff_rows(previous_rows, new_rows))
+    assert changes == [
+        ("added", ["4", "dave", "QR9 0ST"]),
+        ("changed", ["3", "carol", "MN7 8OP"]),
+        ("removed", ["2", "bob", "EF3 4GH"]),
+    ]
+
+
+@pytest.mark.usefixtures("previous_rows", "new_rows")
+def test_diff_rows_spilled_to_disk_matches_in_memory(previous_rows, new_rows, tmp_path):
+    in_memory = sorted(diff_rows(previous_rows, new_rows))
+    spilled = sorted(diff_rows(previous_rows, new_rows, 3, str(tmp_path)))
+    assert spilled == in_memory
+
+
+def test_diff_rows_repeated_keys():
+    previous_rows = [
+        ["1", "alice", "AB1 2CD"],
+        ["1", "alice", "EF3 4GH"],
+        ["1", "alice", "EF3 4GH"],
+        ["2", "bob", "IJ5 6KL"],
+    ]
+    new_rows = [
+        ["1", "alice", "EF3 4GH"],
+        ["1", "alice", "MN7 8OP"],
+        ["2", "bob", "IJ5 6KL"],
+        ["2", "bob", "QR9 0ST"],
+    ]
+    changes = sorted(diff_rows(previous_rows, new_rows))
+    assert changes == [
+        ("added", ["2", "bob", "QR9 0ST"]),
+        ("changed", ["1", "alice", "MN7 8OP"]),
+        ("removed", ["1", "alice", "EF3 4GH"]),
+    ]
+
+
+@pytest.mark.usefixtures("previous_rows", "new_rows")
+def test_diff_rows_key_columns(previous_rows, new_rows, tmp_path):
+    # Keyed on the whole row nothing is seen as changed
+    key_columns = (0, 1, 2)
+    expected = [
+        ("added", ["3", "carol", "MN7 8OP"]),
+        ("added", ["4", "dave", "QR9 0ST"]),
+        ("removed", ["2", "bob", "EF3 4GH"]),
+        ("removed", ["3", "carol", "IJ5 6KL"]),
+    ]
+    changes = diff_rows(previous_rows, new_rows, key_columns=key_columns)
+    assert sorted(changes) == expected
+    spilled = diff_rows(previous_rows, new_rows, 3, str(tmp_path), key_columns)
+    assert sorted(spilled) == expected
+
+
+def test_diff_rows_memory_is_bounded_by_partition(tmp_path):
+    def daily_rows(count, moved):
+        for i in range(count):
+            street = f"{i + 1 if i % moved == 0 else i} High Street"
+            yield [str(i), f"user{i}@example.gov.uk", street, "AB1 2CD", "x" * 40]
+
+    rows = 10000
+    file_size = sum(len(",".join(row)) + 2 for row in daily_rows(rows, rows))
+
+    tracemalloc.start()
+    try:
+        changes = diff_rows(
+            daily_rows(rows, rows), daily_rows(rows, 10), 4, str(tmp_path)
+        )
+        changed = sum(1 for change, row in changes if change == "changed")
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert changed == rows // 10 - 1
+    # Indexing rows as tuples took many times the size of the file
+    assert peak < file_size
+
+
+class FakeDeltaS3Client:
+    """ Serves two daily files and keeps uploaded delta files """
+
+    def __init__(self, files):
+        self.files = files
+        self.uploads = {}
+
+    def head_object(self, Bucket, Key):
+        return {"LastModified": self.files[Key][0]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        contents = [
+            {"Key": key, "LastModified": modified}
+            for key, (modified, body) in self.files.items()
+        ]
+        return [{"Contents": contents}]
+
+    def get_object(self, Bucket, Key):
+        body = self.files[Key][1].encode("utf-8")
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def upload_file(self, path, Bucket, Key):
+        with open(path, newline="") as delta_file:
+            self.uploads[Key] = delta_file.read()
+
+
+def test_write_daily_delta(monkeypatch):
+    folder = "web-app-prod-data/local_authority/haringey/"
+    key = f"{folder}20200526-120000_people.csv"
+    now = datetime.utcnow()
+    s3_client = FakeDeltaS3Client(
+        {
+            f"{folder}20200525-120000_people.csv": (
+                now - timedelta(1),
+                "id,name,postcode\n1,alice,AB1 2CD\n1,alice,EF3 4GH\n2,bob,IJ5 6KL\n",
+            ),
+            key: (now, "id,name,postcode\n1,alice,AB1 2CD\n1,alice,MN7 8OP\n"),
+        }
+    )
+    monkeypatch.setattr("delta.boto3.client", lambda service: s3_client)
+    monkeypatch.setitem(config.CONFIG, "delta_key_columns", "id, name")
+
+    assert write_daily_delta("test_bucket", key) == {
+        "added": 0,
+        "removed": 1,
+        "changed": 1,
+    }
+    assert s3_client.uploads == {
+        delta_file_key(key, "added"): "id,name,postcode\r\n",
+        delta_file_key(key, "removed"): "id,name,postcode\r\n2,bob,IJ5 6KL\r\n",
+        delta_file_key(key, "changed"): "id,name,postcode\r\n1,alice,MN7 8OP\r\n",
+    }
+
+    monkeypatch.setitem(config.CONFIG, "delta_key_columns", "nhs_number")
+    assert write_daily_delta("test_bucket", key) == {}
+
+
+def test_find_previous_file():
+    bucket_name = "test_bucket"
+    folder = "web-app-prod-data/local_authority/haringey/"
+    key = f"{folder}20200526-120000_people.csv"
+    now = datetime.utcnow()
+    contents = [
+        {"Key": key, "LastModified": now},
+        {
+            "Key": f"{folder}20200525-120000_people.csv",
+            "LastModified": now - timedelta(1),
+        },
+        {
+            "Key": f"{folder}20200524-120000_people.csv",
+            "LastModified": now - timedelta(2),
+        },
+        {
+            "Key": f"{folder}20200525-120000_other.csv",
+            "LastModified": now - timedelta(1),
+        },
+        {
+            "Key": f"{folder}20200525-120000_people-delta-added.csv",
+            "LastModified": now - timedelta(1),
+        },
+    ]
+
+    stubber, client = stubs.mock_s3_find_previous_file(bucket_name, key, contents)
+    with stubber:
+        previous_key = find_previous_file(client, bucket_name, key)
+        assert previous_key == f"{folder}20200525-120000_people.csv"
+        stubber.deactivate()
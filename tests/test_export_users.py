@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+
+import pytest
+
+import config
+import export_users
+import stubs
+from user import LIST_USERS_PAGE_SIZE
+
+LIST_GROUP_MEMBERS = {
+    "standard-download": ["justin.casey@communities.gov.uk"],
+    "standard-upload": [],
+    "admin-view": [],
+    "admin-power": [],
+    "admin-full": ["admin.user@communities.gov.uk"],
+}
+
+
+@pytest.fixture()
+def export_pages(list_users_arguments, list_users_response):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    list_users_arguments["Limit"] = LIST_USERS_PAGE_SIZE
+    mfa_user = dict(list_users_response["Users"][0])
+    mfa_user["MFAOptions"] = [
+        {"DeliveryMedium": "SMS", "AttributeName": "phone_number"}
+    ]
+    responses = [
+        {"Users": [mfa_user], "PaginationToken": "page-2"},
+        {"Users": [], "PaginationToken": "page-3"},
+        {"Users": list_users_response["Users"][1:]},
+    ]
+    return stubs.mock_user_list_pages(
+        list_users_arguments, responses, LIST_GROUP_MEMBERS
+    )
+
+
+def test_export_chunks_csv(export_pages):
+    with export_pages:
+        chunks = export_users.export_chunks("csv")
+        # Nothing is requested from cognito until the rows are needed
+        header = next(chunks)
+        assert header.startswith("username,email,name,group,paths")
+        rows = list(csv.DictReader(io.StringIO(header + "".join(chunks))))
+        export_pages.assert_no_pending_responses()
+        export_pages.deactivate()
+
+    assert [(row["username"], row["group"], row["mfa"]) for row in rows] == [
+        ("justin.casey@communities.gov.uk", "standard-download", "sms"),
+        ("admin.user@communities.gov.uk", "admin-full", "none"),
+    ]
+    assert rows[0]["paths"] == (
+        "web-app-prod-data/local_authority/barking;"
+        "web-app-prod-data/local_authority/haringey"
+    )
+    assert rows[0]["status"] == "CONFIRMED"
+    assert rows[0]["enabled"] == "True"
+
+
+def test_export_chunks_jsonl(export_pages):
+    with export_pages:
+        chunks = list(export_users.export_chunks("jsonl"))
+        export_pages.assert_no_pending_responses()
+        export_pages.deactivate()
+
+    # One chunk per page with users
+    assert len(chunks) == 2
+    rows = [json.loads(line) for line in "".join(chunks).splitlines()]
+    assert [row["username"] for row in rows] == [
+        "justin.casey@communities.gov.uk",
+        "admin.user@communities.gov.uk",
+    ]
+    assert rows[1]["phone_number_verified"] is False
+    assert list(rows[0]) == export_users.EXPORT_COLUMNS
+
+
+def test_export_chunks_unknown_format():
+    with pytest.raises(ValueError):
+        next(export_users.export_chunks("xlsx"))
@@ -0,0 +1,30 @@
+import pytest
+
+from file_categories import categorise_file, get_file_name_category, re_case_word
+
+
+@pytest.mark.usefixtures("test_list_object_file")
+def test_categorise_file(test_list_object_file):
+    prefix = "web-app-prod-data/local_authority/barnet"
+    file0 = test_list_object_file
+    categorise_file(file0, prefix)
+    assert file0["Category"] == "People1"
+
+
+def test_get_file_name_category():
+    bare_file_name = "20200526-120000.csv"
+    assert get_file_name_category(bare_file_name) == ""
+    prefixed_file_name = "nhs-20200526-120000.csv"
+    assert get_file_name_category(prefixed_file_name) == "nhs"
+    suffixed_file_name = "20200526-120000-nhs.csv"
+    assert get_file_name_category(suffixed_file_name) == "nhs"
+    underscored_file_name = "nhs_20200526_120000.csv"
+    assert get_file_name_category(underscored_file_name) == "nhs"
+
+
+def test_re_case_word():
+    assert re_case_word("nhs") == "NHS"
+    assert re_case_word("gds") == "GDS"
+    assert re_case_word("dwp") == "DWP"
+    assert re_case_word("mhclg") == "MHCLG"
+    assert re_case_word("other") == "Other"
@@ -1,7 +1,11 @@
 import pytest
 from flask import session
 
+from access_profile import build_access_profile
+from cognito_groups import get_group_by_name
 from flask_helpers import (
+    current_group_name,
+    has_admin_role,
     has_upload_rights,
     is_admin_interface,
     is_development,
@@ -51,3 +55,21 @@ def test_user_has_a_valid_role(test_session):
         assert user_has_a_valid_role(["standard-download"])
         assert not user_has_a_valid_role(["admin-power", "admin-full"])
         assert user_has_a_valid_role(["standard-upload", "standard-download"])
+
+
+@pytest.mark.usefixtures("test_session")
+def test_roles_read_from_access_profile(test_session):
+    profile = build_access_profile(
+        test_session["attributes"], get_group_by_name("admin-full")
+    )
+    with app.test_request_context("/"):
+        session.update({"user": test_session["user"], "access_profile": profile})
+        assert has_admin_role()
+        assert not has_upload_rights()
+        assert current_group_name() == "admin-full"
+        assert user_has_a_valid_role(["admin-full"])
+
+    with app.test_request_context("/"):
+        assert not has_admin_role()
+        assert current_group_name() == "group-not-available"
+        assert not user_has_a_valid_role(["admin-full"])
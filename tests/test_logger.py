@@ -0,0 +1,166 @@
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+
+from logger import (
+    BoundedQueueHandler,
+    JsonFormatter,
+    LOG,
+    LOG_WRITERS,
+    build_logger,
+    exit_on_sigterm,
+    flush_logs,
+    log_lazy,
+    orjson,
+)
+from logger_benchmark import RECORDS, legacy_format, make_record
+
+FORMATTERS = [JsonFormatter(use_orjson=False)]
+if orjson is not None:
+    FORMATTERS.append(JsonFormatter())
+
+
+@pytest.mark.parametrize("formatter", FORMATTERS)
+@pytest.mark.parametrize("message_kind", list(RECORDS))
+def test_json_formatter_matches_legacy_format(formatter, message_kind):
+    record = make_record(*RECORDS[message_kind])
+    expected = json.loads(legacy_format(record))
+    for field in ["timestamp", "taskName"]:
+        expected.pop(field, None)
+
+    logged = json.loads(formatter.format(record))
+    assert logged.pop("timestamp").endswith("Z")
+    assert logged == expected
+
+
+@pytest.mark.parametrize("formatter", FORMATTERS)
+def test_json_formatter_values(formatter):
+    when = datetime(2020, 6, 1, tzinfo=timezone.utc)
+    record = make_record({"created": when, 1: "one"}, None)
+    record.created = when.timestamp() + 0.000123
+
+    logged = json.loads(formatter.format(record))
+    assert logged["msg"] == {"created": str(when), "1": "one"}
+    assert logged["timestamp"] == "2020-06-01T00:00:00.000123Z"
+
+    # A message that only looks like JSON is logged as it is
+    record = make_record("[not json", None)
+    assert json.loads(formatter.format(record))["msg"] == "[not json"
+    record = make_record("100%", ("a",))
+    assert json.loads(formatter.format(record))["msg"] == "100%"
+
+
+def test_log_handler_has_a_json_formatter():
+    assert isinstance(LOG.handlers[0].formatter, JsonFormatter)
+
+
+def test_bounded_queue_handler_drops_debug_first():
+    handler = BoundedQueueHandler(5)
+    for level in [logging.DEBUG] * 5 + [logging.ERROR] * 2:
+        handler.handle(make_record("message", None, level))
+
+    # Debug records stop at 80% full leaving room for errors
+    assert handler.queue.qsize() == 5
+    assert handler.take_dropped() == {"DEBUG": 1, "ERROR": 1}
+    assert handler.take_dropped() == {}
+
+    handler = BoundedQueueHandler(5, overflow="drop-new")
+    for level in [logging.DEBUG] * 5 + [logging.ERROR]:
+        handler.handle(make_record("message", None, level))
+    assert handler.take_dropped() == {"ERROR": 1}
+
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(5, overflow="spill")
+
+
+def test_bounded_queue_handler_prepare_copies_only_mutable_messages():
+    handler = BoundedQueueHandler(5)
+    record = make_record("%s of %d", ("a.csv", 3))
+    assert handler.prepare(record) is record
+
+    files = [{"key": "a.csv"}]
+    prepared = handler.prepare(make_record(files, None))
+    files[0]["url"] = "/download/a.csv"
+    assert prepared.msg == [{"key": "a.csv"}]
+
+    prepared = handler.prepare(make_record("files %s", (files,)))
+    files.append({"key": "b.csv"})
+    assert prepared.msg == "files [{'key': 'a.csv', 'url': '/download/a.csv'}]"
+    assert prepared.args is None
+
+
+def test_queued_logger(capsys):
+    logger = build_logger("test-queued", log_level="INFO", queue_size=10)
+    try:
+        logger.debug("not logged")
+        logger.info({"action": "queued"})
+        LOG_WRITERS["test-queued"].queue_handler.drop(make_record("x", None))
+        flush_logs()
+
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [line["msg"] for line in lines] == [
+            {"action": "queued"},
+            {"action": "logger.dropped", "dropped": {"ERROR": 1}},
+        ]
+    finally:
+        # Back to a synchronous handler
+        build_logger("test-queued")
+    assert "test-queued" not in LOG_WRITERS
+
+
+def test_queued_logger_writes_messages_as_logged(capsys):
+    logger = build_logger("test-queued", log_level="INFO", queue_size=10)
+    try:
+        files = [{"key": "a.csv"}]
+        logger.info(files)
+        files[0]["url"] = "/download/a.csv"
+        flush_logs()
+    finally:
+        build_logger("test-queued")
+    assert json.loads(capsys.readouterr().out)["msg"] == [{"key": "a.csv"}]
+
+
+def test_queued_logger_reports_drops_without_a_flush(capsys):
+    logger = build_logger("test-queued", log_level="INFO", queue_size=10)
+    try:
+        queue_handler = LOG_WRITERS["test-queued"].queue_handler
+        queue_handler.drop(make_record("x", None, logging.DEBUG))
+        logger.info("after the drop")
+        queue_handler.queue.join()
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    finally:
+        build_logger("test-queued")
+    assert [line["msg"] for line in lines] == [
+        "after the drop",
+        {"action": "logger.dropped", "dropped": {"DEBUG": 1}},
+    ]
+
+
+def test_exit_on_sigterm():
+    with patch("logger.flush_logs") as mocked_flush_logs:
+        with pytest.raises(SystemExit):
+            exit_on_sigterm(15, None)
+        mocked_flush_logs.assert_called_once_with()
+
+
+def test_log_lazy(caplog):
+    logger = logging.getLogger("test-lazy")
+    logger.setLevel(logging.INFO)
+
+    def never_called():
+        raise AssertionError("The message was built")
+
+    log_lazy(logger, logging.DEBUG, never_called)
+    assert caplog.records == []
+
+    log_lazy(logger, logging.INFO, lambda: {"action": "lazy", "handler": never_called})
+    log_lazy(logger, logging.INFO, lambda: "User %s: file_key: %s", "a@b.c", "file.csv")
+    # Callables inside the message are logged, not called
+    assert caplog.records[0].msg == {"action": "lazy", "handler": never_called}
+    assert caplog.records[1].getMessage() == "User a@b.c: file_key: file.csv"
+    if sys.version_info >= (3, 8):
+        assert caplog.records[0].funcName == "test_log_lazy"
@@ -1,26 +1,35 @@
+import hashlib
+import io
 import json
 import os
+import zipfile
 from datetime import datetime
 
 import flask
 import pytest
+import requests
 import requests_mock
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 
 import stubs
 import config
+from helpers import jwks_document, sign_id_token
 from main import (
     app,
-    categorise_file,
+    checksum_index_key,
+    checksum_post_fields,
     collect_files_by_date,
     create_presigned_url,
     date_file,
+    find_duplicate_upload,
     generate_upload_file_path,
-    get_file_name_category,
+    get_csv_preview,
     get_files,
     is_mfa_configured,
+    is_sha256_hex,
     key_has_granted_prefix,
     load_user_lookup,
-    re_case_word,
     return_attribute,
     upload_form_validate,
     user_custom_paths,
@@ -151,6 +160,162 @@ def test_route_download(test_client, test_session, test_get_object):
         assert response.location == "http://localhost/403"
 
 
+def test_get_csv_preview():
+    bucket_name = "test_bucket"
+    key = "web-app-prod-data/local_authority/haringey/people1.csv"
+    body = "name,postcode\nalice,AB1 2CD\nbob,EF3 4GH\ncarol,IJ5"
+
+    stubber = stubs.mock_s3_get_object_range(bucket_name, key, body, 45)
+    with stubber:
+        rows = get_csv_preview(bucket_name, key, max_bytes=45, max_rows=20)
+        # the partial last line is dropped
+        assert rows == [["name", "postcode"], ["alice", "AB1 2CD"], ["bob", "EF3 4GH"]]
+        stubber.deactivate()
+
+    stubber = stubs.mock_s3_get_object_range(bucket_name, key, body, 1024)
+    with stubber:
+        rows = get_csv_preview(bucket_name, key, max_bytes=1024, max_rows=1)
+        assert rows == [["name", "postcode"], ["alice", "AB1 2CD"]]
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("test_client", "test_session")
+def test_route_preview(test_client, test_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_session)
+
+    bucket_name = "test_bucket"
+    granted_key = "web-app-prod-data/local_authority/haringey/people1.csv"
+    denied_key = "web-app-prod-data/local_authority/hackney/people1.csv"
+    body = "name,postcode\nalice,AB1 2CD\n"
+
+    stubber = stubs.mock_s3_get_object_range(bucket_name, granted_key, body)
+    with stubber:
+        response = test_client.get(f"/preview/{granted_key}")
+        body = response.data.decode()
+        assert response.status_code == 200
+        assert '<th scope="col" class="govuk-table__header">postcode</th>' in body
+        assert '<td class="govuk-table__cell">alice</td>' in body
+        stubber.deactivate()
+
+    response = test_client.get(f"/preview/{denied_key}")
+    assert response.status_code == 302
+    assert response.location == "http://localhost/403"
+
+
+@pytest.mark.usefixtures("test_client", "test_session")
+def test_route_download_zip(test_client, test_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_session)
+
+    bucket_name = "test_bucket"
+    bodies = {
+        "web-app-prod-data/local_authority/haringey/people1.csv": "a,b\n1,2\n",
+        "web-app-prod-data/local_authority/barnet/people2.csv": "c,d\n3,4\n",
+    }
+    denied_key = "web-app-prod-data/local_authority/hackney/people1.csv"
+
+    for store_only in ["yes", "no"]:
+        stubber = stubs.mock_s3_get_objects(bucket_name, bodies)
+        with stubber:
+            response = test_client.post(
+                "/files/zip", data={"keys": list(bodies), "store_only": store_only}
+            )
+            assert response.status_code == 200
+            assert response.mimetype == "application/zip"
+            archive = zipfile.ZipFile(io.BytesIO(response.data))
+            assert archive.read("local_authority/haringey/people1.csv") == b"a,b\n1,2\n"
+            assert archive.read("local_authority/barnet/people2.csv") == b"c,d\n3,4\n"
+            stubber.deactivate()
+
+    response = test_client.post(
+        "/files/zip", data={"keys": [list(bodies)[0], denied_key]}
+    )
+    assert response.status_code == 302
+    assert response.location == "http://localhost/403"
+
+
+class FakeArchiveS3Client:
+    """ Serves objects from a dict and keeps multipart uploads """
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.uploads = {}
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.bodies:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        body = self.bodies[Key].encode()
+        return {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "LastModified": datetime(2020, 4, 1, 12, 0, 0),
+        }
+
+    def create_multipart_upload(self, Bucket, Key, ContentType):
+        self.uploads[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId].append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert len(MultipartUpload["Parts"]) == len(self.uploads[UploadId])
+        self.objects[Key] = b"".join(self.uploads.pop(UploadId))
+
+    def generate_presigned_url(self, method, Params, ExpiresIn, HttpMethod):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}"
+
+
+@pytest.mark.usefixtures("test_client", "test_session")
+def test_route_download_zip_lists_unreadable_files(
+    test_client, test_session, monkeypatch
+):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_session)
+
+    readable_key = "web-app-prod-data/local_authority/haringey/people1.csv"
+    missing_key = "web-app-prod-data/local_authority/barnet/people2.csv"
+    s3_client = FakeArchiveS3Client({readable_key: "a,b\n1,2\n"})
+    monkeypatch.setattr("main.boto3.client", lambda service, **kwargs: s3_client)
+
+    response = test_client.post(
+        "/files/zip", data={"keys": [readable_key, missing_key]}
+    )
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.namelist() == [
+        "local_authority/haringey/people1.csv",
+        "download-errors.txt",
+    ]
+    assert "local_authority/barnet/people2.csv" in archive.read(
+        "download-errors.txt"
+    ).decode("utf-8")
+
+
+@pytest.mark.usefixtures("test_client", "test_session")
+def test_route_download_zip_on_lambda(test_client, test_session, monkeypatch):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_session)
+
+    key = "web-app-prod-data/local_authority/haringey/people1.csv"
+    s3_client = FakeArchiveS3Client({key: "a,b\n1,2\n"})
+    monkeypatch.setattr("main.boto3.client", lambda service, **kwargs: s3_client)
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "transfer-data")
+    monkeypatch.setitem(config.CONFIG, "zip_archive_prefix", "web-app-archives")
+
+    response = test_client.post("/files/zip", data={"keys": [key]})
+    assert response.status_code == 302
+    [archive_key] = s3_client.objects
+    assert archive_key.startswith("web-app-archives/")
+    assert archive_key.endswith(".zip")
+    assert response.location == f"https://test_bucket.s3.amazonaws.com/{archive_key}"
+
+    archive = zipfile.ZipFile(io.BytesIO(s3_client.objects[archive_key]))
+    assert archive.read("local_authority/haringey/people1.csv") == b"a,b\n1,2\n"
+
+
 @pytest.mark.usefixtures("test_client", "test_session")
 def test_route_upload_denied(test_client, test_session):
     with test_client.session_transaction() as client_session:
@@ -185,6 +350,126 @@ def test_route_upload_allowed(test_client, test_upload_session):
         assert "local_authority/haringey/people1.csv-metadata.json" not in body
 
 
+@pytest.mark.usefixtures("test_client", "test_upload_session")
+def test_route_upload_checksum_rejects_invalid(test_client, test_upload_session):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_upload_session)
+
+    # No pending upload in the session
+    response = test_client.post("/upload/checksum", data={"checksum": "a" * 64})
+    assert response.status_code == 400
+
+    with test_client.session_transaction() as client_session:
+        client_session["upload_file_path"] = "web-app-upload/local_authority/a.csv"
+
+    response = test_client.post("/upload/checksum", data={"checksum": "not-hex"})
+    assert response.status_code == 400
+
+
+class FakeDuplicateS3Client:
+    """ Holds an index entry for an earlier upload """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        # As stored by an upload signed with its checksum
+        return {"Metadata": {"sha256": hashlib.sha256(self.objects[Key]).hexdigest()}}
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[Key]
+
+
+@pytest.mark.usefixtures("test_client", "test_upload_session")
+def test_route_upload_checksum_duplicate(test_client, test_upload_session, monkeypatch):
+    with test_client.session_transaction() as client_session:
+        client_session.update(test_upload_session)
+        client_session["upload_file_path"] = (
+            "web-app-upload/local_authority/haringey/20200102-120000_people.csv"
+        )
+
+    checksum = hashlib.sha256(b"a,b\n").hexdigest()
+    old_key = "web-app-upload/local_authority/haringey/20200101-120000_people.csv"
+    new_key = "web-app-upload/local_authority/haringey/20200102-120000_people.csv"
+    index_entry = json.dumps({"url": old_key}).encode()
+    s3_client = FakeDuplicateS3Client(
+        {
+            checksum_index_key(new_key, checksum): index_entry,
+            old_key: b"a,b\n",
+            f"{new_key}-metadata.json": b"{}",
+        }
+    )
+    monkeypatch.setattr("main.boto3.client", lambda service, **kwargs: s3_client)
+
+    response = test_client.post("/upload/checksum", data={"checksum": checksum})
+    assert response.json == {"duplicate": old_key}
+    assert f"{new_key}-metadata.json" not in s3_client.objects
+    with test_client.session_transaction() as client_session:
+        assert "upload_file_path" not in client_session
+
+
+def test_is_sha256_hex():
+    assert is_sha256_hex("0" * 64)
+    assert is_sha256_hex("0123456789abcdef" * 4)
+    assert not is_sha256_hex("0" * 63)
+    assert not is_sha256_hex("g" * 64)
+    assert not is_sha256_hex("")
+
+
+def test_checksum_post_fields():
+    assert checksum_post_fields() == ({}, [])
+
+    # sha256 of an empty file
+    checksum = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    fields, conditions = checksum_post_fields(checksum)
+    assert fields["x-amz-checksum-algorithm"] == "SHA256"
+    assert (
+        fields["x-amz-checksum-sha256"]
+        == "47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU="
+    )
+    assert {"x-amz-checksum-sha256": fields["x-amz-checksum-sha256"]} in conditions
+    assert {"x-amz-meta-sha256": checksum} in conditions
+
+
+def test_checksum_index_key():
+    key = "web-app-upload/local_authority/haringey/20200101-120000_people.csv"
+    assert (
+        checksum_index_key(key, "abc")
+        == "web-app-upload-checksums/web-app-upload/local_authority/haringey/abc.json"
+    )
+
+
+def test_find_duplicate_upload():
+    bucket_name = "test_bucket"
+    checksum = "a" * 64
+    new_key = "web-app-upload/local_authority/haringey/20200102-120000_people.csv"
+    old_key = "web-app-upload/local_authority/haringey/20200101-120000_people.csv"
+    index_key = checksum_index_key(new_key, checksum)
+
+    stubber = stubs.mock_s3_find_duplicate_upload(
+        bucket_name, index_key, old_key, checksum
+    )
+    with stubber:
+        assert find_duplicate_upload(bucket_name, new_key, checksum) == old_key
+        stubber.deactivate()
+
+    # Uploaded with the unchecked post so its content is unknown
+    stubber = stubs.mock_s3_find_duplicate_upload(bucket_name, index_key, old_key)
+    with stubber:
+        assert find_duplicate_upload(bucket_name, new_key, checksum) is None
+        stubber.deactivate()
+
+    stubber = stubs.mock_s3_find_duplicate_upload(bucket_name, index_key)
+    with stubber:
+        assert find_duplicate_upload(bucket_name, new_key, checksum) is None
+        stubber.deactivate()
+
+
 @pytest.mark.usefixtures("test_client")
 def test_route_css(test_client):
     """ Check CSS actually resolves successfully """
@@ -209,69 +494,134 @@ def test_route_js(test_client):
     assert "!function(a,b)" in body
 
 
-@pytest.mark.usefixtures("test_client", "test_session", "test_mfa_user")
-@requests_mock.Mocker(kw="mocker")
-def test_auth_flow(test_client, test_session, test_mfa_user, **args):
-    """ Test mocked oauth exchange """
-
-    token = "abc123"
+def mock_token_endpoint(mocker, id_token, access_token="abc123"):
     domain = "test.cognito.domain.com"
-    token_endpoint_url = f"https://{domain}/oauth2/token"
     app.config["cognito_domain"] = domain
     app.config["client_id"] = "123456"
     app.config["client_secret"] = "987654"
     app.config["redirect_host"] = "test.domain.com"
-    stubber = stubs.mock_cognito_auth_flow(token, test_mfa_user)
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
 
-    with test_client.session_transaction() as client_session:
-        client_session.update(test_session)
+    oauth_response = json.dumps({"id_token": id_token, "access_token": access_token})
+    mocker.request(
+        method="POST", url=f"https://{domain}/oauth2/token", text=oauth_response
+    )
+    mocker.get(
+        "https://cognito-idp.eu-west-1.amazonaws.com/"
+        f"{stubs.MOCK_COGNITO_USER_POOL_ID}/.well-known/jwks.json",
+        json=jwks_document(),
+    )
+
+
+@pytest.mark.usefixtures("test_client", "test_mfa_user", "id_token_claims")
+@requests_mock.Mocker(kw="mocker")
+def test_auth_flow(test_client, test_mfa_user, id_token_claims, **args):
+    """ Test mocked oauth exchange """
+
+    token = "abc123"
+    config.set("app_environment", "production")
+    stubber = stubs.mock_cognito_auth_flow(token, test_mfa_user)
 
     """Test using request mocker and boto stub."""
 
-    oauth_response = json.dumps({"id_token": token, "access_token": token})
-    mocker = args["mocker"]
-    mocker.request(method="POST", url=token_endpoint_url, text=oauth_response)
+    mock_token_endpoint(args["mocker"], sign_id_token(id_token_claims), token)
     response = test_client.get(f"/?code={token}")
     body = response.data.decode()
     assert response.status_code == 302
     assert "<h1>Redirecting...</h1>" in body
+    assert response.headers.get("Location").endswith("/")
+    stubber.assert_no_pending_responses()
     stubber.deactivate()
 
+    # The session is filled in from the id token claims
+    with test_client.session_transaction() as client_session:
+        assert client_session["user"] == "test-secrets"
+        assert client_session["email"] == "test-user@test-domain.com"
+        profile = client_session["access_profile"]
+        assert profile["group_name"] == "standard-upload"
+        assert "group" not in client_session
+        assert profile["attributes"]["custom:paths"] == "local_authority/barnet"
+        assert profile["can_upload"]
+        assert "attributes" not in client_session
+
 
-@pytest.mark.usefixtures("test_client", "test_session", "test_no_mfa_user")
+@pytest.mark.usefixtures("test_client", "id_token_claims")
 @requests_mock.Mocker(kw="mocker")
-def test_auth_flow_with_no_mfa_user(
-    test_client, test_session, test_no_mfa_user, **args
-):
-    """ Test mocked oauth exchange """
+def test_auth_flow_outside_production(test_client, id_token_claims, **args):
+    # MFA isn't checked so cognito isn't called at all
+    mock_token_endpoint(args["mocker"], sign_id_token(id_token_claims))
+    response = test_client.get("/?code=abc123")
+    assert response.status_code == 302
+    assert not response.headers.get("Location").endswith("403")
 
-    token = "abc123"
+
+@pytest.mark.usefixtures("test_client", "id_token_claims")
+@requests_mock.Mocker(kw="mocker")
+def test_auth_flow_with_invalid_id_token(test_client, id_token_claims, **args):
+    id_token_claims["aud"] = "another-client"
+    mock_token_endpoint(args["mocker"], sign_id_token(id_token_claims))
+    response = test_client.get("/?code=abc123")
+    assert response.status_code == 302
+    assert response.headers.get("Location").endswith("403")
+
+    with test_client.session_transaction() as client_session:
+        assert "user" not in client_session
+
+
+@pytest.mark.usefixtures("test_client")
+@requests_mock.Mocker(kw="mocker")
+def test_auth_flow_token_endpoint_unreachable(test_client, **args):
     domain = "test.cognito.domain.com"
-    token_endpoint_url = f"https://{domain}/oauth2/token"
     app.config["cognito_domain"] = domain
-    config.set("app_environment", "production")
     app.config["client_id"] = "123456"
     app.config["client_secret"] = "987654"
     app.config["redirect_host"] = "test.domain.com"
-    stubber = stubs.mock_cognito_auth_flow(token, test_no_mfa_user)
 
-    with test_client.session_transaction() as client_session:
-        client_session.update(test_session)
+    mocker = args["mocker"]
+    mocker.post(
+        f"https://{domain}/oauth2/token", exc=requests.exceptions.ConnectTimeout
+    )
+    response = test_client.get("/?code=abc123")
+    assert response.status_code == 302
+    assert response.headers.get("Location").endswith("403")
+
+
+@pytest.mark.usefixtures("test_client", "test_no_mfa_user", "id_token_claims")
+@requests_mock.Mocker(kw="mocker")
+def test_auth_flow_with_no_mfa_user(
+    test_client, test_no_mfa_user, id_token_claims, **args
+):
+    """ Test mocked oauth exchange """
+
+    token = "abc123"
+    config.set("app_environment", "production")
+    stubber = stubs.mock_cognito_auth_flow(token, test_no_mfa_user)
 
     """Test using request mocker and boto stub."""
 
-    oauth_response = json.dumps({"id_token": token, "access_token": token})
-    mocker = args["mocker"]
-    mocker.request(method="POST", url=token_endpoint_url, text=oauth_response)
+    mock_token_endpoint(args["mocker"], sign_id_token(id_token_claims), token)
     response = test_client.get(f"/?code={token}")
 
     body = response.data.decode()
     assert response.status_code == 302
     assert "<h1>Redirecting...</h1>" in body
     assert response.headers.get("Location").endswith("403")
+    stubber.assert_no_pending_responses()
     stubber.deactivate()
 
 
+@pytest.mark.usefixtures("test_client", "id_token_claims")
+@requests_mock.Mocker(kw="mocker")
+def test_auth_flow_with_no_phone_number(test_client, id_token_claims, **args):
+    # SMS MFA can't be set up without a phone number
+    # so cognito isn't asked
+    config.set("app_environment", "production")
+    del id_token_claims["phone_number"]
+    mock_token_endpoint(args["mocker"], sign_id_token(id_token_claims))
+    response = test_client.get("/?code=abc123")
+    assert response.headers.get("Location").endswith("403")
+
+
 # Test access management functions
 
 
@@ -538,25 +888,6 @@ def test_collect_files_by_date(test_session):
         assert collected["count"] == 10
 
 
-@pytest.mark.usefixtures("test_list_object_file")
-def test_categorise_file(test_list_object_file):
-    prefix = "web-app-prod-data/local_authority/barnet"
-    file0 = test_list_object_file
-    categorise_file(file0, prefix)
-    assert file0["Category"] == "People1"
-
-
-def test_get_file_name_category():
-    bare_file_name = "20200526-120000.csv"
-    assert get_file_name_category(bare_file_name) == ""
-    prefixed_file_name = "nhs-20200526-120000.csv"
-    assert get_file_name_category(prefixed_file_name) == "nhs"
-    suffixed_file_name = "20200526-120000-nhs.csv"
-    assert get_file_name_category(suffixed_file_name) == "nhs"
-    underscored_file_name = "nhs_20200526_120000.csv"
-    assert get_file_name_category(underscored_file_name) == "nhs"
-
-
 @pytest.mark.usefixtures("test_list_object_file")
 def test_date_file(test_list_object_file):
     now = datetime.utcnow()
@@ -567,11 +898,3 @@ def test_date_file(test_list_object_file):
     date_file(file0)
     assert file0["SortTime"] == date_sorter
     assert file0["ShowDate"] == date_string
-
-
-def test_re_case_word():
-    assert re_case_word("nhs") == "NHS"
-    assert re_case_word("gds") == "GDS"
-    assert re_case_word("dwp") == "DWP"
-    assert re_case_word("mhclg") == "MHCLG"
-    assert re_case_word("other") == "Other"
@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+from path_catalogue import PathCatalogue, validate_catalogue
+
+CATALOGUE = [
+    {
+        "type": "local_authority",
+        "main": "web-app-prod-data/local_authority",
+        "subs": [
+            {"disp": "Barnet", "val": "web-app-prod-data/local_authority/barnet"},
+        ],
+    },
+    {
+        "type": "other",
+        "main": "web-app-prod-data/other",
+        "subs": [{"disp": "NHS", "val": "web-app-prod-data/other/nhs"}],
+    },
+]
+
+
+def write_catalogue(path, content, mtime):
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+    # Set the mtime so changes are seen on filesystems with coarse timestamps
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture()
+def catalogue_path(tmp_path):
+    catalogue_path = tmp_path / "s3paths.json"
+    write_catalogue(catalogue_path, CATALOGUE, 1_000_000_000)
+    return catalogue_path
+
+
+def test_validate_catalogue():
+    assert validate_catalogue(CATALOGUE) == []
+    assert validate_catalogue({}) == ["The catalogue is not a list of access types."]
+    assert validate_catalogue([{"type": "other", "main": "x"}]) == [
+        "Entry 0 has no subs list."
+    ]
+    assert validate_catalogue(
+        [{"type": "other", "main": "x", "subs": [{"disp": "NHS"}]}]
+    ) == ["Entry 0 has a sub without disp and val."]
+    assert validate_catalogue(CATALOGUE + CATALOGUE[1:]) == [
+        "web-app-prod-data/other/nhs appears more than once."
+    ]
+
+
+def test_path_catalogue_indexes(catalogue_path):
+    catalogue = PathCatalogue(str(catalogue_path), check_seconds=0)
+
+    assert catalogue.get_entries() == CATALOGUE
+    assert catalogue.entry_for_type("other") == CATALOGUE[1]
+    assert catalogue.entry_for_type("missing") == []
+    assert catalogue.folder("web-app-prod-data/local_authority/barnet") == {
+        "disp": "Barnet",
+        "val": "web-app-prod-data/local_authority/barnet",
+        "type": "local_authority",
+    }
+    assert catalogue.folder("web-app-prod-data/other") is None
+
+
+def test_path_catalogue_reloads_changes(catalogue_path):
+    catalogue = PathCatalogue(str(catalogue_path), check_seconds=0)
+    assert catalogue.get_entries() == CATALOGUE
+    assert catalogue.version == 1
+
+    # The same content written again isn't loaded again
+    write_catalogue(catalogue_path, CATALOGUE, 2_000_000_000)
+    catalogue.refresh()
+    assert catalogue.version == 1
+
+    write_catalogue(catalogue_path, CATALOGUE[1:], 3_000_000_000)
+    assert catalogue.get_entries() == CATALOGUE[1:]
+    assert catalogue.entry_for_type("local_authority") == []
+    assert catalogue.version == 2
+
+
+def test_path_catalogue_keeps_last_good_version(catalogue_path):
+    catalogue = PathCatalogue(str(catalogue_path), check_seconds=0)
+    assert catalogue.get_entries() == CATALOGUE
+
+    write_catalogue(catalogue_path, "[{", 2_000_000_000)
+    assert catalogue.get_entries() == CATALOGUE
+
+    write_catalogue(catalogue_path, [{"type": "other"}], 3_000_000_000)
+    assert catalogue.get_entries() == CATALOGUE
+    assert catalogue.version == 1
+
+
+def test_path_catalogue_throttles_checks(catalogue_path):
+    catalogue = PathCatalogue(str(catalogue_path), check_seconds=60)
+    assert catalogue.get_entries() == CATALOGUE
+
+    write_catalogue(catalogue_path, CATALOGUE[1:], 2_000_000_000)
+    assert catalogue.get_entries() == CATALOGUE
+
+
+def test_path_catalogue_missing_file(tmp_path):
+    catalogue = PathCatalogue(str(tmp_path / "s3paths.json"), check_seconds=0)
+    assert catalogue.get_entries() == []
+    assert catalogue.entry_for_type("other") == []
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+import pytest
+
+from access_policy import AccessPolicy
+import path_impact
+
+CATALOGUE = [
+    {
+        "type": "other",
+        "main": "web-app-prod-data/other",
+        "subs": [{"disp": "NHS", "val": "web-app-prod-data/other/nhs"}],
+    },
+]
+
+GRANTED_PATHS = {
+    "web-app-prod-data/other/nhs": ["a.user@nhs.net"],
+    "web-app-prod-data/other/nhs/trusts": ["b.user@nhs.net"],
+    "web-app-prod-data/other/retired": ["a.user@nhs.net", "c.user@dwp.gov.uk"],
+}
+
+
+@pytest.fixture()
+def policy():
+    policy = AccessPolicy(CATALOGUE, "web-app-prod-data", "web-app-upload")
+    with patch("path_impact.get_access_policy", return_value=policy):
+        yield policy
+
+
+@pytest.mark.usefixtures("policy")
+def test_orphaned_paths():
+    with patch("user_directory.granted_paths", return_value=GRANTED_PATHS):
+        assert path_impact.orphaned_paths() == {
+            "web-app-prod-data/other/retired": ["a.user@nhs.net", "c.user@dwp.gov.uk"]
+        }
+
+
+def test_report_lines():
+    assert list(path_impact.report_lines(GRANTED_PATHS))[-2:] == [
+        "web-app-prod-data/other/retired\ta.user@nhs.net\n",
+        "web-app-prod-data/other/retired\tc.user@dwp.gov.uk\n",
+    ]
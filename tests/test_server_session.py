@@ -0,0 +1,138 @@
+import time
+
+import pytest
+from flask import Flask, session
+
+from server_session import (
+    FilesystemSessionStore,
+    ServerSideSessionInterface,
+    SessionStore,
+    SQLiteSessionStore,
+    regenerate_session,
+)
+
+
+@pytest.fixture(params=["filesystem", "sqlite"])
+def session_store(request, tmp_path):
+    if request.param == "filesystem":
+        return FilesystemSessionStore(str(tmp_path / "sessions"))
+    return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+
+
+@pytest.fixture()
+def session_app(session_store):
+    session_app = Flask(__name__)
+    session_app.session_interface = ServerSideSessionInterface(session_store, 60)
+
+    @session_app.route("/visit")
+    def visit():
+        session["visited"] = True
+        return "visited"
+
+    @session_app.route("/login")
+    def login():
+        regenerate_session()
+        session["user"] = "test-user@test-domain.com"
+        session["attributes"] = [{"Name": "custom:is_la", "Value": "1"}]
+        return "logged in"
+
+    @session_app.route("/whoami")
+    def whoami():
+        return session.get("user", "nobody")
+
+    @session_app.route("/logout")
+    def logout():
+        session.pop("user", None)
+        regenerate_session()
+        return "logged out"
+
+    @session_app.route("/css/<path:path>")
+    def css(path):
+        return path
+
+    return session_app
+
+
+def session_cookie(response):
+    return response.headers.get("Set-Cookie", "").split(";")[0].split("=", 1)[-1]
+
+
+@pytest.mark.usefixtures("session_store")
+def test_session_store(session_store):
+    now = time.time()
+    session_store.save("a" * 43, '{"user":"a"}', now + 60)
+    session_store.save("b" * 43, '{"user":"b"}', now - 1)
+
+    assert session_store.load("a" * 43) == ('{"user":"a"}', now + 60)
+    assert session_store.load("b" * 43) is None
+    assert session_store.load("c" * 43) is None
+
+    assert session_store.sweep(now) == 1
+    session_store.delete("a" * 43)
+    assert session_store.load("a" * 43) is None
+
+
+@pytest.mark.usefixtures("session_app", "session_store")
+def test_server_side_session(session_app, session_store):
+    client = session_app.test_client()
+
+    response = client.get("/login")
+    session_id = session_cookie(response)
+    # The cookie only holds the session id
+    assert len(session_id) == 43
+    assert "test-user" not in response.headers["Set-Cookie"]
+    data, _ = session_store.load(session_id)
+    assert "test-user@test-domain.com" in data
+
+    assert client.get("/whoami").data == b"test-user@test-domain.com"
+    # An unchanged session isn't saved again
+    assert "Set-Cookie" not in client.get("/whoami").headers
+
+    response = client.get("/logout")
+    assert session_store.load(session_id) is None
+    assert client.get("/whoami").data == b"nobody"
+
+
+@pytest.mark.usefixtures("session_app", "session_store")
+def test_server_side_session_ignores_unknown_ids(session_app, session_store):
+    client = session_app.test_client()
+    client.set_cookie("localhost", "session", "x" * 43)
+
+    response = client.get("/login")
+    assert session_cookie(response) != "x" * 43
+    assert session_store.load("x" * 43) is None
+
+
+@pytest.mark.usefixtures("session_app", "session_store")
+def test_server_side_session_skips_static_files(session_app, session_store):
+    client = session_app.test_client()
+    client.get("/login")
+
+    session_store.load = None
+    assert client.get("/css/main.css").data == b"main.css"
+
+
+@pytest.mark.usefixtures("session_app", "session_store")
+def test_server_side_session_id_changes_on_login(session_app, session_store):
+    client = session_app.test_client()
+
+    anonymous_id = session_cookie(client.get("/visit"))
+    login_id = session_cookie(client.get("/login"))
+    assert login_id != anonymous_id
+    # The id from before login no longer loads a session
+    assert session_store.load(anonymous_id) is None
+    assert "test-user@test-domain.com" in session_store.load(login_id)[0]
+
+    logout_id = session_cookie(client.get("/logout"))
+    assert logout_id not in ("", login_id)
+    assert session_store.load(login_id) is None
+    assert client.get("/whoami").data == b"nobody"
+
+
+def test_session_store_must_be_complete():
+    class LoadOnlyStore(SessionStore):
+        def load(self, session_id):
+            return None
+
+    with pytest.raises(TypeError):
+        LoadOnlyStore()
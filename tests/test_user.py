@@ -1,10 +1,14 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 import pytest
 
 import stubs
 import config
-from user import User
+from cognito_groups import get_group_by_name
+from user import USER_DETAILS_CACHE, User, UserDetailsCache, clear_group_map_cache
 
 
 def test_user_init_email_sanitised():
@@ -248,6 +252,35 @@ def test_user_reinvite_valid_user_success(
         stubber.deactivate()
 
 
+@pytest.mark.usefixtures(
+    "valid_user", "admin_user", "admin_get_user", "create_user_arguments"
+)
+def test_user_reinvite_notifies_changes(
+    valid_user, admin_user, admin_get_user, create_user_arguments, monkeypatch
+):
+    changes = []
+    monkeypatch.setattr(
+        "user.USER_CHANGE_LISTENERS",
+        [lambda email, details: changes.append((email, details))],
+    )
+    stubber = stubs.mock_user_reinvite(
+        admin_user, admin_get_user, create_user_arguments
+    )
+    with stubber:
+        assert valid_user.reinvite()
+        stubber.deactivate()
+
+    assert [(email, details is None) for email, details in changes] == [
+        (admin_user["email"], True),
+        (admin_user["email"], False),
+    ]
+    created = changes[1][1]
+    assert created["username"] == admin_user["email"]
+    assert created["custom:paths"] == admin_user["custom:paths"]
+    assert created["group"]["value"] == admin_user["group"]["value"]
+    assert created["enabled"]
+
+
 @pytest.mark.usefixtures("valid_user", "admin_user")
 def test_user_reinvite_user_not_found_fail(valid_user, admin_user):
     stubber = stubs.mock_user_not_found(admin_user["email"])
@@ -339,3 +372,303 @@ def test_user_create_fails_if_admin_add_user_to_group_fails(
             group_name,
         )
         stubber.deactivate()
+
+
+@pytest.mark.usefixtures("list_users_arguments", "list_users_response")
+def test_user_list_resolves_groups_in_bulk(list_users_arguments, list_users_response):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    group_members = {
+        "standard-download": ["justin.casey@communities.gov.uk"],
+        "standard-upload": [],
+        "admin-view": [],
+        "admin-power": [],
+        "admin-full": ["admin.user@communities.gov.uk"],
+    }
+    # No admin_list_groups_for_user responses are stubbed
+    # so a per-user group lookup would fail the test
+    stubber = stubs.mock_user_list(
+        list_users_arguments, list_users_response, group_members
+    )
+
+    with stubber:
+        result = User.list()
+        groups = {user["username"]: user["group"]["value"] for user in result["users"]}
+        assert groups == {
+            "justin.casey@communities.gov.uk": "standard-download",
+            "admin.user@communities.gov.uk": "admin-full",
+        }
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_user_details_cache_expires_and_evicts():
+    cache = UserDetailsCache(max_size=2, ttl=30)
+    cache.set("a@test.gov.uk", {"email": "a@test.gov.uk"})
+    cache.set("b@test.gov.uk", {"email": "b@test.gov.uk"})
+    # reading a marks it recently used so b is evicted next
+    assert cache.get("a@test.gov.uk") == {"email": "a@test.gov.uk"}
+    cache.set("c@test.gov.uk", {"email": "c@test.gov.uk"})
+    assert cache.get("b@test.gov.uk") is None
+    assert cache.get("a@test.gov.uk") is not None
+
+    cache.update("a@test.gov.uk", enabled=False)
+    assert cache.get("a@test.gov.uk")["enabled"] is False
+    cache.invalidate("a@test.gov.uk")
+    assert cache.get("a@test.gov.uk") is None
+
+    expired = UserDetailsCache(ttl=0)
+    expired.set("a@test.gov.uk", {"email": "a@test.gov.uk"})
+    assert expired.get("a@test.gov.uk") is None
+
+
+@pytest.mark.usefixtures("valid_user", "admin_get_user")
+def test_get_details_is_cached(valid_user, admin_get_user):
+    email = valid_user.email_address
+    stubber = stubs.mock_user_get_details(email, admin_get_user)
+    with stubber:
+        details = valid_user.get_details()
+        stubber.assert_no_pending_responses()
+        # A second user object is served from the cache
+        # without any further cognito calls
+        assert User(email).get_details() == details
+        stubber.deactivate()
+
+    stubber = stubs.mock_cognito_admin_disable_user(email)
+    with stubber:
+        assert User(email).disable()
+        assert USER_DETAILS_CACHE.get(email)["enabled"] is False
+        stubber.deactivate()
+
+    stubber = stubs.mock_cognito_admin_delete_user(email)
+    with stubber:
+        assert User(email).delete()
+        assert USER_DETAILS_CACHE.get(email) is None
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("admin_user")
+def test_user_create_runs_post_create_steps_concurrently(admin_user, monkeypatch):
+    monkeypatch.setattr("user.POST_CREATE_EXECUTOR", ThreadPoolExecutor(3))
+    # Each step only returns once all three are running at the same time
+    barrier = threading.Barrier(3, timeout=5)
+
+    def concurrent_step(*args):
+        barrier.wait()
+        return True
+
+    def failing_step(*args):
+        barrier.wait()
+        return False
+
+    arguments = [
+        admin_user["name"],
+        admin_user["phone_number"],
+        admin_user["custom:paths"],
+        admin_user["custom:is_la"],
+        admin_user["group"]["value"],
+    ]
+
+    with patch("user.cognito") as mocked_cognito:
+        mocked_cognito.create_user.return_value = True
+        mocked_cognito.set_mfa_preferences.side_effect = concurrent_step
+        mocked_cognito.set_user_settings.side_effect = concurrent_step
+        mocked_cognito.add_to_group.side_effect = concurrent_step
+        assert User(admin_user["email"]).create(*arguments)
+        mocked_cognito.disable_user.assert_not_called()
+
+    barrier.reset()
+    with patch("user.cognito") as mocked_cognito:
+        mocked_cognito.create_user.return_value = True
+        mocked_cognito.set_mfa_preferences.side_effect = concurrent_step
+        mocked_cognito.set_user_settings.side_effect = concurrent_step
+        mocked_cognito.add_to_group.side_effect = failing_step
+        with patch("user.config.set_session_var") as mocked_set_session_var:
+            assert not User(admin_user["email"]).create(*arguments)
+        mocked_cognito.disable_user.assert_called_once_with(admin_user["email"])
+    # The same message as adding to a group outside of create
+    mocked_set_session_var.assert_any_call(
+        "error_message", "Failed to add user to standard-download group."
+    )
+
+
+@pytest.mark.usefixtures("admin_user")
+def test_user_set_group(admin_user):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    email = admin_user["email"]
+    user = User(email)
+    user.details = {"group": get_group_by_name("standard-download")}
+
+    # No Cognito calls are made if the group is unchanged
+    assert user.set_group("standard-download")
+
+    stubber = stubs.mock_user_set_group(email, "standard-download", "standard-upload")
+    with stubber:
+        assert user.set_group("standard-upload")
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("admin_user")
+def test_user_status_and_group_changes_notify(admin_user, monkeypatch):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    changes = []
+    monkeypatch.setattr(
+        "user.USER_CHANGE_LISTENERS",
+        [lambda email, details: changes.append((email, details))],
+    )
+    email = admin_user["email"]
+
+    stubber = stubs.mock_cognito_admin_disable_user(email)
+    with stubber:
+        assert User(email).disable()
+        stubber.deactivate()
+    stubber = stubs.mock_cognito_admin_enable_user(email)
+    with stubber:
+        assert User(email).enable()
+        stubber.deactivate()
+
+    user = User(email)
+    user.details = {"group": get_group_by_name("standard-download")}
+    stubber = stubs.mock_user_set_group(email, "standard-download", "standard-upload")
+    with stubber:
+        assert user.set_group("standard-upload")
+        stubber.deactivate()
+
+    assert [email for email, details in changes] == [email] * 3
+    assert [details.get("enabled") for email, details in changes] == [
+        False,
+        True,
+        None,
+    ]
+    assert changes[2][1]["group"]["value"] == "standard-upload"
+
+
+LIST_GROUP_MEMBERS = {
+    "standard-download": ["justin.casey@communities.gov.uk"],
+    "standard-upload": [],
+    "admin-view": [],
+    "admin-power": [],
+    "admin-full": ["admin.user@communities.gov.uk"],
+}
+
+
+@pytest.mark.usefixtures("list_users_arguments", "list_users_response")
+def test_user_list_skips_empty_pages(list_users_arguments, list_users_response):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    responses = [
+        {"Users": [], "PaginationToken": "page-2"},
+        {"Users": [], "PaginationToken": "page-3"},
+        dict(list_users_response, PaginationToken="page-4"),
+    ]
+    stubber = stubs.mock_user_list_pages(
+        list_users_arguments, responses, LIST_GROUP_MEMBERS
+    )
+
+    with stubber:
+        result = User.list()
+        assert len(result["users"]) == 2
+        assert result["token"] == "page-4"
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("list_users_arguments")
+def test_user_list_is_bounded(list_users_arguments):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    responses = [
+        {"Users": [], "PaginationToken": "page-2"},
+        {"Users": [], "PaginationToken": "page-3"},
+    ]
+    stubber = stubs.mock_user_list_pages(list_users_arguments, responses, {})
+
+    with stubber:
+        # Only two pages are read so the caller can carry on from page 3
+        assert User.list(max_pages=2) == {"users": [], "token": "page-3"}
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("list_users_arguments")
+def test_user_list_with_no_users(list_users_arguments):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    list_users_arguments["Filter"] = 'email ^= "nobody"'
+    stubber = stubs.mock_user_list_pages(list_users_arguments, [{"Users": []}], {})
+
+    with stubber:
+        assert User.list("nobody") == {"users": [], "token": ""}
+        stubber.deactivate()
+
+
+@pytest.mark.usefixtures("list_users_arguments", "list_users_response")
+def test_user_iter_users(list_users_arguments, list_users_response):
+    config.set("cognito_pool_id", stubs.MOCK_COGNITO_USER_POOL_ID)
+    list_users_arguments["Limit"] = 60
+    responses = [
+        dict(list_users_response, PaginationToken="page-2"),
+        {"Users": [], "PaginationToken": "page-3"},
+        list_users_response,
+    ]
+    stubber = stubs.mock_user_list_pages(
+        list_users_arguments, responses, LIST_GROUP_MEMBERS
+    )
+
+    with stubber:
+        users = User.iter_users()
+        assert [user["username"] for user in users] == [
+            "justin.casey@communities.gov.uk",
+            "admin.user@communities.gov.uk",
+        ] * 2
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+    # The group map from the first walk is reused
+    stubber = stubs.mock_user_list_pages(list_users_arguments, responses[:1], {})
+    with stubber:
+        # Only the first page is fetched for the first user
+        users = list(User.iter_users(max_users=1))
+        assert [user["username"] for user in users] == [
+            "justin.casey@communities.gov.uk"
+        ]
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+
+def test_group_map_drops_sweep_overlapping_a_change(monkeypatch):
+    responses = {"standard-download": [], "standard-upload": []}
+
+    def list_users_in_group(group_name, token):
+        users = responses.get(group_name, [])
+        return {"Users": [{"Username": username} for username in users]}
+
+    responses["standard-download"] = ["moved-user"]
+
+    def list_during_change(group_name, token):
+        # The user is regrouped while the first sweep is running
+        response = list_users_in_group(group_name, token)
+        if group_name == "standard-download" and mocked.call_count == 1:
+            responses["standard-download"] = []
+            responses["standard-upload"] = ["moved-user"]
+            clear_group_map_cache()
+        return response
+
+    with patch("user.cognito.list_users_in_group") as mocked:
+        mocked.side_effect = list_during_change
+        assert User.group_map()["moved-user"] == "standard-upload"
+        sweeps = mocked.call_count
+        # The second sweep's result is cached
+        assert User.group_map()["moved-user"] == "standard-upload"
+        assert mocked.call_count == sweeps
+
+        clear_group_map_cache()
+        assert User.group_map()["moved-user"] == "standard-upload"
+        assert mocked.call_count == sweeps * 3 // 2
+
+    # A cache which keeps being cleared isn't trusted at all
+    def always_changing(group_name, token):
+        clear_group_map_cache()
+        return list_users_in_group(group_name, token)
+
+    clear_group_map_cache()
+    with patch("user.cognito.list_users_in_group", side_effect=always_changing):
+        assert User.group_map() is None
+    clear_group_map_cache()
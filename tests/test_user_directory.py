@@ -0,0 +1,179 @@
+import os
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+
+from cognito_groups import get_group_by_name
+import user_directory
+
+LA_PATH = "web-app-prod-data/local_authority/haringey"
+OTHER_PATH = "web-app-prod-data/other/gds"
+
+
+def pool_user(email, group_name="standard-download", modified=1, **attributes):
+    user = {
+        "username": email,
+        "status": "CONFIRMED",
+        "createdate": datetime(2020, 6, 1, tzinfo=timezone.utc),
+        "lastmodifieddate": datetime(2020, 6, modified, tzinfo=timezone.utc),
+        "enabled": True,
+        "email": email,
+        "name": "Test User",
+        "phone_number": "+447700900123",
+        "phone_number_verified": "true",
+        "custom:is_la": "1",
+        "custom:paths": LA_PATH,
+        "group": get_group_by_name(group_name),
+    }
+    user.update(attributes)
+    return user
+
+
+def sync(*pages):
+    users = [user for page in pages for user in page]
+    with patch("user_directory.User.iter_users", return_value=iter(users)):
+        return user_directory.sync_user_directory()
+
+
+POOL = [
+    pool_user("la.user@haringey.gov.uk"),
+    pool_user(
+        "other.user@communities.gov.uk",
+        group_name="admin-full",
+        **{"custom:is_la": "0", "custom:paths": f"{OTHER_PATH};{OTHER_PATH}-extra"},
+    ),
+    pool_user("new.user@nhs.net", phone_number_verified="false"),
+]
+
+
+@pytest.mark.usefixtures("user_directory_path")
+def test_sync_user_directory():
+    assert user_directory.last_synced() is None
+    assert sync(POOL[:2], POOL[2:]) == {"seen": 3, "written": 3, "removed": 0}
+    assert user_directory.last_synced() is not None
+
+    # Only changed users are written and missing users removed
+    changed_user = pool_user("la.user@haringey.gov.uk", modified=2)
+    regrouped_user = pool_user("new.user@nhs.net", group_name="standard-upload")
+    assert sync([changed_user, regrouped_user]) == {
+        "seen": 2,
+        "written": 2,
+        "removed": 1,
+    }
+    assert sync([changed_user, regrouped_user]) == {
+        "seen": 2,
+        "written": 0,
+        "removed": 0,
+    }
+
+    users = user_directory.search_users()
+    assert [user["email"] for user in users] == [
+        "la.user@haringey.gov.uk",
+        "new.user@nhs.net",
+    ]
+    assert users[0]["lastmodifieddate"] == "2020-06-02T00:00:00+00:00"
+    assert users[1]["group"]["value"] == "standard-upload"
+
+
+@pytest.mark.usefixtures("user_directory_path")
+@pytest.mark.parametrize(
+    "filters, emails",
+    [
+        ({"email_prefix": "Other."}, ["other.user@communities.gov.uk"]),
+        (
+            {"domain": "gov.uk"},
+            ["la.user@haringey.gov.uk", "other.user@communities.gov.uk"],
+        ),
+        ({"domain": "haringey.gov.uk"}, ["la.user@haringey.gov.uk"]),
+        ({"domain": "ringey.gov.uk"}, []),
+        ({"group_name": "admin-full"}, ["other.user@communities.gov.uk"]),
+        ({"is_la": False}, ["other.user@communities.gov.uk"]),
+        ({"is_la": True, "domain": "nhs.net"}, ["new.user@nhs.net"]),
+        ({"path_prefix": OTHER_PATH}, ["other.user@communities.gov.uk"]),
+        (
+            {"path_prefix": "web-app-prod-data/local_authority/"},
+            ["la.user@haringey.gov.uk", "new.user@nhs.net"],
+        ),
+        ({"phone_unverified": True}, ["new.user@nhs.net"]),
+    ],
+)
+def test_search_users(filters, emails):
+    sync(POOL)
+    assert [user["email"] for user in user_directory.search_users(**filters)] == emails
+
+
+@pytest.mark.usefixtures("user_directory_path")
+def test_sync_if_stale():
+    with patch("user_directory.sync_user_directory") as mocked_sync:
+        user_directory.sync_if_stale()
+        mocked_sync.assert_called_once_with()
+
+    sync(POOL)
+    with patch("user_directory.sync_user_directory") as mocked_sync:
+        user_directory.sync_if_stale()
+        mocked_sync.assert_not_called()
+        user_directory.sync_if_stale(max_age=-1)
+        mocked_sync.assert_called_once_with()
+
+
+@pytest.mark.usefixtures("user_directory_path")
+def test_path_holders():
+    sync(POOL)
+    assert user_directory.path_holders(f"{OTHER_PATH}/") == {
+        OTHER_PATH: ["other.user@communities.gov.uk"]
+    }
+    assert user_directory.path_holders("web-app-prod-data/local_authority") == {
+        LA_PATH: ["la.user@haringey.gov.uk", "new.user@nhs.net"]
+    }
+    # A folder sharing a name prefix isn't inside the folder
+    assert user_directory.path_holders(f"{OTHER_PATH}-extra") == {
+        f"{OTHER_PATH}-extra": ["other.user@communities.gov.uk"]
+    }
+    assert list(user_directory.granted_paths()) == [
+        LA_PATH,
+        OTHER_PATH,
+        f"{OTHER_PATH}-extra",
+    ]
+
+
+@pytest.mark.usefixtures("user_directory_path")
+def test_apply_user_change(user_directory_path):
+    # Nothing is written until there is a mirror
+    user_directory.apply_user_change("la.user@haringey.gov.uk", POOL[0])
+    assert not os.path.exists(user_directory_path)
+
+    sync(POOL)
+    moved_user = pool_user(
+        "la.user@haringey.gov.uk", **{"custom:paths": f"{LA_PATH}-new"}
+    )
+    user_directory.apply_user_change("la.user@haringey.gov.uk", moved_user)
+    user_directory.apply_user_change("New.User@nhs.net", None)
+
+    assert user_directory.path_holders(LA_PATH) == {}
+    assert user_directory.path_holders(f"{LA_PATH}-new") == {
+        f"{LA_PATH}-new": ["la.user@haringey.gov.uk"]
+    }
+    assert [user["email"] for user in user_directory.search_users()] == [
+        "la.user@haringey.gov.uk",
+        "other.user@communities.gov.uk",
+    ]
+
+
+@pytest.mark.usefixtures("user_directory_path")
+def test_apply_partial_user_change(user_directory_path):
+    sync(POOL)
+    modified = datetime(2020, 7, 1, tzinfo=timezone.utc)
+    user_directory.apply_user_change(
+        "La.User@haringey.gov.uk", {"enabled": False, "lastmodifieddate": modified}
+    )
+    user_directory.apply_user_change(
+        "new.user@nhs.net", {"group": get_group_by_name("standard-upload")}
+    )
+
+    users = {user["email"]: user for user in user_directory.search_users()}
+    assert not users["la.user@haringey.gov.uk"]["enabled"]
+    assert users["la.user@haringey.gov.uk"]["lastmodifieddate"] == modified.isoformat()
+    assert users["la.user@haringey.gov.uk"]["custom:paths"] == LA_PATH
+    assert users["new.user@nhs.net"]["group"]["value"] == "standard-upload"
+    assert users["new.user@nhs.net"]["enabled"]
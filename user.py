@@ -1,10 +1,117 @@
+import copy
+import itertools
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+from access_policy import get_access_policy
 import cognito
-from cognito_groups import get_group_by_name
+from cognito_groups import get_group_by_name, get_group_map
 import config
 from logger import LOG
 
+# Most list_users calls one User.list makes skipping empty pages
+LIST_MAX_PAGES = 10
+
+# Cognito returns at most 60 users per list_users call
+LIST_USERS_PAGE_SIZE = 60
+
+# How long a bulk username -> group name lookup is reused
+GROUP_MAP_TTL_SECONDS = 60
+
+# A sweep overlapping a group change is run again at most this often
+GROUP_MAP_SWEEP_ATTEMPTS = 3
+
+# Holds (expires, generation, groups). The generation goes up on
+# each clear so a sweep which overlapped a change isn't kept.
+GROUP_MAP_CACHE = {"entry": (0, 0, None)}
+
+GROUP_MAP_LOCK = threading.Lock()
+
+
+def clear_group_map_cache():
+    with GROUP_MAP_LOCK:
+        _, generation, _ = GROUP_MAP_CACHE["entry"]
+        GROUP_MAP_CACHE["entry"] = (0, generation + 1, None)
+
+
+class UserDetailsCache:
+    """
+    Per-process, size bounded cache of normalised user details
+    keyed by normalised email address.
+
+    Entries expire after ttl seconds so changes made by other
+    processes are picked up. The least recently used entry is
+    evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size=256, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires, details = entry
+            if expires <= time.monotonic():
+                del self._entries[email]
+                return None
+            self._entries.move_to_end(email)
+            return copy.deepcopy(details)
+
+    def set(self, email, details):
+        with self._lock:
+            expires = time.monotonic() + self.ttl
+            self._entries[email] = (expires, copy.deepcopy(details))
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, email, **fields):
+        """ Write fields through to a cached entry if there is one """
+        with self._lock:
+            if email in self._entries:
+                self._entries[email][1].update(fields)
+
+    def invalidate(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+USER_DETAILS_CACHE = UserDetailsCache()
+
+# The admin calls made after a user is created are independent
+# so they are run side by side on this small shared pool
+POST_CREATE_EXECUTOR = ThreadPoolExecutor(max_workers=3, thread_name_prefix="user")
+
+SET_MFA_ERROR = "Failed to set MFA preferences."
+
+SET_SETTINGS_ERROR = "Failed to set preferred MFA to mobile."
+
+ADD_TO_GROUP_ERROR = "Failed to add user to {} group."
+
+# Called as listener(email_address, details) with the user's
+# new details after a user is created or changed through User
+# and with details None after one is deleted. When the user's
+# details weren't loaded, details only holds the changed fields
+USER_CHANGE_LISTENERS = []
+
+
+def notify_user_changed(email_address, details):
+    for listener in USER_CHANGE_LISTENERS:
+        listener(email_address, details)
+
 
 # This class represents a user and performs
 # the necessary validations with cognito
@@ -14,7 +121,6 @@ class User:
             email_address.strip().lower().encode("latin1").decode("utf-8")
         )
         self.details = {}
-        self.cognito_client = cognito.get_boto3_client()
 
     def name(self):
         return self.get_details().get("name", "")
@@ -97,9 +203,23 @@ class User:
             )
 
         if steps.get("created"):
-            steps["set_mfa"] = self.set_mfa_preferences()
-            steps["set_settings"] = self.set_user_settings()
-            steps["added_to_group"] = self.add_to_group(group_name)
+            USER_DETAILS_CACHE.invalidate(self.email_address)
+            steps.update(self.run_post_create_steps(group_name))
+            notify_user_changed(
+                self.email_address,
+                self.changed_details(
+                    {
+                        "name": name,
+                        "phone_number": phone_number,
+                        "phone_number_verified": "false",
+                        "custom:is_la": is_la,
+                        "custom:paths": custom_paths,
+                        "group": get_group_by_name(group_name),
+                        "enabled": all(steps.values()),
+                    },
+                    created=True,
+                ),
+            )
         else:
             error = "Failed to create user."
 
@@ -123,39 +243,75 @@ class User:
         # Return True only if all settings were successfully set
         return all(steps.values())
 
-    def set_mfa_preferences(self):
-        is_set = cognito.set_mfa_preferences(self.email_address)
-        if not is_set:
-            config.set_session_var("error_message", "Failed to set MFA preferences.")
-        return is_set
+    def run_post_create_steps(self, group_name):
+        """
+        Run the admin calls needed after cognito.create_user
+        concurrently and return their status by step.
 
-    def set_user_settings(self):
-        is_set = cognito.set_user_settings(self.email_address)
-        if not is_set:
-            config.set_session_var(
-                "error_message", "Failed to set preferred MFA to mobile."
-            )
-        return is_set
+        Error messages are set here rather than in the worker
+        threads as those have no request context. The threads
+        create their clients under cognito.CLIENT_LOCK.
+        """
+        futures = {
+            "set_mfa": POST_CREATE_EXECUTOR.submit(
+                cognito.set_mfa_preferences, self.email_address
+            ),
+            "set_settings": POST_CREATE_EXECUTOR.submit(
+                cognito.set_user_settings, self.email_address
+            ),
+            "added_to_group": POST_CREATE_EXECUTOR.submit(
+                cognito.add_to_group, self.email_address, group_name
+            ),
+        }
+        steps = {step: future.result() for step, future in futures.items()}
+        clear_group_map_cache()
+
+        error_messages = {
+            "set_mfa": SET_MFA_ERROR,
+            "set_settings": SET_SETTINGS_ERROR,
+            "added_to_group": ADD_TO_GROUP_ERROR.format(group_name),
+        }
+        for step, is_set in steps.items():
+            if not is_set:
+                config.set_session_var("error_message", error_messages[step])
+        return steps
 
     def add_to_group(self, group_name=None):
         is_set = cognito.add_to_group(self.email_address, group_name)
+        clear_group_map_cache()
         if not is_set:
             config.set_session_var(
-                "error_message", f"Failed to add user to {group_name} group."
+                "error_message", ADD_TO_GROUP_ERROR.format(group_name)
             )
         return is_set
 
     def set_group(self, new_group_name):
+        """
+        Move the user from their current group to new_group_name
+
+        Returns True if the user ends up in new_group_name.
+        """
         if new_group_name is None:
-            return
+            return False
         if not isinstance(new_group_name, str):
             raise ValueError("ERR: %s: new_group_name is not str")
 
         current_group_name = self.details["group"]["value"]
-        if current_group_name != new_group_name:
-            removed = cognito.remove_from_group(self.email_address, current_group_name)
-            if removed:
-                self.add_to_group(new_group_name)
+        if current_group_name == new_group_name:
+            return True
+
+        removed = cognito.remove_from_group(self.email_address, current_group_name)
+        if not removed:
+            return False
+        clear_group_map_cache()
+        USER_DETAILS_CACHE.invalidate(self.email_address)
+        added = self.add_to_group(new_group_name)
+        if added:
+            notify_user_changed(
+                self.email_address,
+                self.changed_details({"group": get_group_by_name(new_group_name)}),
+            )
+        return added
 
     def sanitise_phone(self, phone_number):
         if phone_number != "":
@@ -223,9 +379,17 @@ class User:
         # If all tests have passed try the update
         if all(steps.values()):
             steps["updated"] = cognito.update_user(self.email_address, user_attributes)
+            USER_DETAILS_CACHE.invalidate(self.email_address)
             if not steps.get("updated"):
                 error = "The fields were valid but the user failed to update."
 
+        if steps.get("updated"):
+            changes = {
+                attribute["Name"]: attribute["Value"] for attribute in user_attributes
+            }
+            changes["group"] = get_group_by_name(group)
+            notify_user_changed(self.email_address, self.changed_details(changes))
+
         if error:
             config.set_session_var("error_message", error)
             LOG.error(
@@ -239,6 +403,23 @@ class User:
         # Return True if valid and updated
         return all(steps.values())
 
+    def changed_details(self, changes, created=False):
+        """ Return the user's details with changes applied """
+        now = datetime.now(timezone.utc)
+        if created:
+            # cognito.create_user uses the email address as the username
+            details = {
+                "username": self.email_address,
+                "email": self.email_address,
+                "status": "FORCE_CHANGE_PASSWORD",
+                "createdate": now,
+            }
+        else:
+            details = copy.deepcopy(self.details)
+        details.update(changes)
+        details["lastmodifieddate"] = now
+        return details
+
     def __attribute(self, field_name, value):
         if value is None:
             return []
@@ -278,30 +459,25 @@ class User:
             )
             all_user_paths_are_valid = False
 
-        app_authorised_paths = [config.get("bucket_main_prefix", "web-app-prod-data")]
-
-        user_authorised_paths = paths_semicolon_separated.split(";")
-
         # Local Authority users: is_la = 1
         # can only be granted access to [main_prefix]/local_authority/* paths
         # Non Local Authority users: is_la = 0
-        # can only be granted access to [main_prefix]/other/* paths
-        for authorised_path in app_authorised_paths:
-            for path in user_authorised_paths:
-                la_path = "{}/local_authority/".format(authorised_path)
-                user_is_local_authority = is_la == "1"
-                path_is_local_authority = path.startswith(la_path)
-                if user_is_local_authority != path_is_local_authority:
-                    LOG.error(
-                        {
-                            "user": self.email_address,
-                            "group": group_name,
-                            "path": path,
-                            "is_la": is_la,
-                            "message": "Path is invalid for user type",
-                        }
-                    )
-                    all_user_paths_are_valid = False
+        # can only be granted access to paths outside it
+        user_authorised_paths = [
+            path for path in paths_semicolon_separated.split(";") if path != ""
+        ]
+        policy = get_access_policy()
+        for path in policy.invalid_paths(is_la == "1", user_authorised_paths):
+            LOG.error(
+                {
+                    "user": self.email_address,
+                    "group": group_name,
+                    "path": path,
+                    "is_la": is_la,
+                    "message": "Path is invalid for user type",
+                }
+            )
+            all_user_paths_are_valid = False
 
         return all_user_paths_are_valid
 
@@ -321,7 +497,11 @@ class User:
                 "ERR: %s: the email %s is not valid", "user-admin", self.email_address
             )
             return False
-        return cognito.delete_user(self.email_address)
+        USER_DETAILS_CACHE.invalidate(self.email_address)
+        deleted = cognito.delete_user(self.email_address)
+        if deleted:
+            notify_user_changed(self.email_address, None)
+        return deleted
 
     def disable(self):
         if not self.email_address_is_valid():
@@ -329,7 +509,13 @@ class User:
                 "ERR: %s: the email %s is not valid", "user-admin", self.email_address
             )
             return False
-        return cognito.disable_user(self.email_address)
+        disabled = cognito.disable_user(self.email_address)
+        if disabled:
+            USER_DETAILS_CACHE.update(self.email_address, enabled=False)
+            notify_user_changed(
+                self.email_address, self.changed_details({"enabled": False})
+            )
+        return disabled
 
     def enable(self):
         if not self.email_address_is_valid():
@@ -337,7 +523,13 @@ class User:
                 "ERR: %s: the email %s is not valid", "user-admin", self.email_address
             )
             return False
-        return cognito.enable_user(self.email_address)
+        enabled = cognito.enable_user(self.email_address)
+        if enabled:
+            USER_DETAILS_CACHE.update(self.email_address, enabled=True)
+            notify_user_changed(
+                self.email_address, self.changed_details({"enabled": True})
+            )
+        return enabled
 
     def reinvite(self):
         details = self.get_details()
@@ -359,9 +551,13 @@ class User:
         return False
 
     def get_details(self):
+        if self.details == {}:
+            self.details = USER_DETAILS_CACHE.get(self.email_address) or {}
         if self.details == {}:
             aws_details = cognito.get_user(self.email_address)
             self.details = User.normalise(aws_details)
+            if self.details != {}:
+                USER_DETAILS_CACHE.set(self.email_address, self.details)
         return self.details
 
     def email_address_is_valid(self):
@@ -391,7 +587,30 @@ class User:
         ]
 
     @staticmethod
-    def list(email_starts_filter="", token="", limit=20):
+    def list(email_starts_filter="", token="", limit=20, max_pages=LIST_MAX_PAGES):
+        """
+        Return a page of up to limit users and the token for the next page
+
+        Cognito can return an empty page with a token for more
+        when a filter is sparse. Empty pages are skipped, making
+        at most max_pages list_users calls, so the token returned
+        may be for a later page with users on it.
+        """
+        page = {"users": [], "token": ""}
+        pages = User.iter_pages(email_starts_filter, token, limit)
+        for page in itertools.islice(pages, max_pages):
+            if page["users"]:
+                break
+        return page
+
+    @staticmethod
+    def iter_pages(email_starts_filter="", token="", limit=LIST_USERS_PAGE_SIZE):
+        """
+        Yield each page of users from token onwards
+        as {"users": [...], "token": next_token}
+
+        Pages are only fetched as they are consumed.
+        """
         arguments = {
             "AttributesToGet": [
                 "name",
@@ -405,31 +624,47 @@ class User:
             ],
             "Limit": limit,
         }
+        arguments["UserPoolId"] = config.get("cognito_pool_id")
         if email_starts_filter != "":
             arguments["Filter"] = 'email ^= "{}"'.format(email_starts_filter)
-        if token != "":
-            arguments["PaginationToken"] = token
+
         cognito_client = cognito.get_boto3_client()
-        response = cognito_client.list_users(**arguments)
-        token = ""
-        users = []
-        if "Users" in response:
-            for aws_user_details in response["Users"]:
-                user = User.normalise(aws_user_details)
+        while True:
+            if token != "":
+                arguments["PaginationToken"] = token
+            response = cognito.call_api(cognito_client, "list_users", **arguments)
+            aws_users = response.get("Users", [])
+            group_map = User.group_map() if aws_users else None
+            users = []
+            for aws_user_details in aws_users:
+                user = User.normalise(aws_user_details, group_map)
                 if user != {}:
                     users.append(user)
-            if "PaginationToken" in response:
-                token = response["PaginationToken"]
-            # Edge case where users could be blank but there is
-            # a token for getting more users
-            if not any(response["Users"]) and not token:
-                return list(
-                    email_starts_filter=email_starts_filter, limit=limit, token=token
-                )
-        return {"users": users, "token": token}
+            token = response.get("PaginationToken", "")
+            yield {"users": users, "token": token}
+            if token == "":
+                return
 
     @staticmethod
-    def normalise(aws_details):
+    def iter_users(email_starts_filter="", limit=LIST_USERS_PAGE_SIZE, max_users=None):
+        """
+        Lazily yield every user matching the filter a page at a time
+
+        Stops after max_users users if it is set.
+        """
+        users = itertools.chain.from_iterable(
+            page["users"] for page in User.iter_pages(email_starts_filter, "", limit)
+        )
+        return itertools.islice(users, max_users)
+
+    @staticmethod
+    def normalise(aws_details, group_map=None):
+        """
+        Flatten cognito user details into a dict
+
+        Pass a group_map from User.group_map() when normalising
+        many users to avoid a group lookup per user.
+        """
         result = {}
         if "Username" in aws_details:
             result = {
@@ -443,10 +678,65 @@ class User:
                 "Attributes" if "Attributes" in aws_details else "UserAttributes"
             ]:
                 result[attr["Name"]] = attr["Value"]
+            if "MFAOptions" in aws_details:
+                result["mfa_options"] = aws_details["MFAOptions"]
         if "username" in result:
-            result["group"] = User.group(result["username"])
+            if group_map is None:
+                result["group"] = User.group(result["username"])
+            else:
+                result["group"] = get_group_by_name(group_map.get(result["username"]))
         return result
 
+    @staticmethod
+    def group_map():
+        """
+        Return a dict of username to group name for every user
+        in one of the app's groups.
+
+        Built with a paged list_users_in_group sweep of each group
+        and reused for GROUP_MAP_TTL_SECONDS. A sweep during which
+        a user's group changed is run again.
+        Returns None if any group could not be listed
+        or groups kept changing during the sweeps.
+        """
+        for _ in range(GROUP_MAP_SWEEP_ATTEMPTS):
+            with GROUP_MAP_LOCK:
+                expires, generation, groups = GROUP_MAP_CACHE["entry"]
+            if groups is not None and expires > time.monotonic():
+                return groups
+
+            groups = User.sweep_groups()
+            if groups is None:
+                return None
+
+            with GROUP_MAP_LOCK:
+                if GROUP_MAP_CACHE["entry"][1] == generation:
+                    GROUP_MAP_CACHE["entry"] = (
+                        time.monotonic() + GROUP_MAP_TTL_SECONDS,
+                        generation,
+                        groups,
+                    )
+                    return groups
+        # Callers look each user's group up instead
+        return None
+
+    @staticmethod
+    def sweep_groups():
+        groups = {}
+        # Like User.group only the first group for a user is used
+        for group_name in get_group_map().keys():
+            token = ""
+            while True:
+                response = cognito.list_users_in_group(group_name, token)
+                if "Users" not in response:
+                    return None
+                for aws_user_details in response["Users"]:
+                    groups.setdefault(aws_user_details["Username"], group_name)
+                token = response.get("NextToken", "")
+                if token == "":
+                    break
+        return groups
+
     @staticmethod
     def group(username):
         response = cognito.list_groups_for_user(username)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Local mirror of the Cognito user pool for admin searches.
+
+Cognito can only filter list_users on a single attribute prefix
+so questions like "which users have access to this path" mean
+walking the whole pool. The mirror keeps the normalised user
+details and group membership in a SQLite database on local disk
+with indexes on the fields the admin interface searches by.
+
+A sync walks the pool and only rewrites users whose
+UserLastModifiedDate or group has changed since the last sync.
+Users no longer in the pool are removed. Between syncs users
+created, updated or deleted through User are written to the
+mirror straight away.
+
+The user_paths table is a reverse index from each granted path
+to the users holding it, so the users affected by renaming or
+retiring a folder can be found without walking the pool.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from cognito_groups import get_group_by_name
+from logger import LOG
+from user import LIST_USERS_PAGE_SIZE, USER_CHANGE_LISTENERS, User
+import config
+
+# How old the mirror can be before a search syncs it first
+USER_DIRECTORY_MAX_AGE_SECONDS = 300
+
+SEARCH_LIMIT = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    name TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    phone_number_verified INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    enabled INTEGER NOT NULL,
+    is_la TEXT NOT NULL,
+    paths TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    created TEXT NOT NULL,
+    last_modified TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_domain ON users (domain);
+CREATE INDEX IF NOT EXISTS users_group_name ON users (group_name);
+CREATE INDEX IF NOT EXISTS users_is_la ON users (is_la);
+CREATE TABLE IF NOT EXISTS user_paths (
+    username TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (username, path)
+);
+CREATE INDEX IF NOT EXISTS user_paths_path ON user_paths (path);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+USER_COLUMNS = [
+    "username",
+    "email",
+    "domain",
+    "name",
+    "phone_number",
+    "phone_number_verified",
+    "status",
+    "enabled",
+    "is_la",
+    "paths",
+    "group_name",
+    "created",
+    "last_modified",
+]
+
+# Only one sync per process walks the pool at a time
+SYNC_LOCK = threading.Lock()
+
+
+def database_path():
+    return config.get("user_directory_path") or os.path.join(
+        tempfile.gettempdir(), "user-directory.sqlite3"
+    )
+
+
+def connect():
+    connection = sqlite3.connect(database_path(), timeout=30)
+    connection.row_factory = sqlite3.Row
+    # Searches can read while a sync is writing
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def email_domain(email):
+    return email.rsplit("@", 1)[-1] if "@" in email else ""
+
+
+def timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def user_row(user):
+    """ Flatten a User.normalise dict into a users table row """
+    email = user.get("email", "").lower()
+    return {
+        "username": user["username"],
+        "email": email,
+        "domain": email_domain(email),
+        "name": user.get("name", ""),
+        "phone_number": user.get("phone_number", ""),
+        "phone_number_verified": user.get("phone_number_verified") == "true",
+        "status": user["status"],
+        "enabled": bool(user["enabled"]),
+        "is_la": user.get("custom:is_la", "0"),
+        "paths": user.get("custom:paths", ""),
+        "group_name": user["group"]["value"],
+        "created": timestamp(user["createdate"]),
+        "last_modified": timestamp(user["lastmodifieddate"]),
+    }
+
+
+def row_user(row):
+    """ Return a users table row in the shape of User.normalise """
+    return {
+        "username": row["username"],
+        "email": row["email"],
+        "name": row["name"],
+        "phone_number": row["phone_number"],
+        "phone_number_verified": "true" if row["phone_number_verified"] else "false",
+        "status": row["status"],
+        "enabled": bool(row["enabled"]),
+        "custom:is_la": row["is_la"],
+        "custom:paths": row["paths"],
+        "group": get_group_by_name(row["group_name"]),
+        "createdate": row["created"],
+        "lastmodifieddate": row["last_modified"],
+    }
+
+
+def changed_columns(details):
+    """ The users table columns set by a change to some of a user's details """
+    columns = {}
+    if "enabled" in details:
+        columns["enabled"] = bool(details["enabled"])
+    if "group" in details:
+        columns["group_name"] = details["group"]["value"]
+    if "lastmodifieddate" in details:
+        columns["last_modified"] = timestamp(details["lastmodifieddate"])
+    return columns
+
+
+def update_user(connection, email_address, columns):
+    if not columns:
+        return
+    connection.execute(
+        "UPDATE users SET {} WHERE email = ?".format(
+            ", ".join(f"{column} = ?" for column in columns)
+        ),
+        list(columns.values()) + [email_address.lower()],
+    )
+
+
+def write_user(connection, row):
+    connection.execute(
+        "INSERT OR REPLACE INTO users ({}) VALUES ({})".format(
+            ", ".join(USER_COLUMNS), ", ".join("?" for _ in USER_COLUMNS)
+        ),
+        [row[column] for column in USER_COLUMNS],
+    )
+    connection.execute("DELETE FROM user_paths WHERE username = ?", [row["username"]])
+    connection.executemany(
+        "INSERT OR IGNORE INTO user_paths (username, path) VALUES (?, ?)",
+        [(row["username"], path) for path in row["paths"].split(";") if path],
+    )
+
+
+def delete_users(connection, usernames):
+    for username in usernames:
+        connection.execute("DELETE FROM users WHERE username = ?", [username])
+        connection.execute("DELETE FROM user_paths WHERE username = ?", [username])
+
+
+def sync_user_directory():
+    """
+    Bring the mirror up to date with the user pool
+
+    Returns the number of users seen, written and removed.
+    """
+    with SYNC_LOCK:
+        connection = connect()
+        try:
+            known = {
+                row["username"]: (row["last_modified"], row["group_name"])
+                for row in connection.execute(
+                    "SELECT username, last_modified, group_name FROM users"
+                )
+            }
+            seen = set()
+            written = 0
+            for user in User.iter_users(limit=LIST_USERS_PAGE_SIZE):
+                row = user_row(user)
+                seen.add(row["username"])
+                current = (row["last_modified"], row["group_name"])
+                if known.get(row["username"]) != current:
+                    write_user(connection, row)
+                    written += 1
+
+            removed = set(known) - seen
+            delete_users(connection, removed)
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)",
+                ["last_synced", time.time()],
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+    counts = {"seen": len(seen), "written": written, "removed": len(removed)}
+    LOG.info({"action": "user_directory.sync", "counts": counts})
+    return counts
+
+
+def apply_user_change(email_address, details):
+    """
+    Write a change made through User to the mirror
+
+    Details holding only the changed fields update just
+    those columns. A mirror that hasn't been made yet is left
+    to the first sync. The next sync rewrites the row with the timestamps
+    Cognito recorded for the change.
+    """
+    if not os.path.exists(database_path()):
+        return
+    try:
+        connection = connect()
+        try:
+            if details is None:
+                usernames = [
+                    row["username"]
+                    for row in connection.execute(
+                        "SELECT username FROM users WHERE email = ?",
+                        [email_address.lower()],
+                    )
+                ]
+                delete_users(connection, usernames)
+            elif "username" in details:
+                write_user(connection, user_row(details))
+            else:
+                update_user(connection, email_address, changed_columns(details))
+            connection.commit()
+        finally:
+            connection.close()
+    except sqlite3.Error as error:
+        # The change is in Cognito and the next sync will pick it up
+        LOG.error({"action": "user_directory.apply_user_change", "error": str(error)})
+
+
+USER_CHANGE_LISTENERS.append(apply_user_change)
+
+
+def last_synced():
+    """ Return when the mirror was last synced as a unix time or None """
+    connection = connect()
+    try:
+        row = connection.execute(
+            "SELECT value FROM sync_state WHERE name = 'last_synced'"
+        ).fetchone()
+    finally:
+        connection.close()
+    return row["value"] if row else None
+
+
+def sync_if_stale(max_age=USER_DIRECTORY_MAX_AGE_SECONDS):
+    synced = last_synced()
+    if synced is None or time.time() - synced > max_age:
+        return sync_user_directory()
+    return None
+
+
+def prefix_range(column, prefix):
+    # A range on the column can use its index where LIKE can't
+    return f"{column} >= ? AND {column} < ?", [prefix, prefix + "\uffff"]
+
+
+def search_users(
+    email_prefix="",
+    domain="",
+    group_name="",
+    is_la=None,
+    path_prefix="",
+    phone_unverified=False,
+    limit=SEARCH_LIMIT,
+):
+    """
+    Return users from the mirror matching all the given filters
+    ordered by email address.
+
+    domain matches the email domain and its subdomains and
+    path_prefix the start of any of the user's granted paths.
+    """
+    conditions = []
+    parameters = []
+
+    if email_prefix:
+        condition, values = prefix_range("users.email", email_prefix.lower())
+        conditions.append(condition)
+        parameters += values
+    if domain:
+        domain = domain.lower()
+        conditions.append("(users.domain = ? OR users.domain LIKE ? ESCAPE '\\')")
+        escaped = domain.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        parameters += [domain, f"%.{escaped}"]
+    if group_name:
+        conditions.append("users.group_name = ?")
+        parameters.append(group_name)
+    if is_la is not None:
+        conditions.append("users.is_la = ?")
+        parameters.append("1" if is_la else "0")
+    if phone_unverified:
+        conditions.append("users.phone_number_verified = 0")
+    if path_prefix:
+        condition, values = prefix_range("user_paths.path", path_prefix)
+        conditions.append(
+            "users.username IN (SELECT user_paths.username FROM user_paths "
+            f"WHERE {condition})"
+        )
+        parameters += values
+
+    query = "SELECT * FROM users"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY users.email LIMIT ?"
+    parameters.append(limit)
+
+    connection = connect()
+    try:
+        rows = connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+    return [row_user(row) for row in rows]
+
+
+def path_holders(path):
+    """
+    Return the email addresses of the users granted path
+    or a folder inside it, by granted path
+    """
+    path = path.rstrip("/")
+    condition, values = prefix_range("user_paths.path", path + "/")
+    return grouped_paths(f"user_paths.path = ? OR {condition}", [path] + values)
+
+
+def granted_paths():
+    """ Return every granted path with the email addresses holding it """
+    return grouped_paths("1", [])
+
+
+def grouped_paths(condition, parameters):
+    connection = connect()
+    try:
+        rows = connection.execute(
+            "SELECT user_paths.path, users.email FROM user_paths "
+            "JOIN users ON users.username = user_paths.username "
+            f"WHERE {condition} ORDER BY user_paths.path, users.email",
+            parameters,
+        ).fetchall()
+    finally:
+        connection.close()
+
+    holders = {}
+    for row in rows:
+        holders.setdefault(row["path"], []).append(row["email"])
+    return holders